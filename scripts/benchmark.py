@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the prediction pipeline over the bundled test images,
+without starting the server.
+Every batch is timed stage by stage: file read, JPEG decode, .convert('RGB'),
+the torchvision transform, each backbone (efficientnet, swin, resnet) and
+softmax/post-processing. The run is repeated
+for every combination of --batch-sizes and --threads and reports throughput,
+p50/p95/p99 batch latency and peak RSS.
+With --tensor-store the images are read already preprocessed from a store
+built by scripts/build_tensor_store.py, so only inference is measured.
+Results are written as JSON; pass --baseline with an earlier report to fail
+(exit code 1) when throughput or latency regress by more than --tolerance.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.app.model import CLASSES, build_unified_model
+from server.app.dataset import LABEL_DIRS, list_test_images
+from server.app.dedup import NearDuplicateIndex
+from server.app.preprocessing import transform
+from server.app.tensor_store import TensorStore
+
+STAGES = ["read", "decode", "convert_rgb", "transform", "store_load",
+          "efficientnet", "swin", "resnet", "postprocess"]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _timer(stage_times):
+    def timed(stage, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        stage_times[stage] += time.perf_counter() - started
+        return result
+    return timed
+
+
+def run_model(model, batch, timed):
+    with torch.no_grad():
+        outputs = [timed(name, getattr(model, name), batch) for name in ("efficientnet", "swin", "resnet")]
+
+        def postprocess():
+            probabilities = torch.softmax(sum(outputs) / 3, dim=1)
+            return [CLASSES[int(row.argmax())] for row in probabilities]
+        return timed("postprocess", postprocess)
+
+
+def run_store_batch(model, store, entries, stage_times):
+    """
+    Run one batch of preprocessed images from the tensor store through the model
+    """
+    timed = _timer(stage_times)
+    return run_model(model, timed("store_load", store.load, entries), timed)
+
+
+def run_batch(model, paths, stage_times):
+    """
+    Run one batch through every stage, adding each stage's time to stage_times
+    """
+    timed = _timer(stage_times)
+    tensors = []
+    for path in paths:
+        contents = timed("read", path.read_bytes)
+        image = timed("decode", lambda: Image.open(io.BytesIO(contents)).copy())
+        rgb = timed("convert_rgb", image.convert, "RGB")
+        tensors.append(timed("transform", transform, rgb))
+
+    return run_model(model, torch.stack(tensors), timed)
+
+
+def benchmark(model, items, batch_size, threads, runner, warmup_batches=1):
+    """
+    Time runner(model, batch_items, stage_times) over items in batches
+    """
+    torch.set_num_threads(threads)
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+    for batch in batches[:warmup_batches]:
+        runner(model, batch, {stage: 0.0 for stage in STAGES})
+
+    stage_times = {stage: 0.0 for stage in STAGES}
+    latencies = []
+    started = time.perf_counter()
+    for batch in batches:
+        batch_started = time.perf_counter()
+        runner(model, batch, stage_times)
+        latencies.append(time.perf_counter() - batch_started)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "batch_size": batch_size,
+        "threads": threads,
+        "images": len(items),
+        "throughput": len(items) / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000
+        },
+        "stage_ms_per_image": {stage: seconds / len(items) * 1000 for stage, seconds in stage_times.items()},
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def benchmark_dedup(entries, lookups=2000, seed=0):
+    """
+    Time NearDuplicateIndex lookups with entries random hashes stored:
+    misses, near matches (3 bits off a stored hash) and exact matches
+    """
+    rng = random.Random(seed)
+    index = NearDuplicateIndex(max_entries=entries)
+    index.set_model_version("benchmark")
+    stored = [rng.getrandbits(64) for _ in range(entries)]
+    for value in stored:
+        index.add(value, ((0.5, 0.5), ("efficientnet",), None))
+
+    queries = {
+        "miss": [rng.getrandbits(64) for _ in range(lookups)],
+        "near": [value ^ 0b1011 for value in stored[:lookups]],
+        "exact": stored[:lookups]
+    }
+    results = {}
+    for kind, values in queries.items():
+        latencies = []
+        for value in values:
+            started = time.perf_counter()
+            index.lookup(value)
+            latencies.append(time.perf_counter() - started)
+        results[kind] = {"p50": percentile(latencies, 50) * 1000, "p99": percentile(latencies, 99) * 1000}
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    List regressions against a baseline report: lower throughput or higher
+    p95 latency by more than tolerance (a fraction) for the same configuration
+    """
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get("results", {}).get(key)
+        if previous is None:
+            continue
+        if result["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {result['throughput']:.2f} < baseline {previous['throughput']:.2f} img/s")
+        if result["latency_ms"]["p95"] > previous["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 latency {result['latency_ms']['p95']:.1f} > baseline {previous['latency_ms']['p95']:.1f} ms")
+    return regressions
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the prediction pipeline on the bundled test images")
+    parser.add_argument("--model-dir", type=Path, help="Directory with the unified ensemble model")
+    parser.add_argument("--batch-sizes", type=parse_list, default=[1, 8, 32])
+    parser.add_argument("--threads", type=parse_list, default=[os.cpu_count() or 1])
+    parser.add_argument("--limit", type=int, help="Only use this many images per class")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_report.json"))
+    parser.add_argument("--baseline", type=Path, help="Earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Allowed relative regression against the baseline (default 10%%)")
+    parser.add_argument("--tensor-store", type=Path,
+                        help="Read preprocessed images from this tensor store and time inference only")
+    parser.add_argument("--dedup-entries", type=int,
+                        help="Only time near-duplicate index lookups with this many stored hashes")
+    args = parser.parse_args()
+
+    if args.dedup_entries:
+        print(f"Timing near-duplicate lookups with {args.dedup_entries} hashes stored...")
+        for kind, latency in benchmark_dedup(args.dedup_entries).items():
+            print(f"  {kind:<6} p50 {latency['p50']:.3f} ms, p99 {latency['p99']:.3f} ms")
+        return 0
+
+    if args.tensor_store:
+        store = TensorStore(args.tensor_store)
+        items = []
+        for label in LABEL_DIRS.values():
+            items += [entry for entry in store.entries if entry["label"] == label][:args.limit]
+
+        def runner(model, entries, stage_times):
+            return run_store_batch(model, store, entries, stage_times)
+    else:
+        items = [path for path, _ in list_test_images(limit=args.limit)]
+        runner = run_batch
+    if not items:
+        print("Error: no test images found")
+        return 1
+
+    print("Loading model...")
+    model = build_unified_model(args.model_dir)
+
+    results = {}
+    for threads in args.threads:
+        for batch_size in args.batch_sizes:
+            key = f"batch={batch_size},threads={threads}"
+            print(f"Running {key} over {len(items)} images...")
+            result = benchmark(model, items, batch_size, threads, runner)
+            results[key] = result
+            stages = ", ".join(f"{stage} {ms:.2f}" for stage, ms in result["stage_ms_per_image"].items())
+            print(f"  {result['throughput']:.2f} img/s, p50 {result['latency_ms']['p50']:.1f} ms, "
+                  f"p95 {result['latency_ms']['p95']:.1f} ms, p99 {result['latency_ms']['p99']:.1f} ms, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB")
+            print(f"  ms/image: {stages}")
+
+    report = {
+        "meta": {
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "source": str(args.tensor_store) if args.tensor_store else "images"
+        },
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s) against {args.baseline}:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print(f"\n✅ No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Script to preprocess an image directory once into memory-mapped tensor shards.
+Each image is decoded and resized exactly like the server does and stored as
+uint8 pixels, with an index of filename, label, original size and content
+hash. Re-running only processes images that were added or changed.
+Evaluation jobs read from the store when it exists, so repeated accuracy and
+latency runs skip decoding entirely; scripts/benchmark.py --tensor-store does
+the same for benchmarks.
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.app.config import TENSOR_STORE_DIR
+from server.app.dataset import find_test_images_dir
+from server.app.tensor_store import build_tensor_store, TensorStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the preprocessed tensor store")
+    parser.add_argument("--image-dir", type=Path, default=find_test_images_dir())
+    parser.add_argument("--store-dir", type=Path, default=Path(TENSOR_STORE_DIR))
+    parser.add_argument("--shard-size", type=int, default=256, help="Images per shard file")
+    args = parser.parse_args()
+
+    if not args.image_dir.exists():
+        print(f"Error: image directory not found: {args.image_dir}")
+        return 1
+
+    print(f"Building tensor store for {args.image_dir} in {args.store_dir}")
+    started = time.perf_counter()
+    counts = build_tensor_store(args.image_dir, args.store_dir, shard_size=args.shard_size)
+    elapsed = time.perf_counter() - started
+
+    store = TensorStore(args.store_dir)
+    shard_bytes = sum((args.store_dir / name).stat().st_size for name in store.index["shards"])
+    print(f"✅ {len(store)} images stored ({counts['kept']} unchanged, {counts['added']} added, "
+          f"{counts['removed']} removed) in {elapsed:.1f}s, {shard_bytes / 1024 / 1024:.1f} MB "
+          f"across {len(store.index['shards'])} shards")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
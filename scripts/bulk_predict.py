@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Script to score a large image archive offline with the unified ensemble,
+without going through the server.
+Inputs are a directory tree (searched recursively) or a CSV/JSONL manifest
+with a path column. Images are read and decoded by a pool of worker
+processes while the main process runs the ensemble on large batches, and
+results are streamed to JSONL, CSV or Parquet (a directory of part files;
+needs pyarrow).
+Progress is checkpointed next to the output: an interrupted run started
+again with the same arguments drops anything written after the last
+checkpoint and skips every image already in the output, so re-running on a
+directory that has grown only scores the new images.
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from collections import deque
+from itertools import islice
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Decode workers only need the preprocessing module; the model is imported in main()
+from server.app.preprocessing import decode_image, pixels_to_batch
+
+FORMATS = ("jsonl", "csv", "parquet")
+
+
+def _ignore_interrupts():
+    # Ctrl-C is handled by the main process, which checkpoints and stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def decode_path(path):
+    """
+    Read and decode one image in a worker process; returns (pixels, error)
+    """
+    try:
+        with open(path, "rb") as f:
+            return decode_image(f), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def iter_directory(root, extensions):
+    # Sorted walk, so the order (and a resumed run) is the same every time
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+        for name in sorted(filenames):
+            if not name.startswith(".") and os.path.splitext(name)[1].lower() in extensions:
+                yield os.path.join(dirpath, name)
+
+
+class ManifestError(ValueError):
+    """
+    A manifest row that can't be scored, with its file and line
+    """
+
+
+def _manifest_rows(f, path):
+    # (line number, row) pairs of a CSV or JSONL manifest
+    if path.suffix.lower() in (".jsonl", ".ndjson"):
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                raise ManifestError(f"{path}:{line_number}: invalid JSON: {e}")
+            yield line_number, row
+    else:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def iter_manifest(path, column, root=None):
+    """
+    Yield (key, path) pairs from a CSV (with a header row) or JSONL manifest
+
+    The key is the path as written in the manifest; relative paths are read
+    from root, or from the manifest's directory. Raises ManifestError on a
+    row without a path in column.
+    """
+    root = Path(root) if root else path.parent
+    with open(path, newline="") as f:
+        for line_number, row in _manifest_rows(f, path):
+            key = row.get(column) if isinstance(row, dict) else None
+            if not isinstance(key, str) or not key:
+                raise ManifestError(f"{path}:{line_number}: no {column!r} field in {row!r}")
+            yield key, str(root / key)
+
+
+def check_manifest(path, column):
+    """
+    Read the whole manifest once, so a bad row is reported before any
+    scoring starts rather than failing a long run halfway; returns the
+    number of rows
+    """
+    return sum(1 for _ in iter_manifest(path, column))
+
+
+class JsonlWriter:
+    def __init__(self, path, classes):
+        self.path = path
+        self.classes = classes
+        self.file = None
+
+    def restore(self, state):
+        """
+        Drop anything written after the checkpoint; returns the keys already scored
+        """
+        size = state["bytes"] if state else 0
+        with open(self.path, "a+b") as f:
+            f.truncate(size)
+        scored = set()
+        with open(self.path) as f:
+            for line in f:
+                scored.add(json.loads(line)["path"])
+        self.file = open(self.path, "a")
+        return scored
+
+    def write(self, rows):
+        self.file.write("".join(json.dumps(row) + "\n" for row in rows))
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {"bytes": self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+
+class CsvWriter(JsonlWriter):
+    def __init__(self, path, classes):
+        super().__init__(path, classes)
+        self.fields = ["path", "prediction", "confidence"] + [f"p_{name.lower()}" for name in classes] + ["error"]
+
+    def restore(self, state):
+        size = state["bytes"] if state else 0
+        with open(self.path, "a+b") as f:
+            f.truncate(size)
+        with open(self.path, newline="") as f:
+            scored = {row["path"] for row in csv.DictReader(f)}
+        self.file = open(self.path, "a", newline="")
+        self.writer = csv.DictWriter(self.file, self.fields)
+        if size == 0:
+            self.writer.writeheader()
+        return scored
+
+    def write(self, rows):
+        for row in rows:
+            flat = {key: row.get(key) for key in ("path", "prediction", "confidence", "error")}
+            for name, probability in row.get("probabilities", {}).items():
+                flat[f"p_{name.lower()}"] = probability
+            self.writer.writerow(flat)
+
+
+class ParquetWriter:
+    """
+    Writes one part file per checkpoint into the output directory, since a
+    Parquet file can't be appended to
+    """
+    def __init__(self, path, classes):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output requires pyarrow: pip install pyarrow")
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.path = path
+        self.classes = classes
+        self.rows = []
+        self.parts = 0
+
+    def _part(self, index):
+        return self.path / f"part-{index:05d}.parquet"
+
+    def restore(self, state):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.parts = state["parts"] if state else 0
+        # Parts from after the checkpoint
+        for part in self.path.glob("part-*.parquet"):
+            if int(part.stem.split("-")[1]) >= self.parts:
+                part.unlink()
+        scored = set()
+        for index in range(self.parts):
+            scored.update(self.pq.read_table(self._part(index), columns=["path"]).column("path").to_pylist())
+        return scored
+
+    def write(self, rows):
+        self.rows.extend(rows)
+
+    def commit(self):
+        if self.rows:
+            columns = {key: [row.get(key) for row in self.rows] for key in ("path", "prediction", "confidence", "error")}
+            for name in self.classes:
+                columns[f"p_{name.lower()}"] = [row.get("probabilities", {}).get(name) for row in self.rows]
+            self.pq.write_table(self.pa.table(columns), self._part(self.parts))
+            self.parts += 1
+            self.rows = []
+        return {"parts": self.parts}
+
+    def close(self):
+        pass
+
+
+WRITERS = {"jsonl": JsonlWriter, "csv": CsvWriter, "parquet": ParquetWriter}
+
+
+def checkpoint_path(output):
+    return output.parent / f"{output.name}.checkpoint.json"
+
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def format_row(key, probabilities, classes):
+    predicted = int(probabilities.argmax())
+    return {
+        "path": key,
+        "prediction": classes[predicted],
+        "confidence": round(probabilities[predicted].item(), 6),
+        "probabilities": {name: round(probability, 6) for name, probability in zip(classes, probabilities.tolist())}
+    }
+
+
+class Progress:
+    """
+    Live images/sec line, rewritten in place at most once per interval
+    """
+    def __init__(self, already_scored, interval=1.0):
+        self.already_scored = already_scored
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.last = 0.0
+        self.scored = 0
+        self.errors = 0
+
+    def update(self, scored, errors, force=False):
+        self.scored += scored
+        self.errors += errors
+        now = time.perf_counter()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.started
+        rate = self.scored / elapsed if elapsed > 0 else 0.0
+        print(f"\r{self.scored} scored ({rate:.1f} img/s), {self.errors} errors, "
+              f"{self.already_scored} skipped, {elapsed:.0f}s", end="", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score an image directory or manifest offline with the ensemble")
+    parser.add_argument("input", type=Path, help="Image directory, or a .csv/.jsonl manifest of image paths")
+    parser.add_argument("output", type=Path, help="Output file (directory for parquet)")
+    parser.add_argument("--format", choices=FORMATS, help="Output format (default: from the output suffix, else jsonl)")
+    parser.add_argument("--path-column", default="path", help="Manifest column holding the image paths")
+    parser.add_argument("--root", type=Path, help="Directory relative manifest paths are read from")
+    parser.add_argument("--model-dir", type=Path, help="Directory with the unified ensemble model")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per forward pass")
+    parser.add_argument("--decode-workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Processes reading and decoding images")
+    parser.add_argument("--prefetch", type=int, default=2, help="Batches decoded ahead of the one being scored")
+    parser.add_argument("--checkpoint-every", type=int, default=4096, help="Images between checkpoints")
+    parser.add_argument("--no-optimize", action="store_true", help="Skip the load-time optimization pass")
+    parser.add_argument("--restart", action="store_true", help="Discard the existing output and checkpoint")
+    args = parser.parse_args()
+
+    if not args.input.exists():
+        print(f"Error: input not found: {args.input}")
+        return 1
+    if not args.input.is_dir():
+        try:
+            check_manifest(args.input, args.path_column)
+        except ManifestError as e:
+            print(f"Error: {e}")
+            return 1
+    output_format = args.format or args.output.suffix.lstrip(".").lower()
+    if output_format not in FORMATS:
+        output_format = "jsonl"
+
+    from server.app.backends import EagerBackend
+    from server.app.bulk import IMAGE_EXTENSIONS
+    from server.app.cache import weights_checksum
+    from server.app.config import OPTIMIZE_TRANSFORMS, OPTIMIZE_TOLERANCE, OPTIMIZE_CHECK_IMAGES
+    from server.app.model import CLASSES, build_unified_model, device, find_model_dir
+    from server.app.optimize import optimize_model
+
+    # Same weights the tool loads, so a resumed run can tell if they changed
+    model_dir = args.model_dir or find_model_dir()
+    weight_files = [path for path in (model_dir / "unified_ensemble_model.safetensors",
+                                      model_dir / "unified_ensemble_model.pth") if path.exists()][:1]
+    model_version = weights_checksum(weight_files)
+
+    checkpoint_file = checkpoint_path(args.output)
+    if args.restart:
+        for path in (checkpoint_file, args.output):
+            if path.is_dir():
+                for part in path.glob("part-*.parquet"):
+                    part.unlink()
+            elif path.exists():
+                path.unlink()
+    checkpoint = None
+    if checkpoint_file.exists():
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        if checkpoint["format"] != output_format:
+            print(f"Error: {args.output} was written as {checkpoint['format']}; pass --restart to start over")
+            return 1
+        if checkpoint["model_version"] != model_version:
+            print(f"Error: {args.output} was scored by model {checkpoint['model_version']}, "
+                  f"not {model_version}; pass --restart to start over")
+            return 1
+    elif args.output.exists() and (args.output.is_file() or any(args.output.iterdir())):
+        print(f"Error: {args.output} exists but has no checkpoint; pass --restart to overwrite it")
+        return 1
+
+    writer = WRITERS[output_format](args.output, CLASSES)
+    scored = writer.restore(checkpoint["output"] if checkpoint else None)
+    if scored:
+        print(f"Resuming: {len(scored)} images already scored in {args.output}")
+
+    # Started before the model is loaded so the workers don't inherit it
+    pool = multiprocessing.Pool(args.decode_workers, initializer=_ignore_interrupts)
+
+    print("Loading model...")
+    model = build_unified_model(model_dir).to(device)
+    options = {}
+    if not args.no_optimize and OPTIMIZE_TRANSFORMS:
+        model, options, report = optimize_model(model, device, OPTIMIZE_TRANSFORMS, OPTIMIZE_TOLERANCE,
+                                                OPTIMIZE_CHECK_IMAGES)
+        applied = [entry["name"] for entry in report["transforms"] if entry["status"] == "applied"]
+        print(f"Optimizations applied: {', '.join(applied) or 'none'}")
+    backend = EagerBackend(model, device, **options)
+
+    if args.input.is_dir():
+        entries = ((path, path) for path in iter_directory(args.input, IMAGE_EXTENSIONS))
+    else:
+        entries = iter_manifest(args.input, args.path_column, args.root)
+    entries = ((key, path) for key, path in entries if key not in scored)
+
+    checkpoint = {
+        "input": str(args.input.resolve()),
+        "format": output_format,
+        "model_version": model_version,
+        "started_at": (checkpoint or {}).get("started_at", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        "images": len(scored),
+        "errors": (checkpoint or {}).get("errors", 0),
+        "finished": False
+    }
+    progress = Progress(len(scored))
+    since_checkpoint = 0
+
+    def commit():
+        checkpoint["output"] = writer.commit()
+        checkpoint["images"] = len(scored) + progress.scored + progress.errors
+        checkpoint["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        save_checkpoint(checkpoint_file, checkpoint)
+
+    # Decoding runs batches ahead in the worker pool while the current batch
+    # is scored; only prefetch + 1 batches of pixels are held at a time.
+    # Images that fail to decode are written with an error and not retried.
+    pending = deque()
+    exit_code = 0
+    try:
+        while True:
+            while len(pending) < args.prefetch + 1:
+                chunk = list(islice(entries, args.batch_size))
+                if not chunk:
+                    break
+                pending.append((chunk, pool.map_async(decode_path, [path for _, path in chunk], chunksize=4)))
+            if not pending:
+                break
+            chunk, decoding = pending.popleft()
+            decoded = decoding.get()
+
+            rows = []
+            pixels = [array for array, error in decoded if error is None]
+            probabilities = iter(backend.predict_proba(pixels_to_batch(pixels)) if pixels else [])
+            for (key, _), (array, error) in zip(chunk, decoded):
+                if error is not None:
+                    rows.append({"path": key, "error": error})
+                else:
+                    rows.append(format_row(key, next(probabilities), CLASSES))
+            errors = sum(1 for _, error in decoded if error is not None)
+            writer.write(rows)
+            checkpoint["errors"] += errors
+            progress.update(len(rows) - errors, errors)
+
+            since_checkpoint += len(rows)
+            if since_checkpoint >= args.checkpoint_every:
+                commit()
+                since_checkpoint = 0
+        checkpoint["finished"] = True
+    except KeyboardInterrupt:
+        print("\nInterrupted, saving checkpoint...")
+        exit_code = 130
+    finally:
+        pool.terminate()
+        commit()
+        writer.close()
+
+    progress.update(0, 0, force=True)
+    print()
+    if exit_code:
+        print(f"❌ Stopped after {checkpoint['images']} images; run again with the same arguments to resume")
+        return exit_code
+    print(f"✅ {checkpoint['images']} images in {args.output} ({checkpoint['errors']} could not be decoded)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
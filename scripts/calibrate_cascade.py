@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Script to calibrate the confidence threshold of the cascade mode.
+Runs all three backbones on the bundled test images, then for a range of
+thresholds on the efficientnet_b0 softmax margin reports how many images
+would be escalated to swin and resnet, the estimated relative latency, and
+how often the cascade agrees with the full ensemble. The recommended
+threshold is the cheapest one that keeps agreement above --min-agreement.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.app.model import build_unified_model
+from server.app.dataset import list_test_images
+from server.app.preprocessing import preprocess_batch
+
+DEFAULT_MODEL_DIR = Path(os.path.join(os.path.dirname(__file__), "../server/model")).resolve()
+CLASSES = ["Normal", "Pneumonia"]
+
+
+def collect_outputs(model, images, batch_size):
+    """
+    Logits of every backbone for every image, plus the time each backbone took
+    """
+    logits = {"efficientnet": [], "swin": [], "resnet": []}
+    seconds = {name: 0.0 for name in logits}
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            chunk = images[start:start + batch_size]
+            batch = preprocess_batch([path.read_bytes() for path, _ in chunk])
+            for name in logits:
+                started = time.perf_counter()
+                logits[name].append(getattr(model, name)(batch))
+                seconds[name] += time.perf_counter() - started
+    return {name: torch.cat(outputs) for name, outputs in logits.items()}, seconds
+
+
+def sweep(logits, seconds, labels, thresholds):
+    """
+    Escalation rate, relative cost and agreement with the full ensemble per threshold
+    """
+    efficientnet_probs = torch.softmax(logits["efficientnet"], dim=1)
+    top2 = efficientnet_probs.topk(2, dim=1).values
+    margin = top2[:, 0] - top2[:, 1]
+
+    full_logits = (logits["efficientnet"] + logits["swin"] + logits["resnet"]) / 3
+    full_pred = full_logits.argmax(dim=1)
+    cheap_pred = efficientnet_probs.argmax(dim=1)
+    total_time = sum(seconds.values())
+
+    rows = []
+    for threshold in thresholds:
+        escalated = margin < threshold
+        cascade_pred = torch.where(escalated, full_pred, cheap_pred)
+        escalation_rate = escalated.float().mean().item()
+        rows.append({
+            "threshold": round(threshold, 4),
+            "escalation_rate": escalation_rate,
+            "relative_cost": (seconds["efficientnet"] + escalation_rate * (seconds["swin"] + seconds["resnet"])) / total_time,
+            "agreement": (cascade_pred == full_pred).float().mean().item(),
+            "accuracy": (cascade_pred == labels).float().mean().item()
+        })
+    return rows, (full_pred == labels).float().mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the cascade confidence threshold")
+    parser.add_argument("--model-dir", type=Path, default=DEFAULT_MODEL_DIR)
+    parser.add_argument("--min-agreement", type=float, default=0.99,
+                        help="Minimum agreement with the full ensemble for the recommended threshold")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--output", type=Path, help="Write the sweep as JSON to this file")
+    args = parser.parse_args()
+
+    images = list_test_images()
+    if not images:
+        print("Error: no test images found")
+        return 1
+    labels = torch.tensor([CLASSES.index(label) for _, label in images])
+    print(f"Running all backbones on {len(images)} test images...")
+
+    logits, seconds = collect_outputs(build_unified_model(args.model_dir), images, args.batch_size)
+    thresholds = [i / 20 for i in range(21)]
+    rows, full_accuracy = sweep(logits, seconds, labels, thresholds)
+
+    print(f"\nFull ensemble accuracy: {full_accuracy:.4f}")
+    print(f"Backbone time: " + ", ".join(f"{name} {value:.2f}s" for name, value in seconds.items()))
+    print(f"\n{'threshold':>10} {'escalated':>10} {'cost':>8} {'agreement':>10} {'accuracy':>10}")
+    for row in rows:
+        print(f"{row['threshold']:>10.2f} {row['escalation_rate']:>10.1%} {row['relative_cost']:>8.1%} "
+              f"{row['agreement']:>10.4f} {row['accuracy']:>10.4f}")
+
+    candidates = [row for row in rows if row["agreement"] >= args.min_agreement]
+    recommended = min(candidates, key=lambda row: row["relative_cost"]) if candidates else None
+    if recommended:
+        print(f"\nRecommended: CASCADE_MODE=1 CASCADE_THRESHOLD={recommended['threshold']} "
+              f"({recommended['relative_cost']:.1%} of full ensemble cost, {recommended['agreement']:.2%} agreement)")
+    else:
+        print(f"\nNo threshold reaches {args.min_agreement} agreement")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"full_accuracy": full_accuracy, "seconds": seconds, "sweep": rows,
+                       "recommended": recommended}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Script to run the load-time optimization pass on the unified ensemble and
+report, per transform, whether it stays within the tolerance, how far its
+outputs moved from the unoptimized model on the bundled test images and how
+much latency it gained. This is the same pass the server runs at startup
+when OPTIMIZE_TRANSFORMS is set; use it to pick the transforms to enable.
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import torch
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.app.model import build_unified_model
+from server.app.optimize import TRANSFORMS, optimize_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the latency gained by each load-time optimization")
+    parser.add_argument("--model-dir", type=Path, help="Directory with the unified ensemble model")
+    parser.add_argument("--transforms", default=",".join(TRANSFORMS),
+                        help="Comma separated transforms to try (default: all)")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="Maximum class probability difference allowed per transform")
+    parser.add_argument("--images", type=int, default=8, help="Test images per class to check and time on")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed passes per transform")
+    parser.add_argument("--output", type=Path, help="Also write the report as JSON")
+    args = parser.parse_args()
+
+    print("Loading model...")
+    model = build_unified_model(args.model_dir)
+    transforms = [name.strip() for name in args.transforms.split(",") if name.strip()]
+    _, _, report = optimize_model(model, torch.device("cpu"), transforms, args.tolerance, args.images, args.repeats)
+
+    print(f"\nBaseline: {report['baseline_ms']:.1f} ms for {report['check_images']} images ({report['check_source']})")
+    for transform in report["transforms"]:
+        line = f"  {transform['name']:<15} {transform['status']:<12}"
+        if "max_abs_diff" in transform:
+            line += f" max diff {transform['max_abs_diff']:.2e}"
+        if "gain_pct" in transform:
+            line += f", {transform['latency_ms']:.1f} ms ({transform['gain_pct']:+.1f}%)"
+        print(line)
+    print(f"Optimized: {report['optimized_ms']:.1f} ms ({report['total_gain_pct']:+.1f}%)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+    if any(transform["status"] == "rejected" for transform in report["transforms"]):
+        print("\n❌ Some transforms changed the outputs beyond the tolerance and were rejected")
+        return 1
+    print("\n✅ Every enabled transform stays within the tolerance")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Script to check the fast preprocessing path against the reference torchvision
+transform on the bundled test images.
+The exact path (JPEG draft mode off) must match the reference within float
+rounding; the draft path is allowed a small deviation since the JPEG decoder
+downscales before the bilinear resize.
+"""
+
+import argparse
+import io
+import os
+import sys
+from pathlib import Path
+
+import torch
+from PIL import Image
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.app.preprocessing import transform, preprocess_bytes, preprocess_batch
+
+DEFAULT_IMAGE_DIR = Path(os.path.join(os.path.dirname(__file__), "../server/test_images")).resolve()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check fast preprocessing against the torchvision transform")
+    parser.add_argument("--image-dir", type=Path, default=DEFAULT_IMAGE_DIR)
+    parser.add_argument("--tolerance", type=float, default=1e-5,
+                        help="Maximum absolute difference allowed for the exact path")
+    parser.add_argument("--draft-tolerance", type=float, default=0.02,
+                        help="Maximum mean absolute difference allowed for the draft path")
+    args = parser.parse_args()
+
+    image_paths = sorted(p for p in args.image_dir.rglob("*") if p.suffix.lower() in (".jpeg", ".jpg", ".png"))
+    if not image_paths:
+        print(f"Error: no test images found in {args.image_dir}")
+        return 1
+    print(f"Checking {len(image_paths)} images from {args.image_dir}")
+
+    exact_max = 0.0
+    draft_max = 0.0
+    draft_mean_worst = 0.0
+    failures = []
+    buffers = []
+
+    for image_path in image_paths:
+        contents = image_path.read_bytes()
+        buffers.append(contents)
+        reference = transform(Image.open(io.BytesIO(contents)).convert('RGB'))
+
+        exact_diff = (preprocess_bytes(contents, draft=False) - reference).abs()
+        draft_diff = (preprocess_bytes(contents, draft=True) - reference).abs()
+
+        exact_max = max(exact_max, exact_diff.max().item())
+        draft_max = max(draft_max, draft_diff.max().item())
+        draft_mean_worst = max(draft_mean_worst, draft_diff.mean().item())
+
+        if exact_diff.max().item() > args.tolerance:
+            failures.append(f"{image_path.name}: exact path max diff {exact_diff.max().item():.2e}")
+        if draft_diff.mean().item() > args.draft_tolerance:
+            failures.append(f"{image_path.name}: draft path mean diff {draft_diff.mean().item():.2e}")
+
+    # Batch preprocessing must produce the same tensors as the single-image path
+    batch = preprocess_batch(buffers[:32], draft=False)
+    singles = torch.stack([preprocess_bytes(contents, draft=False) for contents in buffers[:32]])
+    batch_max = (batch - singles).abs().max().item()
+    if batch_max > args.tolerance:
+        failures.append(f"batch path max diff {batch_max:.2e}")
+
+    print(f"Exact path: max abs diff {exact_max:.2e}")
+    print(f"Draft path: max abs diff {draft_max:.2e}, worst per-image mean abs diff {draft_mean_worst:.2e}")
+    print(f"Batch path: max abs diff {batch_max:.2e}")
+
+    if failures:
+        print(f"\n❌ {len(failures)} check(s) failed:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+
+    print("\n✅ Fast preprocessing matches the reference transform")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Script to check the class activation saliency maps on the unified ensemble.
+Hooks the three backbones' pooling layers (including swin's channels-last
+feature maps), runs the bundled test images through the ensemble and checks
+that every backbone contributed a feature map and that the fused heatmaps
+are finite, in [0, 1] and render as overlays.
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import torch
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.app.model import build_unified_model
+from server.app.optimize import check_inputs
+from server.app.preprocessing import IMAGE_SIZE
+from server.app.saliency import capture_features, class_activation_maps, overlay_png
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check saliency maps on the unified ensemble")
+    parser.add_argument("--model-dir", type=Path, help="Directory with the unified ensemble model")
+    parser.add_argument("--images", type=int, default=2, help="Test images per class to explain")
+    args = parser.parse_args()
+
+    print("Loading model...")
+    ensemble = build_unified_model(args.model_dir).ensemble
+    batch, source = check_inputs(args.images)
+    # Explain every other row, so the captures have to pick the right ones
+    rows = list(range(0, len(batch), 2))
+    print(f"Explaining {len(rows)} of {len(batch)} images ({source})")
+
+    with torch.no_grad(), capture_features(ensemble, rows) as capture:
+        logits = ensemble(batch)
+    heatmaps = class_activation_maps(ensemble, capture, logits[rows].argmax(dim=1))
+
+    failures = []
+    for name in ensemble.names:
+        features = capture.features.get(name)
+        if features is None:
+            failures.append(f"{name}: no feature map captured")
+        else:
+            print(f"  {name:<15} feature map {tuple(features.shape)}")
+            if features.shape[0] != len(rows):
+                failures.append(f"{name}: captured {features.shape[0]} rows, expected {len(rows)}")
+    expected = (len(rows),) + IMAGE_SIZE[::-1]
+    if heatmaps is None:
+        failures.append("no heatmaps computed")
+    else:
+        print(f"Heatmaps {tuple(heatmaps.shape)}, range [{heatmaps.min().item():.3f}, {heatmaps.max().item():.3f}]")
+        if tuple(heatmaps.shape) != expected:
+            failures.append(f"heatmaps have shape {tuple(heatmaps.shape)}, expected {expected}")
+        if not torch.isfinite(heatmaps).all() or heatmaps.min() < 0 or heatmaps.max() > 1:
+            failures.append("heatmaps are not finite values in [0, 1]")
+        else:
+            sizes = [len(overlay_png(heatmap)) for heatmap in heatmaps]
+            print(f"Overlays: {min(sizes)} to {max(sizes)} base64 characters")
+
+    if failures:
+        print(f"\n❌ {len(failures)} check(s) failed:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+
+    print("\n✅ Every backbone contributes to the saliency maps")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
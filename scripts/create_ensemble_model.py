@@ -3,8 +3,18 @@
 Script to create a unified ensemble model from individual models.
 This will load the three separate models, combine them into an ensemble,
 and save the ensemble as a single file for easier use.
+Alongside the .pth file it writes a memory-mappable .safetensors copy that the
+server loads zero-copy, so all worker processes share one set of weights.
+Run with --convert path/to/unified_ensemble_model.pth to only produce the
+.safetensors copy of an existing unified model.
+Run with --export path/to/unified_ensemble_model.pth to export the model for
+the torchscript and onnx inference backends (softmax folded in, dynamic batch
+dimension), then check their outputs against eager PyTorch and compare their
+latency at batch sizes 1, 8 and 32.
 """
 
+import argparse
+import time
 import torch
 import torch.nn as nn
 import timm
@@ -14,7 +24,11 @@ import sys
 
 # Add parent directory to path for imports
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from server.app.model import EnsembleModel
+from server.app.model import EnsembleModel, EnsembleProbabilities
+from server.app.weights import save_mmap_weights, load_mmap_weights
+from server.app.backends import EagerBackend, TorchScriptBackend, OnnxRuntimeBackend
+from server.app.dataset import list_test_images
+from server.app.preprocessing import preprocess_batch
 
 class EnsembleModelWrapper(nn.Module):
     """
@@ -35,7 +49,139 @@ class EnsembleModelWrapper(nn.Module):
     def forward(self, x):
         return self.ensemble(x)
 
+def save_mmap_copy(unified_model, pth_path):
+    """
+    Write the memory-mappable copy of a unified model next to its .pth file
+    and check that it loads back to identical weights
+    """
+    mmap_path = pth_path.with_suffix(".safetensors")
+    state_dict = unified_model.state_dict()
+    save_mmap_weights(state_dict, mmap_path)
+
+    loaded = load_mmap_weights(mmap_path)
+    for name, tensor in state_dict.items():
+        if not torch.equal(loaded[name], tensor.cpu()):
+            raise ValueError(f"Memory-mapped weights differ from the model for {name}")
+    print(f"Memory-mapped ensemble model saved to: {mmap_path}")
+    return mmap_path
+
+def convert(pth_path):
+    """
+    Produce the .safetensors copy of an existing unified .pth model
+    """
+    pth_path = Path(pth_path).resolve()
+    unified_model = EnsembleModelWrapper()
+    unified_model.load_state_dict(torch.load(pth_path, map_location="cpu"))
+    unified_model.eval()
+    save_mmap_copy(unified_model, pth_path)
+
+def export_backends(unified_model, output_dir, opset_version=17):
+    """
+    Export the ensemble with the softmax folded in as a frozen TorchScript
+    trace and as an ONNX graph, both with a dynamic batch dimension
+    """
+    probabilities_model = EnsembleProbabilities(unified_model).eval()
+    example_input = torch.zeros(1, 3, 256, 256)
+
+    torchscript_path = output_dir / "unified_ensemble_model.ts.pt"
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(probabilities_model, example_input))
+    torch.jit.save(traced, str(torchscript_path))
+    print(f"TorchScript ensemble model saved to: {torchscript_path}")
+
+    onnx_path = output_dir / "unified_ensemble_model.onnx"
+    torch.onnx.export(
+        probabilities_model,
+        example_input,
+        str(onnx_path),
+        input_names=["image"],
+        output_names=["probabilities"],
+        dynamic_axes={"image": {0: "batch"}, "probabilities": {0: "batch"}},
+        opset_version=opset_version,
+        do_constant_folding=True
+    )
+    print(f"ONNX ensemble model saved to: {onnx_path}")
+    return torchscript_path, onnx_path
+
+def compare_backends(unified_model, torchscript_path, onnx_path, batch_sizes=(1, 8, 32), runs=5, tolerance=1e-4):
+    """
+    Check every exported backend against eager PyTorch on the test images and
+    compare their latency per batch size
+
+    Returns False if any backend's probabilities differ by more than tolerance.
+    """
+    cpu = torch.device("cpu")
+    backends = {
+        "eager": EagerBackend(unified_model, cpu),
+        "torchscript": TorchScriptBackend(torchscript_path, cpu)
+    }
+    try:
+        backends["onnx"] = OnnxRuntimeBackend(onnx_path)
+    except RuntimeError as e:
+        print(f"Skipping onnx backend: {e}")
+
+    # Parity on real images, at every batch size so the dynamic batch dimension is exercised
+    images = list_test_images(limit=max(batch_sizes) // 2)
+    inputs = preprocess_batch([path.read_bytes() for path, _ in images])
+    passed = True
+    print("\nParity against eager (max abs difference of probabilities):")
+    for batch_size in batch_sizes:
+        batch = inputs[:batch_size]
+        if len(batch) < batch_size:
+            batch = torch.cat([batch, torch.randn(batch_size - len(batch), 3, 256, 256)])
+        reference = backends["eager"].predict_proba(batch)
+        for name, backend in backends.items():
+            if name == "eager":
+                continue
+            diff = (backend.predict_proba(batch) - reference).abs().max().item()
+            ok = diff <= tolerance
+            passed = passed and ok
+            print(f"  {name:<12} batch {batch_size:>3}: {diff:.2e} {'✅' if ok else '❌'}")
+
+    print("\nLatency (ms per batch, images/s):")
+    print(f"  {'backend':<12}" + "".join(f"{'batch ' + str(b):>22}" for b in batch_sizes))
+    for name, backend in backends.items():
+        row = f"  {name:<12}"
+        for batch_size in batch_sizes:
+            batch = torch.randn(batch_size, 3, 256, 256)
+            backend.predict_proba(batch)  # warmup
+            started = time.perf_counter()
+            for _ in range(runs):
+                backend.predict_proba(batch)
+            elapsed = (time.perf_counter() - started) / runs
+            row += f"{elapsed * 1000:>12.1f} {batch_size / elapsed:>8.1f}/s"
+        print(row)
+
+    return passed
+
+def export(pth_path):
+    """
+    Export an existing unified .pth model for the torchscript and onnx backends
+    """
+    pth_path = Path(pth_path).resolve()
+    unified_model = EnsembleModelWrapper()
+    unified_model.load_state_dict(torch.load(pth_path, map_location="cpu"))
+    unified_model.eval()
+
+    torchscript_path, onnx_path = export_backends(unified_model, pth_path.parent)
+    if not compare_backends(unified_model, torchscript_path, onnx_path):
+        print("❌ Exported backends do not match eager PyTorch")
+        sys.exit(1)
+    print("\n✅ Exported backends match eager PyTorch")
+
 def main():
+    parser = argparse.ArgumentParser(description="Create the unified ensemble model")
+    parser.add_argument("--convert", metavar="PTH", help="Only write the .safetensors copy of an existing unified .pth model")
+    parser.add_argument("--export", metavar="PTH", help="Export an existing unified .pth model to TorchScript and ONNX")
+    args = parser.parse_args()
+
+    if args.convert:
+        convert(args.convert)
+        return
+    if args.export:
+        export(args.export)
+        return
+
     # Set the device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
@@ -91,6 +237,7 @@ def main():
         output_path = model_dir / "unified_ensemble_model.pth"
         torch.save(unified_model.state_dict(), output_path)
         print(f"Unified ensemble model saved to: {output_path}")
+        save_mmap_copy(unified_model, output_path)
         
         # Test loading the model
         test_model = EnsembleModelWrapper()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Script to compare per-worker memory and load time of the unified ensemble
+model loaded from the .pth file versus the memory-mapped .safetensors file.
+Starts several worker processes per format, like uvicorn --workers would, waits
+until all of them have loaded the model and then reports each worker's RSS,
+the part of it that is private (anonymous) memory, and its proportional
+share (PSS) which accounts for pages shared between the workers.
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_MODEL_DIR = Path(os.path.join(os.path.dirname(__file__), "../server/model")).resolve()
+
+
+def memory_usage():
+    """
+    Read RSS, anonymous RSS and PSS of the current process in MB (Linux only)
+    """
+    usage = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "RssAnon:", "RssFile:")):
+                name, value = line.split(":")
+                usage[name] = int(value.split()[0]) / 1024
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    usage["Pss"] = int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        usage["Pss"] = None
+    return usage
+
+
+def worker(weights_path, loaded, release, results):
+    import torch
+    from server.app.model import EnsembleModelWrapper
+    from server.app.weights import load_mmap_weights
+
+    torch.set_num_threads(1)
+    started = time.perf_counter()
+    model = EnsembleModelWrapper()
+    if weights_path.endswith(".safetensors"):
+        model.load_state_dict(load_mmap_weights(weights_path), assign=True)
+    else:
+        model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    model.eval()
+    load_time = time.perf_counter() - started
+
+    # Touch every weight once, like a first forward pass would
+    with torch.no_grad():
+        checksum = sum(float(p.sum()) for p in model.parameters())
+
+    # Measure only once every worker is holding its model
+    loaded.wait()
+    results.put({"load_time": load_time, "checksum": checksum, **memory_usage()})
+    release.wait()
+
+
+def measure(weights_path, workers):
+    ctx = mp.get_context("spawn")
+    loaded = ctx.Barrier(workers)
+    release = ctx.Barrier(workers + 1)
+    results = ctx.Queue()
+
+    processes = [ctx.Process(target=worker, args=(str(weights_path), loaded, release, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measurements = [results.get() for _ in range(workers)]
+    release.wait()
+    for process in processes:
+        process.join()
+    return measurements
+
+
+def summarize(name, measurements):
+    def avg(key):
+        values = [m[key] for m in measurements if m.get(key) is not None]
+        return sum(values) / len(values) if values else float("nan")
+
+    print(f"{name:<14} {avg('load_time'):>10.2f} {avg('VmRSS'):>10.0f} {avg('RssAnon'):>10.0f} "
+          f"{avg('RssFile'):>10.0f} {avg('Pss'):>10.0f} {sum(m['Pss'] or 0 for m in measurements):>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure per-worker RSS and load time of each weight format")
+    parser.add_argument("--model-dir", type=Path, default=DEFAULT_MODEL_DIR)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    formats = {
+        ".pth": args.model_dir / "unified_ensemble_model.pth",
+        ".safetensors": args.model_dir / "unified_ensemble_model.safetensors",
+    }
+
+    print(f"Loading with {args.workers} workers per format (memory in MB, averaged per worker)\n")
+    print(f"{'format':<14} {'load (s)':>10} {'RSS':>10} {'anon':>10} {'file':>10} {'PSS':>10} {'total PSS':>12}")
+    for name, path in formats.items():
+        if not path.exists():
+            print(f"{name:<14} not found at {path}")
+            continue
+        summarize(name, measure(path, args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Script to build an INT8 version of the unified ensemble model for CPU inference.
+The Linear layers of the Swin transformer are dynamically quantized, and the
+EfficientNet and ResNet conv backbones are statically quantized with FX graph
+mode, calibrated on the bundled test images. The quantized ensemble is saved
+as a TorchScript file that the server loads with MODEL_PRECISION=int8.
+The artifact is only published if its predictions agree with the fp32 model
+on the held-out test images at or above the given threshold.
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# Add parent directory to path for imports
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server.app.model import EnsembleModel, EnsembleProbabilities, build_unified_model
+from server.app.dataset import list_test_images
+from server.app.preprocessing import preprocess_batch
+
+DEFAULT_MODEL_DIR = Path(os.path.join(os.path.dirname(__file__), "../server/model")).resolve()
+
+
+def iter_batches(images, batch_size):
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        yield preprocess_batch([path.read_bytes() for path, _ in chunk]), [label for _, label in chunk]
+
+
+def quantize_static(model, calibration_images, batch_size):
+    """
+    FX graph mode post-training static quantization of a conv backbone
+    """
+    example_inputs = (torch.zeros(1, 3, 256, 256),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(torch.backends.quantized.engine), example_inputs)
+    with torch.no_grad():
+        for batch, _ in iter_batches(calibration_images, batch_size):
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def build_int8_model(fp32_model, calibration_images, batch_size):
+    """
+    Quantize each backbone of the ensemble and trace the result
+    """
+    print("Quantizing EfficientNet (static, FX)...")
+    efficientnet = quantize_static(fp32_model.efficientnet, calibration_images, batch_size)
+    print("Quantizing ResNet (static, FX)...")
+    resnet = quantize_static(fp32_model.resnet, calibration_images, batch_size)
+    print("Quantizing Swin Linear layers (dynamic)...")
+    swin = quantize_dynamic(fp32_model.swin, {nn.Linear}, dtype=torch.qint8)
+
+    # Softmax folded in, like the other exported backends
+    int8_model = EnsembleProbabilities(EnsembleModel(efficientnet, swin, resnet)).eval()
+    with torch.no_grad():
+        return torch.jit.trace(int8_model, torch.zeros(1, 3, 256, 256))
+
+
+def compare(fp32_model, int8_model, eval_images, batch_size):
+    """
+    Agreement between the fp32 and int8 predictions, and accuracy of each
+    """
+    agree = fp32_correct = int8_correct = total = 0
+    classes = ["Normal", "Pneumonia"]
+    with torch.no_grad():
+        for batch, labels in iter_batches(eval_images, batch_size):
+            fp32_pred = fp32_model(batch).argmax(dim=1)
+            int8_pred = int8_model(batch).argmax(dim=1)
+            targets = torch.tensor([classes.index(label) for label in labels])
+            agree += int((fp32_pred == int8_pred).sum())
+            fp32_correct += int((fp32_pred == targets).sum())
+            int8_correct += int((int8_pred == targets).sum())
+            total += len(labels)
+    return {
+        "images": total,
+        "agreement": agree / total,
+        "fp32_accuracy": fp32_correct / total,
+        "int8_accuracy": int8_correct / total
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the INT8 unified ensemble model")
+    parser.add_argument("--model-dir", type=Path, default=DEFAULT_MODEL_DIR)
+    parser.add_argument("--calibration-size", type=int, default=32,
+                        help="Images per class used for calibration (held out from the agreement check)")
+    parser.add_argument("--threshold", type=float, default=0.98,
+                        help="Minimum fp32/int8 prediction agreement required to publish the model")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    torch.backends.quantized.engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "fbgemm"
+
+    images = list_test_images()
+    if not images:
+        print("Error: no test images found for calibration")
+        return 1
+    calibration_images = [image for label in ("Normal", "Pneumonia")
+                          for image in [i for i in images if i[1] == label][:args.calibration_size]]
+    eval_images = [image for image in images if image not in calibration_images]
+    print(f"Calibrating on {len(calibration_images)} images, checking agreement on {len(eval_images)}")
+
+    fp32_model = build_unified_model(args.model_dir)
+    int8_model = build_int8_model(build_unified_model(args.model_dir), calibration_images, args.batch_size)
+
+    report = compare(fp32_model, int8_model, eval_images, args.batch_size)
+    report["threshold"] = args.threshold
+    print(json.dumps(report, indent=2))
+
+    if report["agreement"] < args.threshold:
+        print(f"❌ Agreement {report['agreement']:.4f} is below {args.threshold}, INT8 model not published")
+        return 1
+
+    output_path = args.model_dir / "unified_ensemble_model_int8.pt"
+    tmp_path = output_path.with_suffix(".pt.tmp")
+    torch.jit.save(int8_model, str(tmp_path))
+    os.replace(tmp_path, output_path)
+    with open(output_path.with_suffix(".json"), "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ INT8 ensemble model saved to: {output_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+import asyncio
+import time
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+
+from .config import (
+    ADMISSION_MAX_PENDING, ADMISSION_MAX_PER_CLIENT, ADMISSION_RETRY_AFTER_SECONDS, REQUEST_TIMEOUT_MS
+)
+from .metrics import ADMISSION_PENDING, REQUESTS_SHED
+
+# Request headers identifying the client and shortening its deadline
+CLIENT_HEADER = "x-client-id"
+TIMEOUT_HEADER = "x-request-timeout-ms"
+
+
+class Overloaded(Exception):
+    """
+    A request refused because the server, or its client's share of it, is full
+    """
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ClientDisconnected(Exception):
+    """
+    The client went away before its prediction finished
+    """
+
+
+class AdmissionController:
+    """
+    Bounds how many prediction requests are in the server at once
+
+    Requests over max_pending (in total) or max_per_client (per client) are
+    refused straight away rather than queueing up behind work that is already
+    saturating the CPU. Each admitted request also gets a deadline, after
+    which it is no longer worth running through the model.
+    """
+    def __init__(self, max_pending=ADMISSION_MAX_PENDING, max_per_client=ADMISSION_MAX_PER_CLIENT,
+                 retry_after=ADMISSION_RETRY_AFTER_SECONDS, timeout_ms=REQUEST_TIMEOUT_MS):
+        self.max_pending = max_pending
+        self.max_per_client = max_per_client
+        self.retry_after = retry_after
+        self.timeout_ms = timeout_ms
+        self.pending = 0
+        self.clients = {}
+        self.stats = {"admitted": 0, "queue_full": 0, "client_limit": 0, "expired": 0, "disconnected": 0}
+
+    def acquire(self, client):
+        """
+        Admit a request from client or raise Overloaded
+
+        Only called from the event loop, so the counters need no lock.
+        """
+        if self.max_pending and self.pending >= self.max_pending:
+            self.record("queue_full")
+            raise Overloaded(f"Server is busy ({self.pending} requests pending)", self.retry_after)
+        if self.max_per_client and self.clients.get(client, 0) >= self.max_per_client:
+            self.record("client_limit")
+            raise Overloaded(f"Too many concurrent requests from this client (limit {self.max_per_client})",
+                             self.retry_after)
+        self.pending += 1
+        self.clients[client] = self.clients.get(client, 0) + 1
+        self.stats["admitted"] += 1
+        ADMISSION_PENDING.set(self.pending)
+
+    def release(self, client):
+        self.pending -= 1
+        remaining = self.clients.get(client, 1) - 1
+        if remaining:
+            self.clients[client] = remaining
+        else:
+            self.clients.pop(client, None)
+        ADMISSION_PENDING.set(self.pending)
+
+    def record(self, reason):
+        """
+        Count a request shed for reason (queue_full, client_limit, expired, disconnected)
+        """
+        self.stats[reason] += 1
+        REQUESTS_SHED.inc(reason=reason)
+
+    def deadline(self, headers):
+        """
+        time.monotonic() deadline for a request, or None if it has none
+
+        The timeout header can only shorten the configured default.
+        """
+        timeout_ms = self.timeout_ms
+        requested = headers.get(TIMEOUT_HEADER)
+        if requested and requested.isdigit() and int(requested) > 0:
+            timeout_ms = min(timeout_ms, int(requested)) if timeout_ms else int(requested)
+        if not timeout_ms:
+            return None
+        return time.monotonic() + timeout_ms / 1000.0
+
+    def status(self):
+        return {
+            "max_pending": self.max_pending,
+            "max_per_client": self.max_per_client,
+            "timeout_ms": self.timeout_ms,
+            "pending": self.pending,
+            "clients": len(self.clients),
+            "stats": self.stats
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying an AdmissionController to the given paths
+
+    Runs before the request body is read, so a refused upload costs nothing
+    but the 429 response. The request's deadline, and when it was admitted
+    (to time how long the body took to arrive and parse), are left in
+    request.state.
+    """
+    def __init__(self, app, controller, paths):
+        self.app = app
+        self.controller = controller
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        client = headers.get(CLIENT_HEADER) or (scope.get("client") or ("unknown",))[0]
+        try:
+            self.controller.acquire(client)
+        except Overloaded as e:
+            response = JSONResponse(status_code=429, content={"error": str(e)},
+                                    headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+            return
+
+        try:
+            state = scope.setdefault("state", {})
+            state["deadline"] = self.controller.deadline(headers)
+            state["admitted_at"] = time.perf_counter()
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(client)
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(receive, coro):
+    """
+    Await coro, cancelling it if the client disconnects first
+
+    Must only be used once the request body has been read, so the next
+    message receive() can deliver is the disconnect. Raises ClientDisconnected
+    when the client went away; a cancelled prediction still waiting in the
+    batch queue is dropped before the forward pass.
+    """
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        raise ClientDisconnected()
+    return task.result()
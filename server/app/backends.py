@@ -0,0 +1,97 @@
+import contextlib
+
+import torch
+
+# Inference backends all take a preprocessed (N, 3, H, W) float batch and
+# return (N, num_classes) class probabilities on the CPU. Exported artifacts
+# (TorchScript, ONNX) have the softmax folded into the graph; the eager
+# backend applies it after the forward pass.
+
+
+class EagerBackend:
+    """
+    Runs the PyTorch ensemble module directly
+
+    The run options are set by the load-time optimization pass (see
+    optimize.py): inference_mode instead of no_grad, channels_last inputs
+    and autocast to a lower precision dtype such as bfloat16.
+    """
+    name = "eager"
+
+    def __init__(self, model, device, inference_mode=False, channels_last=False, autocast_dtype=None):
+        self.model = model
+        self.device = device
+        self.inference_mode = inference_mode
+        self.channels_last = channels_last
+        self.autocast_dtype = autocast_dtype
+
+    def _context(self):
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode() if self.inference_mode else torch.no_grad())
+        if self.autocast_dtype is not None:
+            stack.enter_context(torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype))
+        return stack
+
+    def _prepare(self, batch):
+        batch = batch.to(self.device)
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def predict_proba(self, batch):
+        with self._context():
+            outputs = self.model(self._prepare(batch))
+            probabilities = torch.nn.functional.softmax(outputs.float(), dim=1)
+        return probabilities.cpu()
+
+    def predict_proba_cascade(self, batch, threshold):
+        """
+        Confidence-gated cascade, see EnsembleModel.forward_cascade
+
+        Returns the class probabilities and a mask of the inputs that needed
+        the full ensemble.
+        """
+        with self._context():
+            probabilities, escalated = self.model.forward_cascade(self._prepare(batch), threshold)
+        return probabilities.float().cpu(), escalated.cpu()
+
+
+class TorchScriptBackend:
+    """
+    Runs a traced TorchScript export of the ensemble
+    """
+    name = "torchscript"
+
+    def __init__(self, path, device):
+        self.device = device
+        self.model = torch.jit.load(str(path), map_location=device)
+        self.model.eval()
+
+    def predict_proba(self, batch):
+        with torch.no_grad():
+            return self.model(batch.to(self.device)).cpu()
+
+
+class OnnxRuntimeBackend:
+    """
+    Runs the ONNX export of the ensemble with ONNX Runtime on the CPU
+
+    onnxruntime is an optional dependency, only needed for this backend.
+    """
+    name = "onnx"
+
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("The onnx backend requires onnxruntime: pip install onnxruntime")
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_proba(self, batch):
+        outputs = self.session.run(None, {self.input_name: batch.contiguous().numpy()})[0]
+        return torch.from_numpy(outputs)
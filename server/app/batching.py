@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+import torch
+
+
+class DeadlineExceeded(Exception):
+    """
+    A request's deadline passed before it reached the model
+    """
+
+
+class BatchScheduler:
+    """
+    Collects concurrent prediction requests into a queue and runs them through
+    the model as a single stacked batch.
+
+    A batch is dispatched as soon as it holds max_batch_size images, or when
+    the first image in it has waited max_wait_ms, whichever comes first.
+    Every caller gets back its own row of the batch output together with the
+    size of the batch it ran in.
+
+    The forward pass itself runs in the given executor so the event loop
+    keeps accepting requests; up to max_concurrent_batches batches may be in
+    flight at once, and new requests queue up (and form larger batches) while
+    all of them are busy.
+
+    Requests whose caller has gone away, or whose deadline has passed, are
+    dropped when the batch is formed instead of being run through the model.
+
+    Requests may ask for an explanation; batches containing any are run as
+    run_batch(batch, explain=[flag per image]), all others as run_batch(batch).
+    """
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=5.0,
+                 executor=None, max_concurrent_batches=1):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.executor = executor
+        self.max_concurrent_batches = max_concurrent_batches
+        self.stats = {"requests": 0, "batches": 0, "largest_batch": 0, "expired": 0}
+        self._queue = None
+        self._worker = None
+        self._slots = None
+        self._in_flight = set()
+
+    def _ensure_started(self):
+        # The queue and worker task are bound to the running event loop, so
+        # they are created lazily on the first request rather than at import
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_concurrent_batches)
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    def queue_depth(self):
+        """
+        Number of requests waiting to be formed into a batch
+        """
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, image_tensor, deadline=None, explain=False):
+        """
+        Queue a single preprocessed image tensor (C, H, W) and wait for its result
+
+        deadline is an optional time.monotonic() value; if it passes while the
+        request is still queued, DeadlineExceeded is raised instead.
+        Returns a tuple of (output row, batch size)
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image_tensor, future, deadline, explain))
+        return await future
+
+    async def _collect(self):
+        # Block until there is at least one request, then keep pulling until
+        # the batch is full or the wait window of the first request expires
+        loop = asyncio.get_running_loop()
+        items = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(items) < self.max_batch_size:
+            if not self._queue.empty():
+                items.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Callers that went away, or ran out of time, while waiting do not
+        # need a forward pass
+        now = time.monotonic()
+        ready = []
+        for item in items:
+            _, future, deadline, _ = item
+            if future.done():
+                continue
+            if deadline is not None and now > deadline:
+                self.stats["expired"] += 1
+                future.set_exception(DeadlineExceeded("Request deadline passed before inference"))
+                continue
+            ready.append(item)
+        return ready
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Wait for a free worker before forming the next batch, so requests
+            # arriving in the meantime can still join it
+            await self._slots.acquire()
+            try:
+                items = await self._collect()
+            except BaseException:
+                self._slots.release()
+                raise
+            if not items:
+                self._slots.release()
+                continue
+            # Keep a reference so the task isn't garbage collected mid-flight
+            task = loop.create_task(self._dispatch(items))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _dispatch(self, items):
+        try:
+            await self._execute(items)
+        finally:
+            self._slots.release()
+
+    async def _execute(self, items):
+        batch_size = len(items)
+        self.stats["requests"] += batch_size
+        self.stats["batches"] += 1
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], batch_size)
+
+        try:
+            tensors = [tensor for tensor, _, _, _ in items]
+            explain = [flag for _, _, _, flag in items]
+            loop = asyncio.get_running_loop()
+            outputs = await loop.run_in_executor(self.executor, self._stack_and_run, tensors, explain)
+        except Exception as e:
+            for _, future, _, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for i, (_, future, _, _) in enumerate(items):
+            if not future.done():
+                future.set_result((outputs[i], batch_size))
+
+    def _stack_and_run(self, tensors, explain):
+        if any(explain):
+            return self.run_batch(torch.stack(tensors), explain=explain)
+        return self.run_batch(torch.stack(tensors))
@@ -0,0 +1,238 @@
+import asyncio
+import io
+import json
+import tarfile
+import zipfile
+from pathlib import PurePosixPath
+
+import torch
+
+from .config import BULK_CHUNK_SIZE, BULK_MAX_EXTRACTED_BYTES, MAX_UPLOAD_BYTES
+from .executor import inference_pool, decode_pool, run_in_pool
+from .ingest import UploadRejected, validate_upload
+
+# File types picked out of uploaded archives; everything else is skipped
+IMAGE_EXTENSIONS = {".jpeg", ".jpg", ".png", ".bmp", ".tif", ".tiff"}
+
+
+class ExtractionBudget:
+    """
+    Bytes that may still be extracted from the archives of one request
+    """
+    def __init__(self, max_bytes=BULK_MAX_EXTRACTED_BYTES):
+        self.remaining = max_bytes or None
+
+    @property
+    def exhausted(self):
+        return self.remaining is not None and self.remaining <= 0
+
+    def read(self, member, declared_size, max_bytes=MAX_UPLOAD_BYTES):
+        """
+        Read an archive member, refusing it before reading if its header
+        declares more than max_bytes and never reading more than that (or the
+        remaining budget) even if the header lies
+        """
+        if max_bytes and declared_size > max_bytes:
+            raise UploadRejected(413, f"Archive member is {declared_size} bytes, the limit is {max_bytes}")
+        limits = [limit for limit in (max_bytes, self.remaining) if limit]
+        contents = member.read(min(limits) + 1) if limits else member.read()
+        if self.remaining is not None:
+            self.remaining -= len(contents)
+        if max_bytes and len(contents) > max_bytes:
+            raise UploadRejected(413, f"Archive member is larger than {max_bytes} bytes")
+        if self.remaining is not None and self.remaining < 0:
+            raise UploadRejected(413, f"Archives extract to more than {BULK_MAX_EXTRACTED_BYTES} bytes")
+        return contents
+
+
+def _validated(contents):
+    # Same size, format and dimension checks as a single /predict upload
+    validate_upload(io.BytesIO(contents))
+    return contents
+
+
+def _is_image_name(name):
+    path = PurePosixPath(name)
+    # Skip hidden files and macOS resource forks (__MACOSX/._foo.jpeg)
+    if any(part.startswith(".") or part == "__MACOSX" for part in path.parts):
+        return False
+    return path.suffix.lower() in IMAGE_EXTENSIONS
+
+
+def _iter_zip(fileobj, archive_name, budget):
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if budget.exhausted:
+                return
+            if info.is_dir() or not _is_image_name(info.filename):
+                continue
+
+            def read(info=info):
+                with archive.open(info) as member:
+                    return _validated(budget.read(member, info.file_size))
+            yield {"filename": info.filename, "archive": archive_name}, read
+
+
+def _raise(error):
+    raise error
+
+
+def _iter_tar(fileobj, archive_name, budget):
+    # Stream mode reads the archive front to back without seeking or indexing it
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            if budget.exhausted:
+                return
+            if not member.isfile() or not _is_image_name(member.name):
+                continue
+            meta = {"filename": member.name, "archive": archive_name}
+            # Members must be read before the stream moves past them
+            try:
+                contents = _validated(budget.read(archive.extractfile(member), member.size))
+            except UploadRejected as e:
+                yield meta, lambda e=e: _raise(e)
+                continue
+            yield meta, lambda contents=contents: contents
+
+
+def _read_upload(fileobj):
+    validate_upload(fileobj)
+    return fileobj.read()
+
+
+def iter_upload_images(files):
+    """
+    Yield (metadata, read) pairs for every image in the uploaded files
+
+    Plain image uploads yield a single entry; zip and tar (optionally
+    compressed) uploads yield one entry per image member. Contents are only
+    read when read() is called, so the whole upload is never held in memory.
+
+    Every image goes through the same checks as a /predict upload. Archive
+    members are limited to MAX_UPLOAD_BYTES each and BULK_MAX_EXTRACTED_BYTES
+    in total; once the total is reached the remaining members are skipped.
+    """
+    budget = ExtractionBudget()
+    for upload in files:
+        fileobj = upload.file
+        fileobj.seek(0)
+
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            yield from _iter_zip(fileobj, upload.filename, budget)
+            continue
+
+        fileobj.seek(0)
+        try:
+            is_tar = tarfile.is_tarfile(fileobj)
+        except Exception:
+            is_tar = False
+        fileobj.seek(0)
+        if is_tar:
+            yield from _iter_tar(fileobj, upload.filename, budget)
+            continue
+
+        yield {"filename": upload.filename}, lambda fileobj=fileobj: _read_upload(fileobj)
+
+
+def _next_chunk(entries, chunk_size):
+    # Runs in the decode pool since reading from spooled uploads and
+    # decompressing archive members is blocking I/O
+    chunk = []
+    for meta, read in entries:
+        try:
+            chunk.append((meta, read(), None))
+        except UploadRejected as e:
+            chunk.append((meta, None, e.detail))
+        except Exception as e:
+            chunk.append((meta, None, str(e)))
+        if len(chunk) >= chunk_size:
+            break
+    return chunk
+
+
+def _preprocess_or_error(preprocess, contents):
+    try:
+        return preprocess(contents), None
+    except Exception as e:
+        return None, str(e)
+
+
+async def _decode_chunk(entries, chunk_size, preprocess):
+    chunk = await run_in_pool(decode_pool, _next_chunk, entries, chunk_size)
+    decoded = await asyncio.gather(*[
+        run_in_pool(decode_pool, _preprocess_or_error, preprocess, contents)
+        for _, contents, error in chunk if error is None
+    ])
+
+    # Contents are dropped here; only the preprocessed tensors are kept
+    decoded = iter(decoded)
+    items = []
+    for meta, _, error in chunk:
+        tensor = None
+        if error is None:
+            tensor, error = next(decoded)
+        items.append((meta, tensor, error))
+    return items
+
+
+async def stream_predictions(files, preprocess, run_batch, format_prediction, chunk_size=BULK_CHUNK_SIZE,
+                             explain=None):
+    """
+    Decode, batch and predict every image in the uploads, yielding one NDJSON
+    line per image as each chunk finishes
+
+    At most two chunks are held in memory at a time: the one running through
+    the ensemble and the next one being decoded.
+
+    With explain, a function (heatmap, probabilities, models consulted) ->
+    payload, every chunk runs with saliency capture and each result gets an
+    "explanation" built from its heatmap.
+    """
+    entries = iter_upload_images(files)
+    next_chunk = asyncio.ensure_future(_decode_chunk(entries, chunk_size, preprocess))
+
+    try:
+        while True:
+            items = await next_chunk
+            if not items:
+                break
+            # Start decoding the following chunk while this one is inferred
+            next_chunk = asyncio.ensure_future(_decode_chunk(entries, chunk_size, preprocess))
+
+            tensors = [tensor for _, tensor, error in items if error is None]
+            outputs = []
+            if tensors:
+                try:
+                    if explain is None:
+                        outputs = await run_in_pool(inference_pool, run_batch, torch.stack(tensors))
+                    else:
+                        outputs = await run_in_pool(inference_pool, run_batch, torch.stack(tensors),
+                                                    None, [True] * len(tensors))
+                        explanations = await asyncio.gather(*[
+                            run_in_pool(decode_pool, explain, output[3], output[0], output[1])
+                            for output in outputs
+                        ])
+                        outputs = [output[:3] + (payload,) for output, payload in zip(outputs, explanations)]
+                except Exception as e:
+                    items = [(meta, None, str(e)) if error is None else (meta, tensor, error)
+                             for meta, tensor, error in items]
+
+            row = 0
+            lines = []
+            for meta, tensor, error in items:
+                if error is not None:
+                    result = {**meta, "error": error}
+                else:
+                    probabilities, models_consulted, version = outputs[row][:3]
+                    result = format_prediction(meta["filename"], probabilities, models_consulted, version)
+                    result.update(meta)
+                    if explain is not None:
+                        result["explanation"] = outputs[row][3]
+                    result["batch_size"] = len(tensors)
+                    row += 1
+                lines.append(json.dumps(result) + "\n")
+            yield "".join(lines)
+    finally:
+        if not next_chunk.done():
+            next_chunk.cancel()
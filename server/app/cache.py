@@ -0,0 +1,226 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+# Writes to the SQLite tier between two prunes of its oldest rows
+DB_PRUNE_INTERVAL = 256
+
+
+def content_hash(contents):
+    """
+    Hash of the uploaded bytes used as the cache key
+    """
+    return hashlib.sha256(contents).hexdigest()
+
+
+def file_hash(fileobj, chunk_size=1 << 20):
+    """
+    content_hash of a file object, read in chunks and rewound afterwards
+    """
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def weights_checksum(paths, chunk_size=1 << 20):
+    """
+    Checksum of the weight files a model was loaded from
+
+    Used as the model version, so cached predictions are invalidated as soon
+    as different weights are loaded.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(chunk_size), b""):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Two-tier cache of prediction results
+
+    The first tier is a bounded in-memory LRU with a TTL. The optional second
+    tier is a SQLite database that survives restarts; entries found there are
+    promoted back into memory. Entries are keyed by (content hash, model
+    version), and rows written by any other model version are dropped as
+    soon as a new one is set. The SQLite tier is capped at db_max_entries
+    rows; expired rows and then the oldest ones are pruned every
+    DB_PRUNE_INTERVAL writes. The cache stays disabled until the model
+    version is known.
+    """
+    def __init__(self, model_version=None, max_entries=1024, ttl_seconds=0, db_path=None, db_max_entries=0):
+        self.model_version = None
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.db_max_entries = db_max_entries
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0, "expired": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_writes = 0
+
+        if model_version is not None:
+            self.set_model_version(model_version)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.model_version is not None
+
+    def set_model_version(self, model_version):
+        """
+        Switch the cache to a newly loaded model, invalidating entries of any other version
+        """
+        with self._lock:
+            self.model_version = model_version
+            self._entries.clear()
+
+            if self.db_path and self.max_entries > 0 and self._db is None:
+                Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(str(self.db_path), check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS predictions ("
+                    "content_hash TEXT NOT NULL, model_version TEXT NOT NULL, "
+                    "result TEXT NOT NULL, created_at REAL NOT NULL, "
+                    "PRIMARY KEY (content_hash, model_version))"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS predictions_created_at ON predictions (created_at)")
+
+            if self._db is not None:
+                # Weights changed since these rows were written
+                self._db.execute("DELETE FROM predictions WHERE model_version != ?", (model_version,))
+                self._prune_db()
+                self._db.commit()
+
+    def _expired(self, created_at):
+        return self.ttl_seconds > 0 and time.time() - created_at > self.ttl_seconds
+
+    def get(self, key):
+        """
+        Return the cached result for a content hash, or None on a miss
+        """
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, result = entry
+                if not self._expired(created_at):
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return result
+                del self._entries[key]
+                self.stats["expired"] += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT result, created_at FROM predictions WHERE content_hash = ? AND model_version = ?",
+                    (key, self.model_version)
+                ).fetchone()
+                if row is not None:
+                    result, created_at = json.loads(row[0]), row[1]
+                    if not self._expired(created_at):
+                        self._store(key, created_at, result)
+                        self.stats["disk_hits"] += 1
+                        return result
+                    self._delete_row(key)
+                    self.stats["expired"] += 1
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, result, model_version=None):
+        """
+        Store the result for a content hash in both tiers
+
+        If model_version is given and no longer current, the result is stale
+        and not stored.
+        """
+        if not self.enabled or (model_version is not None and model_version != self.model_version):
+            return
+
+        created_at = time.time()
+        with self._lock:
+            self._store(key, created_at, result)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                    (key, self.model_version, json.dumps(result), created_at)
+                )
+                self._db_writes += 1
+                if self._db_writes >= DB_PRUNE_INTERVAL:
+                    self._prune_db()
+                self._db.commit()
+
+    def purge(self, key=None):
+        """
+        Remove a single entry, or every entry when no key is given
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                if self._db is not None:
+                    self._db.execute("DELETE FROM predictions")
+                    self._db.commit()
+            else:
+                self._entries.pop(key, None)
+                self._delete_row(key)
+
+    def status(self):
+        """
+        Report the cache settings, size and hit/miss/eviction counters
+        """
+        with self._lock:
+            disk_entries = None
+            if self._db is not None:
+                disk_entries = self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+            return {
+                "enabled": self.enabled,
+                "model_version": self.model_version,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "db_max_entries": self.db_max_entries,
+                "entries": len(self._entries),
+                "disk_entries": disk_entries,
+                "stats": dict(self.stats)
+            }
+
+    def _store(self, key, created_at, result):
+        self._entries[key] = (created_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _prune_db(self):
+        # Drop expired rows, then the oldest ones beyond db_max_entries
+        self._db_writes = 0
+        if self.ttl_seconds > 0:
+            self._db.execute("DELETE FROM predictions WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+        if self.db_max_entries > 0:
+            excess = self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] - self.db_max_entries
+            if excess > 0:
+                self._db.execute(
+                    "DELETE FROM predictions WHERE rowid IN "
+                    "(SELECT rowid FROM predictions ORDER BY created_at LIMIT ?)",
+                    (excess,)
+                )
+                self.stats["disk_evictions"] += excess
+
+    def _delete_row(self, key):
+        if self._db is not None:
+            self._db.execute(
+                "DELETE FROM predictions WHERE content_hash = ? AND model_version = ?",
+                (key, self.model_version)
+            )
+            self._db.commit()
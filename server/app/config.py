@@ -0,0 +1,171 @@
+import os
+
+# Server settings are read from environment variables so they can be tuned
+# per deployment (see the Dockerfile) without code changes.
+
+
+def env_int(name, default):
+    """
+    Read an integer setting from the environment
+    """
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def env_float(name, default):
+    """
+    Read a float setting from the environment
+    """
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+# Dynamic micro-batching for /predict
+# Maximum number of images stacked into a single ensemble forward pass
+BATCH_MAX_SIZE = max(1, env_int("BATCH_MAX_SIZE", 8))
+# How long the first request of a batch waits for others to join (milliseconds)
+BATCH_MAX_WAIT_MS = max(0.0, env_float("BATCH_MAX_WAIT_MS", 5.0))
+
+# Worker pools that keep decoding and inference off the asyncio event loop
+# Number of ensemble forward passes that may run at the same time (0 = the
+# tuned value for this host, see app/topology.py, or 1)
+INFERENCE_WORKERS = max(0, env_int("INFERENCE_WORKERS", 0))
+# Torch intra-op threads used by each inference worker (0 = tuned, or split the cores evenly)
+TORCH_NUM_THREADS = max(0, env_int("TORCH_NUM_THREADS", 0))
+# Torch inter-op threads per process (0 = 1; the ensemble doesn't use inter-op parallelism)
+TORCH_INTEROP_THREADS = max(0, env_int("TORCH_INTEROP_THREADS", 0))
+
+# CPU topology
+# Number of server processes on the host (uvicorn --workers), each of which
+# gets its own share of the available cores
+SERVER_WORKERS = max(1, env_int("SERVER_WORKERS", 1))
+# Pin each server process to its share of the cores
+PIN_WORKERS = env_int("PIN_WORKERS", 1) == 1
+# Tuned thread configurations, one per host (python -m app.topology --autotune)
+TOPOLOGY_CACHE_PATH = os.environ.get(
+    "TOPOLOGY_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "topology.json")
+)
+# Number of threads decoding and preprocessing uploaded images
+DECODE_WORKERS = max(1, env_int("DECODE_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Bulk prediction (/predict/batch)
+# Number of images decoded and run through the ensemble per streamed chunk
+BULK_CHUNK_SIZE = max(1, env_int("BULK_CHUNK_SIZE", 16))
+
+# Admission control for /predict
+# Requests admitted at once; further requests get 429 (0 = unlimited)
+ADMISSION_MAX_PENDING = max(0, env_int("ADMISSION_MAX_PENDING", 64))
+# Requests admitted at once per client (X-Client-Id header or address, 0 = unlimited)
+ADMISSION_MAX_PER_CLIENT = max(0, env_int("ADMISSION_MAX_PER_CLIENT", 0))
+# Retry-After sent with 429 responses, in seconds
+ADMISSION_RETRY_AFTER_SECONDS = max(1, env_int("ADMISSION_RETRY_AFTER_SECONDS", 1))
+# Default request deadline in milliseconds; clients may send a shorter one in
+# the X-Request-Timeout-Ms header (0 = no default deadline)
+REQUEST_TIMEOUT_MS = max(0, env_int("REQUEST_TIMEOUT_MS", 0))
+
+# Upload limits
+# Largest image accepted by /predict in bytes, enforced while the body streams
+# in (0 = unlimited)
+MAX_UPLOAD_BYTES = max(0, env_int("MAX_UPLOAD_BYTES", 32 * 1024 * 1024))
+# Largest request body accepted by /predict/batch in bytes (0 = unlimited)
+BULK_MAX_UPLOAD_BYTES = max(0, env_int("BULK_MAX_UPLOAD_BYTES", 1024 * 1024 * 1024))
+# Most bytes extracted from the archives of one /predict/batch request, so a
+# decompression bomb can't keep the server busy (0 = unlimited). Each member
+# is also limited to MAX_UPLOAD_BYTES.
+BULK_MAX_EXTRACTED_BYTES = max(0, env_int("BULK_MAX_EXTRACTED_BYTES", 4 * 1024 * 1024 * 1024))
+# Largest image in pixels, checked from the image header before decoding
+# (0 = unlimited)
+MAX_IMAGE_PIXELS = max(0, env_int("MAX_IMAGE_PIXELS", 8192 * 8192))
+# Largest request body accepted by /predict/raw in bytes (0 = only the 4 GB
+# ceiling in app/rawinput.py)
+RAW_MAX_UPLOAD_BYTES = max(0, env_int("RAW_MAX_UPLOAD_BYTES", 256 * 1024 * 1024))
+# Most images accepted in one /predict/raw request
+RAW_MAX_BATCH = max(1, env_int("RAW_MAX_BATCH", 64))
+
+# Prediction cache, keyed by the uploaded bytes and the loaded model version
+# Maximum number of predictions kept in memory (0 disables the cache)
+CACHE_MAX_ENTRIES = max(0, env_int("CACHE_MAX_ENTRIES", 1024))
+# How long a cached prediction stays valid in seconds (0 = never expires)
+CACHE_TTL_SECONDS = max(0.0, env_float("CACHE_TTL_SECONDS", 24 * 3600))
+# Optional SQLite file for a persistent cache tier that survives restarts
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "")
+# Maximum number of rows kept in the SQLite tier, oldest pruned first (0 = no limit)
+CACHE_DB_MAX_ENTRIES = max(0, env_int("CACHE_DB_MAX_ENTRIES", 100000))
+
+# Near-duplicate reuse: predictions are also indexed by a perceptual hash of
+# the decoded image, so re-encoded or rescaled copies of a radiograph reuse
+# them. Off by default, since distinct chest X-rays can look alike at this scale.
+DEDUP_ENABLED = env_int("DEDUP_ENABLED", 0) == 1
+# Largest Hamming distance (out of 64 bits, at most 11) still treated as the same image
+DEDUP_MAX_DISTANCE = min(11, max(0, env_int("DEDUP_MAX_DISTANCE", 4)))
+# Number of hashes kept in memory, oldest evicted first
+DEDUP_MAX_ENTRIES = max(0, env_int("DEDUP_MAX_ENTRIES", 1000000))
+# Hash to use: "phash" (DCT based, more robust) or "dhash" (gradient based, faster)
+DEDUP_HASH = os.environ.get("DEDUP_HASH", "phash").lower()
+
+# Image preprocessing
+# Let the JPEG decoder downscale large radiographs while decoding (draft mode)
+PREPROCESS_JPEG_DRAFT = env_int("PREPROCESS_JPEG_DRAFT", 1) == 1
+
+# Model startup
+# Batch sizes warmed up before the server reports ready, as a comma separated
+# list (defaults to every size from 1 to BATCH_MAX_SIZE)
+WARMUP_BATCH_SIZES = [int(size) for size in os.environ.get("WARMUP_BATCH_SIZES", "").split(",") if size.strip()]
+# Load unified_ensemble_model.safetensors through a shared memory map when present
+WEIGHTS_MMAP = env_int("WEIGHTS_MMAP", 1) == 1
+# Weights to serve: "fp32" or "int8" (built by scripts/quantize_ensemble_model.py)
+MODEL_PRECISION = os.environ.get("MODEL_PRECISION", "fp32").lower()
+# How the ensemble is executed: "eager", "torchscript" or "onnx" (exported by
+# scripts/create_ensemble_model.py --export)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager").lower()
+
+# Load-time optimization of the eager ensemble (see app/optimize.py), as a
+# comma separated list of fold_bn, channels_last, inference_mode and bf16
+# (off by default). Each transform is checked against the
+# unoptimized model on OPTIMIZE_CHECK_IMAGES test images per class and kept
+# only if no class probability moves by more than OPTIMIZE_TOLERANCE.
+OPTIMIZE_TRANSFORMS = [name.strip() for name in os.environ.get("OPTIMIZE_TRANSFORMS", "").split(",")
+                       if name.strip()]
+OPTIMIZE_TOLERANCE = env_float("OPTIMIZE_TOLERANCE", 0.01)
+OPTIMIZE_CHECK_IMAGES = max(1, env_int("OPTIMIZE_CHECK_IMAGES", 4))
+
+# Model registry: versions that can be hot-swapped in through /admin/model,
+# one directory per version laid out like server/model (defaults to
+# server/model/versions)
+MODEL_VERSIONS_DIR = os.environ.get("MODEL_VERSIONS_DIR", "")
+# Token required in the X-Admin-Token header by the /admin endpoints (unset
+# leaves them open, e.g. behind a private network)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Confidence-gated cascade: run efficientnet_b0 first and only consult the
+# swin and resnet backbones when its softmax margin is below the threshold
+# (calibrate with scripts/calibrate_cascade.py). Only applies to the eager backend.
+CASCADE_MODE = env_int("CASCADE_MODE", 0) == 1
+CASCADE_THRESHOLD = env_float("CASCADE_THRESHOLD", 0.9)
+
+# Run the three backbones concurrently instead of one after another
+PARALLEL_BACKBONES = env_int("PARALLEL_BACKBONES", 0) == 1
+# Torch intra-op threads for the efficientnet, swin and resnet threads, as a
+# comma separated list (defaults to an even split of TORCH_NUM_THREADS)
+BACKBONE_THREADS = [int(count) for count in os.environ.get("BACKBONE_THREADS", "").split(",") if count.strip()]
+
+# Evaluation jobs (/eval)
+# Where finished evaluation results are stored, one file per model version
+EVAL_RESULTS_DIR = os.environ.get(
+    "EVAL_RESULTS_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "eval_results")
+)
+# Images per forward pass during an evaluation
+EVAL_BATCH_SIZE = max(1, env_int("EVAL_BATCH_SIZE", 32))
+
+# Metrics (/metrics)
+# Record latency histograms; counters and gauges are always kept
+METRICS_HISTOGRAMS = env_int("METRICS_HISTOGRAMS", 1) == 1
+
+# Preprocessed test-set tensor store (scripts/build_tensor_store.py), used by
+# evaluation jobs to skip decoding when present
+TENSOR_STORE_DIR = os.environ.get(
+    "TENSOR_STORE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tensor_store")
+)
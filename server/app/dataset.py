@@ -0,0 +1,35 @@
+import os
+from pathlib import Path
+
+# Labels of the bundled test set, taken from the directory each image is in
+LABEL_DIRS = {"NORMAL": "Normal", "PNEUMONIA": "Pneumonia"}
+IMAGE_EXTENSIONS = {".jpeg", ".jpg", ".png"}
+
+
+def find_test_images_dir():
+    """
+    Get the directory holding the bundled NORMAL/PNEUMONIA test images
+    """
+    test_images_dir = Path("../test_images/test").resolve()
+    if not test_images_dir.exists():
+        test_images_dir = Path("../../server/test_images/test").resolve()
+    if not test_images_dir.exists():
+        test_images_dir = Path(os.path.join(os.path.dirname(__file__), "../test_images/test")).resolve()
+    return test_images_dir
+
+
+def list_test_images(test_images_dir=None, category=None, limit=None):
+    """
+    List (path, label) pairs of labelled test images, sorted by path
+
+    category restricts the list to "NORMAL" or "PNEUMONIA"; limit caps the
+    number of images taken from each category.
+    """
+    test_images_dir = Path(test_images_dir) if test_images_dir else find_test_images_dir()
+    images = []
+    for dir_name, label in LABEL_DIRS.items():
+        if category and category.upper() != dir_name:
+            continue
+        paths = sorted(p for p in (test_images_dir / dir_name).glob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+        images.extend((path, label) for path in paths[:limit])
+    return images
@@ -0,0 +1,190 @@
+import threading
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+
+# Orthonormal DCT-II basis for the 32x32 pHash transform
+_DCT_SIZE = 32
+_DCT = np.cos(np.pi / _DCT_SIZE * (np.arange(_DCT_SIZE)[:, None]) * (np.arange(_DCT_SIZE)[None, :] + 0.5))
+_DCT[0] /= np.sqrt(2)
+_DCT *= np.sqrt(2 / _DCT_SIZE)
+
+
+def _grayscale(pixels):
+    # Decoded images are (H, W) grayscale or (H, W, 3) RGB uint8 arrays
+    if pixels.ndim == 3:
+        pixels = pixels.mean(axis=2).astype(np.uint8)
+    return Image.fromarray(pixels)
+
+
+def _pack(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def dhash(pixels):
+    """
+    64-bit difference hash: whether each pixel of a 9x8 thumbnail is brighter
+    than its right neighbour
+    """
+    thumbnail = np.asarray(_grayscale(pixels).resize((9, 8), Image.BOX), dtype=np.int16)
+    return _pack(thumbnail[:, 1:] > thumbnail[:, :-1])
+
+
+def phash(pixels):
+    """
+    64-bit perceptual hash: signs of the lowest 8x8 DCT frequencies of a
+    32x32 thumbnail relative to their median, which survive re-encoding and
+    rescaling
+    """
+    thumbnail = np.asarray(_grayscale(pixels).resize((_DCT_SIZE, _DCT_SIZE), Image.BOX), dtype=np.float64)
+    low = (_DCT @ thumbnail @ _DCT.T)[:8, :8].ravel()
+    # The DC term only encodes overall brightness
+    return _pack(low > np.median(low[1:]))
+
+
+HASH_FUNCTIONS = {"phash": phash, "dhash": dhash}
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _neighbours(value, bits, radius):
+    # Every value within Hamming distance radius of a bits-wide chunk
+    yield value
+    if radius >= 1:
+        for i in range(bits):
+            flipped = value ^ (1 << i)
+            yield flipped
+            if radius >= 2:
+                for j in range(i + 1, bits):
+                    yield flipped ^ (1 << j)
+
+
+class NearDuplicateIndex:
+    """
+    Predictions keyed by a 64-bit perceptual hash, looked up by Hamming distance
+
+    Uses multi-index hashing: each hash is split into `chunks` 16-bit parts
+    with one table per part. Two hashes within max_distance agree on at
+    least one part to within max_distance // chunks bits (pigeonhole), so a
+    lookup only probes the few buckets around each part of the query and
+    checks the full distance on those candidates. With a million entries a
+    bucket holds about 15 of them, so a lookup that isn't an exact match
+    checks about a thousand candidates: measured at about 1.5 ms median and
+    under 4 ms p99 in CPython on uniformly random hashes (scripts/benchmark.py
+    --dedup-entries 1000000). Exact matches are a single dict lookup.
+    Real radiographs hash less uniformly, so their buckets and lookups can
+    be larger.
+
+    Holds up to max_entries hashes and evicts the oldest first. Stored
+    values are compact (probabilities and the models consulted), so a
+    million entries fit in a few hundred MB.
+    """
+    def __init__(self, max_distance=4, max_entries=1_000_000, chunks=4):
+        if max_distance // chunks > 2:
+            raise ValueError(f"max_distance must be below {3 * chunks} for {chunks} chunks")
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.chunks = chunks
+        self.chunk_bits = HASH_BITS // chunks
+        self.model_version = None
+        self.stats = {"lookups": 0, "hits": 0, "exact_hits": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._tables = [{} for _ in range(self.chunks)]
+        self._entries = {}
+        self._order = deque()
+
+    def _parts(self, value):
+        mask = (1 << self.chunk_bits) - 1
+        return [(value >> (i * self.chunk_bits)) & mask for i in range(self.chunks)]
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.model_version is not None
+
+    def set_model_version(self, model_version):
+        """
+        Drop every entry; predictions of other weights can't be reused
+        """
+        with self._lock:
+            self.model_version = model_version
+            self._reset()
+
+    def lookup(self, value):
+        """
+        Closest stored (entry, distance) within max_distance of value, or None
+        """
+        if not self.enabled:
+            return None
+        radius = self.max_distance // self.chunks
+        with self._lock:
+            self.stats["lookups"] += 1
+            exact = self._entries.get(value)
+            if exact is not None:
+                self.stats["hits"] += 1
+                self.stats["exact_hits"] += 1
+                return exact, 0
+
+            best, best_distance = None, self.max_distance + 1
+            seen = set()
+            for table, part in zip(self._tables, self._parts(value)):
+                for probe in _neighbours(part, self.chunk_bits, radius):
+                    for candidate in table.get(probe, ()):
+                        if candidate in seen:
+                            continue
+                        seen.add(candidate)
+                        distance = hamming(candidate, value)
+                        if distance < best_distance:
+                            best, best_distance = candidate, distance
+            if best is None:
+                return None
+            self.stats["hits"] += 1
+            return self._entries[best], best_distance
+
+    def add(self, value, entry, model_version=None):
+        """
+        Store entry under a hash, unless it was produced by another model version
+        """
+        if not self.enabled or (model_version is not None and model_version != self.model_version):
+            return
+        with self._lock:
+            if value not in self._entries:
+                for table, part in zip(self._tables, self._parts(value)):
+                    table.setdefault(part, []).append(value)
+                self._order.append(value)
+            self._entries[value] = entry
+            while len(self._entries) > self.max_entries:
+                self._evict(self._order.popleft())
+
+    def _evict(self, value):
+        del self._entries[value]
+        for table, part in zip(self._tables, self._parts(value)):
+            bucket = table[part]
+            bucket.remove(value)
+            if not bucket:
+                del table[part]
+        self.stats["evictions"] += 1
+
+    def purge(self):
+        with self._lock:
+            self._reset()
+
+    def status(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "max_distance": self.max_distance,
+                "max_entries": self.max_entries,
+                "entries": len(self._entries),
+                "stats": dict(self.stats)
+            }
@@ -0,0 +1,278 @@
+import json
+import os
+import threading
+import time
+import uuid
+from functools import lru_cache
+from pathlib import Path
+
+import torch
+
+from . import model as xray_model
+from .config import EVAL_RESULTS_DIR, EVAL_BATCH_SIZE
+from .dataset import list_test_images, find_test_images_dir
+from .executor import inference_pool, decode_pool
+from .tensor_store import open_tensor_store
+
+POSITIVE_CLASS = "Pneumonia"
+# Finished jobs kept in memory for GET /eval/{id}; the oldest are dropped first
+MAX_FINISHED_JOBS = 64
+
+
+@lru_cache(maxsize=16)
+def _test_images(category, limit):
+    # The bundled test set doesn't change while the server runs, so it is
+    # only globbed once per (category, limit)
+    return tuple(list_test_images(category=category, limit=limit))
+
+
+def roc_auc(scores, positives):
+    """
+    Area under the ROC curve from positive-class scores, computed as the
+    probability that a random positive scores above a random negative
+    (ties count half)
+    """
+    n_pos = sum(positives)
+    n_neg = len(positives) - n_pos
+    if n_pos == 0 or n_neg == 0:
+        return None
+
+    # Rank-sum (Mann-Whitney U) with average ranks for tied scores
+    order = sorted(range(len(scores)), key=lambda i: scores[i])
+    ranks = [0.0] * len(scores)
+    i = 0
+    while i < len(order):
+        j = i
+        while j + 1 < len(order) and scores[order[j + 1]] == scores[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2 + 1
+        i = j + 1
+    rank_sum = sum(rank for rank, positive in zip(ranks, positives) if positive)
+    return (rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def compute_metrics(results, classes):
+    """
+    Confusion matrix, per-class precision/recall/F1, accuracy and ROC-AUC
+    """
+    scored = [r for r in results if "error" not in r]
+    index = {label: i for i, label in enumerate(classes)}
+    confusion = [[0] * len(classes) for _ in classes]
+    for r in scored:
+        confusion[index[r["true_label"]]][index[r["prediction"]]] += 1
+
+    per_class = {}
+    for label, i in index.items():
+        true_positive = confusion[i][i]
+        predicted = sum(row[i] for row in confusion)
+        actual = sum(confusion[i])
+        precision = true_positive / predicted if predicted else 0.0
+        recall = true_positive / actual if actual else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        per_class[label] = {"precision": precision, "recall": recall, "f1": f1, "support": actual}
+
+    correct = sum(confusion[i][i] for i in range(len(classes)))
+    return {
+        "total": len(results),
+        "scored": len(scored),
+        "errors": len(results) - len(scored),
+        "accuracy": correct / len(scored) if scored else 0.0,
+        "confusion_matrix": {"labels": classes, "matrix": confusion},
+        "per_class": per_class,
+        "roc_auc": roc_auc(
+            [r["positive_probability"] for r in scored],
+            [r["true_label"] == POSITIVE_CLASS for r in scored]
+        )
+    }
+
+
+def _read_image(path):
+    try:
+        return xray_model.preprocess_image(path.read_bytes()), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _load_chunk(chunk, store, base_dir):
+    """
+    (tensor, error) per image of the chunk: from the tensor store where it
+    holds an up to date copy of the image, decoded in parallel otherwise
+    """
+    loaded = [None] * len(chunk)
+    if store is not None:
+        hits = []
+        for i, (path, _) in enumerate(chunk):
+            stat = path.stat()
+            entry = store.lookup(path.relative_to(base_dir).as_posix(), stat.st_size, stat.st_mtime_ns)
+            if entry is not None:
+                hits.append((i, entry))
+        if hits:
+            batch = store.load([entry for _, entry in hits])
+            for (i, _), tensor in zip(hits, batch):
+                loaded[i] = (tensor, None)
+
+    misses = [i for i, item in enumerate(loaded) if item is None]
+    for i, item in zip(misses, decode_pool.map(_read_image, [chunk[i][0] for i in misses])):
+        loaded[i] = item
+    return loaded
+
+
+class EvaluationJobs:
+    """
+    Background evaluation jobs over the bundled test set
+
+    Each job decodes images in the decode pool (or reads them already
+    preprocessed from the tensor store when one has been built), runs them
+    through the ensemble in batches on the inference pool and computes the
+    metrics when done. Finished results are stored per effective model
+    version (cache_version, which includes the cascade setting), so
+    re-running the same evaluation against the same model returns them
+    immediately. Results are also appended to a .partial file after every
+    batch, so a job interrupted by a crash or restart resumes where it
+    stopped the next time the same evaluation is started.
+    """
+    def __init__(self, results_dir=EVAL_RESULTS_DIR):
+        self.results_dir = Path(results_dir)
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def _result_path(self, version, category, limit):
+        name = f"{version.cache_version}-{(category or 'all').lower()}-{limit or 'all'}.json"
+        return self.results_dir / name
+
+    def _add(self, job):
+        with self._lock:
+            self.jobs[job["id"]] = job
+            finished = [job_id for job_id, other in self.jobs.items() if other["status"] in ("completed", "failed")]
+            for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[job_id]
+
+    def _running(self, result_path):
+        with self._lock:
+            for job in self.jobs.values():
+                if job["result_file"] == result_path.name and job["status"] in ("queued", "running"):
+                    return job
+        return None
+
+    def start(self, category=None, limit=None, batch_size=EVAL_BATCH_SIZE):
+        """
+        Start an evaluation and return its job record
+        """
+        job_id = uuid.uuid4().hex[:12]
+        # The whole job runs on this version even if another is swapped in
+        version = xray_model.active_model()
+        result_path = self._result_path(version, category, limit)
+        # Two jobs writing the same results would corrupt the partial file
+        running = self._running(result_path)
+        if running is not None:
+            return running
+
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "model_version": version.version,
+            "category": category,
+            "limit": limit,
+            "progress": {"processed": 0, "total": 0},
+            "metrics": None,
+            "error": None,
+            "cached": False,
+            "resumed": 0,
+            "result_file": result_path.name
+        }
+        self._add(job)
+
+        if result_path.exists():
+            with open(result_path) as f:
+                stored = json.load(f)
+            job.update(status="completed", cached=True, metrics=stored["metrics"], results=stored["results"])
+            job["progress"] = {"processed": len(stored["results"]), "total": len(stored["results"])}
+            return job
+
+        thread = threading.Thread(target=self._run, args=(job, version, category, limit, batch_size, result_path),
+                                  daemon=True)
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    @staticmethod
+    def _load_partial(partial_path):
+        """
+        Results a previous interrupted run appended, dropping a torn last line
+        """
+        results = []
+        if partial_path.exists():
+            with open(partial_path) as f:
+                for line in f:
+                    try:
+                        results.append(json.loads(line))
+                    except ValueError:
+                        break
+            # Rewrite without the torn line so new results append cleanly
+            tmp_path = partial_path.with_name(partial_path.name + ".tmp")
+            with open(tmp_path, "w") as f:
+                f.writelines(json.dumps(result) + "\n" for result in results)
+            os.replace(tmp_path, partial_path)
+        return results
+
+    def _run(self, job, version, category, limit, batch_size, result_path):
+        try:
+            images = _test_images(category.upper() if category else None, limit)
+            job["progress"]["total"] = len(images)
+            job["status"] = "running"
+            started = time.perf_counter()
+            self.results_dir.mkdir(parents=True, exist_ok=True)
+            partial_path = result_path.with_suffix(".partial")
+            # The test set is listed in a stable order, so the results of an
+            # interrupted run are a prefix of this one
+            results = self._load_partial(partial_path)[:len(images)]
+            resumed = len(results)
+            job["resumed"] = resumed
+            job["progress"]["processed"] = resumed
+            store = open_tensor_store()
+            base_dir = find_test_images_dir()
+            job["tensor_store"] = store is not None
+
+            with open(partial_path, "a") as partial:
+                for start in range(resumed, len(images), batch_size):
+                    chunk = images[start:start + batch_size]
+                    decoded = _load_chunk(chunk, store, base_dir)
+
+                    tensors = [tensor for tensor, error in decoded if error is None]
+                    outputs = iter(inference_pool.submit(xray_model.run_batch, torch.stack(tensors), version).result()
+                                   if tensors else [])
+
+                    for (path, label), (_, error) in zip(chunk, decoded):
+                        if error is not None:
+                            results.append({"filename": path.name, "true_label": label, "error": error})
+                            continue
+                        probabilities, models_consulted, row_version = next(outputs)
+                        prediction = xray_model.format_prediction(path.name, probabilities, models_consulted,
+                                                                  row_version)
+                        prediction.update(
+                            true_label=label,
+                            correct=prediction["prediction"] == label,
+                            positive_probability=probabilities[xray_model.CLASSES.index(POSITIVE_CLASS)].item()
+                        )
+                        results.append(prediction)
+                    partial.writelines(json.dumps(result) + "\n" for result in results[start:])
+                    partial.flush()
+                    job["progress"]["processed"] = len(results)
+
+            elapsed = time.perf_counter() - started
+            metrics = compute_metrics(results, xray_model.CLASSES)
+            metrics["elapsed_seconds"] = elapsed
+            metrics["throughput"] = (len(results) - resumed) / elapsed if elapsed > 0 else 0.0
+
+            tmp_path = result_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"metrics": metrics, "results": results}, f)
+            os.replace(tmp_path, result_path)
+            partial_path.unlink()
+
+            job.update(status="completed", metrics=metrics, results=results)
+        except Exception as e:
+            job.update(status="failed", error=str(e))
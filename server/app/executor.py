@@ -0,0 +1,94 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from .config import DECODE_WORKERS, BACKBONE_THREADS
+from .topology import plan_threads
+
+# CPUs, inference workers and torch threads for this process
+THREAD_PLAN = plan_threads()
+inference_workers = THREAD_PLAN["inference_workers"]
+
+
+def intra_op_threads():
+    """
+    Number of torch intra-op threads each inference worker should use
+    """
+    return THREAD_PLAN["intra_op_threads"]
+
+
+def _init_inference_worker():
+    # With the OpenMP backend the thread count is tracked per calling thread,
+    # so each worker sets its own share of the cores
+    torch.set_num_threads(intra_op_threads())
+
+
+# Process-wide defaults before any worker thread starts
+torch.set_num_threads(intra_op_threads())
+try:
+    torch.set_num_interop_threads(THREAD_PLAN["interop_threads"])
+except RuntimeError:
+    # Only settable before the first inter-op parallel work in the process
+    pass
+
+# Forward passes run here; the event loop only awaits their results
+inference_pool = ThreadPoolExecutor(
+    max_workers=inference_workers,
+    thread_name_prefix="inference",
+    initializer=_init_inference_worker
+)
+
+def backbone_thread_counts():
+    """
+    Torch intra-op threads for each backbone thread in parallel mode
+    """
+    if BACKBONE_THREADS:
+        return BACKBONE_THREADS
+    return [max(1, intra_op_threads() // 3)] * 3
+
+
+_backbone_counts = iter(backbone_thread_counts())
+_backbone_counts_lock = threading.Lock()
+
+
+def _init_backbone_worker():
+    # Each backbone thread takes its own share of the intra-op threads, so
+    # together they don't oversubscribe the cores
+    with _backbone_counts_lock:
+        torch.set_num_threads(next(_backbone_counts))
+
+
+# The backbones of the ensemble run here in parallel mode. Every loaded model
+# version shares it, so hot-swaps don't start (and leak) new threads, each
+# with its own OpenMP pool. Threads only start once parallel mode is used.
+backbone_pool = ThreadPoolExecutor(
+    max_workers=len(backbone_thread_counts()),
+    thread_name_prefix="backbone",
+    initializer=_init_backbone_worker
+)
+
+# PIL decoding and preprocessing run here so uploads keep being parsed while
+# the inference workers are busy
+decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+
+
+async def run_in_pool(pool, func, *args):
+    """
+    Run a blocking function in one of the worker pools and await its result
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, func, *args)
+
+
+def pool_status():
+    """
+    Report the configured size of each worker pool
+    """
+    return {
+        "inference_workers": inference_workers,
+        "torch_num_threads": intra_op_threads(),
+        "decode_workers": DECODE_WORKERS,
+        "topology": THREAD_PLAN
+    }
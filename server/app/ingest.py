@@ -0,0 +1,131 @@
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from PIL import Image, UnidentifiedImageError
+
+from .config import MAX_UPLOAD_BYTES, MAX_IMAGE_PIXELS
+
+# Pillow's own decompression bomb guard applies to every decode, including
+# images inside /predict/batch archives (None disables it)
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS or None
+
+# Leading bytes of the image formats accepted for upload
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+]
+
+# Allowance for the multipart boundaries and part headers around the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadRejected(HTTPException):
+    """
+    An upload refused before decoding: 413 when it is too large, 415 when it
+    isn't a supported image
+    """
+    def __init__(self, status_code, message):
+        super().__init__(status_code=status_code, detail=message)
+
+
+def sniff_format(head):
+    """
+    Image format named by the first bytes of a file, or None if unsupported
+    """
+    for signature, image_format in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def upload_size(fileobj):
+    """
+    Size in bytes of a (spooled) upload file, leaving it rewound
+    """
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    return size
+
+
+def validate_upload(fileobj, max_bytes=MAX_UPLOAD_BYTES, max_pixels=MAX_IMAGE_PIXELS):
+    """
+    Check an uploaded file's size, format and dimensions without decoding it
+
+    Only the first bytes and the image header are read. Raises UploadRejected,
+    otherwise returns (format, (width, height)) with the file rewound so it
+    can be decoded directly.
+    """
+    size = upload_size(fileobj)
+    if max_bytes and size > max_bytes:
+        raise UploadRejected(413, f"Upload is {size} bytes, the limit is {max_bytes}")
+
+    image_format = sniff_format(fileobj.read(16))
+    fileobj.seek(0)
+    if image_format is None:
+        raise UploadRejected(415, "Unsupported file type, expected a PNG, JPEG, GIF, BMP, TIFF or WebP image")
+
+    try:
+        # Image.open only parses the header; pixel data is read on load()
+        image = Image.open(fileobj, formats=[image_format])
+    except Image.DecompressionBombError as e:
+        raise UploadRejected(413, str(e))
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise UploadRejected(415, f"File is not a valid {image_format} image")
+    finally:
+        fileobj.seek(0)
+
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        raise UploadRejected(413, f"Image is {width}x{height} pixels, the limit is {max_pixels} pixels")
+    return image_format, image.size
+
+
+class BodySizeLimit:
+    """
+    ASGI middleware that caps the request body size per path
+
+    Requests whose Content-Length is over the limit get a 413 before any of
+    the body is read; chunked bodies are counted as they stream in and cut
+    off as soon as they pass the limit, so an oversized upload is never
+    spooled in full.
+    """
+    def __init__(self, app, limits):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("path")) if scope["type"] == "http" else None
+        if not limit:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        length = headers.get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            await self._reject(scope, receive, send, limit)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised inside form parsing; FastAPI passes HTTPExceptions through
+                    raise UploadRejected(413, f"Request body is larger than {limit} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def _reject(self, scope, receive, send, limit):
+        response = JSONResponse(status_code=413, content={"error": f"Request body is larger than {limit} bytes"})
+        await response(scope, receive, send)
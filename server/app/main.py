@@ -1,8 +1,23 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.routing import Match
 import uvicorn
-from app.model import predict_xray
+from app.model import (
+    predict_xray, predict_xray_batch, predict_pixels, format_prediction, batch_scheduler, prediction_cache,
+    MODEL_STATE, start_model_loading, model_ready, model_unavailable_message, backbone_timings, model_registry,
+    near_duplicates, CLASSES
+)
+from app.executor import pool_status
+from app.evaluation import EvaluationJobs
+from app.ingest import BodySizeLimit, UploadRejected, MULTIPART_OVERHEAD
+from app.rawinput import SHAPE_HEADER, read_body, pixels_from_body, response_format, encode_predictions
+from app.admission import AdmissionController, AdmissionMiddleware, ClientDisconnected, cancel_on_disconnect
+from app.batching import DeadlineExceeded
+from app.config import MAX_UPLOAD_BYTES, BULK_MAX_UPLOAD_BYTES, RAW_MAX_UPLOAD_BYTES, ADMIN_TOKEN
+from app.metrics import registry, REQUESTS, REQUEST_ERRORS, REQUEST_LATENCY, IN_FLIGHT, STAGE_LATENCY
 import os
+import secrets
 from pathlib import Path
 import glob
 from PIL import Image
@@ -12,8 +27,52 @@ from typing import List, Dict, Union
 
 app = FastAPI(title="X-Ray Insight API", description="API for X-Ray pneumonia prediction")
 
+# Stop oversized uploads while they stream in, before they are spooled
+app.add_middleware(BodySizeLimit, limits={
+    "/predict": MAX_UPLOAD_BYTES and MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD,
+    "/predict/batch": BULK_MAX_UPLOAD_BYTES,
+    "/predict/raw": RAW_MAX_UPLOAD_BYTES
+})
+
+# Refuse predictions with a 429 once too many are pending, before their body is read
+admission = AdmissionController()
+app.add_middleware(AdmissionMiddleware, controller=admission, paths=["/predict", "/predict/raw"])
+
+@app.exception_handler(UploadRejected)
+async def upload_rejected(request: Request, exc: UploadRejected):
+    return JSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+
+def endpoint_label(scope):
+    """
+    Route path template for a request (e.g. /eval/{job_id}), so metric labels stay bounded
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    endpoint = endpoint_label(request.scope)
+    IN_FLIGHT.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        IN_FLIGHT.dec()
+        REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+        if status >= 400:
+            REQUEST_ERRORS.inc(endpoint=endpoint)
+
 # Configure CORS to allow requests from the frontend
 # Default to localhost:5173 for local development
+# Added last so it is the outermost middleware: the 413s and 429s the
+# middlewares above send on their own also carry the CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173", "http://localhost:8080","http://localhost:8000"],  # Allow both default Vite ports
@@ -22,119 +81,290 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Background evaluations over the bundled test set
+evaluation_jobs = EvaluationJobs()
+
+@app.on_event("startup")
+async def load_model_in_background():
+    # The model loads and warms up on the inference pool; requests are
+    # accepted right away and /health/ready reports when it's usable
+    start_model_loading()
+
 @app.get("/")
 async def root():
     return {"message": "X-Ray Insight API is running"}
 
+@app.get("/health/live")
+async def health_live():
+    """
+    Liveness probe: the server process is up and handling requests
+    """
+    return {"status": "alive", "model_status": MODEL_STATE["status"]}
+
+@app.get("/health/ready")
+async def health_ready():
+    """
+    Readiness probe: the model is loaded and warmed up
+
+    Returns 503 until then, so traffic is only routed once the first real
+    request will be fast.
+    """
+    status_code = 200 if model_ready() else 503
+    return JSONResponse(status_code=status_code, content={
+        "ready": model_ready(),
+        "status": MODEL_STATE["status"],
+        "error": MODEL_STATE["error"],
+        "backend": MODEL_STATE.get("backend"),
+        "version": MODEL_STATE.get("version"),
+        "timings": MODEL_STATE["timings"]
+    })
+
 @app.post("/predict")
-async def predict(file: UploadFile = File(...)):
+async def predict(request: Request, file: UploadFile = File(...), cache: bool = True, purge: bool = False,
+                  explain: bool = False):
     """
     Upload an X-ray image and get pneumonia prediction
+    
+    Parameters:
+    - cache: Set to false to skip the prediction cache lookup for this request
+    - purge: Set to true to drop any cached prediction for this image first
+    - explain: Set to true to also get a saliency heatmap of where the
+      ensemble looked, as a base64 PNG overlay for the 256x256 input
+    
+    Uploads larger than MAX_UPLOAD_BYTES or MAX_IMAGE_PIXELS get a 413, files
+    that aren't images a 415.
+    
+    When ADMISSION_MAX_PENDING requests are already pending the request gets
+    a 429 with a Retry-After header. Requests whose deadline (REQUEST_TIMEOUT_MS
+    or the X-Request-Timeout-Ms header) passes before inference get a 504, and
+    requests from clients that disconnected are dropped without running the model.
     """
+    # FastAPI has received and parsed the multipart body by the time we get here
+    admitted_at = getattr(request.state, "admitted_at", None)
+    if admitted_at is not None:
+        STAGE_LATENCY.observe(time.perf_counter() - admitted_at, stage="upload_read")
+    deadline = getattr(request.state, "deadline", None)
     try:
         # Process the uploaded image and get prediction
-        result = await predict_xray(file)
+        result = await cancel_on_disconnect(
+            request.receive, predict_xray(file, use_cache=cache, purge_cache=purge, deadline=deadline, explain=explain))
+        if "error" in result:
+            REQUEST_ERRORS.inc(endpoint="/predict")
         return result
+    except ClientDisconnected:
+        admission.record("disconnected")
+        # Nobody is listening; the status only shows up in the metrics
+        return JSONResponse(status_code=499, content={"error": "Client disconnected"})
+    except DeadlineExceeded as e:
+        admission.record("expired")
+        return JSONResponse(status_code=504, content={"error": str(e)})
+    except UploadRejected:
+        raise
     except Exception as e:
+        REQUEST_ERRORS.inc(endpoint="/predict")
         return {"error": str(e)}
 
-@app.get("/test")
-async def run_batch_test(category: str = None, limit: int = 20):
+@app.post("/predict/raw")
+async def predict_raw(request: Request, format: str = None):
     """
-    Run tests on the X-ray model using test images
+    Predict already decoded grayscale or RGB pixels sent as the request body
+    
+    The body is an application/octet-stream of uint8 pixels with their shape
+    in the X-Shape header ("H,W", "H,W,C", "N,H,W" or "N,H,W,C"), or an .npy
+    file of uint8 pixels. Images that are already 256x256 go straight into
+    the model; others are resized like decoded uploads.
     
     Parameters:
-    - category: Filter tests by "NORMAL" or "PNEUMONIA" (optional)
-    - limit: Maximum number of test images to process (default 20)
+    - format: "json" (default, like /predict; a batch dimension returns a
+      list of predictions), "msgpack" or "binary" (float32 probabilities).
+      Also picked from the Accept header when not given.
     
-    Returns results for model performance evaluation
+    Admission control and deadlines work as for /predict. Raw requests are
+    not cached.
     """
-    test_images_dir = Path("../test_images/test").resolve()
-    if not test_images_dir.exists():
-        test_images_dir = Path("../../server/test_images/test").resolve()
-    
-    if not test_images_dir.exists():
-        return {"error": f"Test images directory not found: {test_images_dir}"}
+    if not model_ready():
+        return JSONResponse(status_code=503, content={"error": model_unavailable_message()})
+    deadline = getattr(request.state, "deadline", None)
+    try:
+        response_type = response_format(format, request.headers.get("accept", ""))
+        started = time.perf_counter()
+        body = await read_body(request)
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage="upload_read")
+        images, batched = pixels_from_body(body, request.headers.get(SHAPE_HEADER))
+        outputs, batch_size = await cancel_on_disconnect(request.receive, predict_pixels(images, deadline))
+    except ClientDisconnected:
+        admission.record("disconnected")
+        return JSONResponse(status_code=499, content={"error": "Client disconnected"})
+    except DeadlineExceeded as e:
+        admission.record("expired")
+        return JSONResponse(status_code=504, content={"error": str(e)})
+    except UploadRejected:
+        raise
+    except Exception as e:
+        REQUEST_ERRORS.inc(endpoint="/predict/raw")
+        return {"error": str(e)}
+
+    if response_type != "json":
+        return encode_predictions(outputs, CLASSES, response_type, batch_size)
+    predictions = [
+        {**format_prediction(None, probabilities, models_consulted, version), "batch_size": batch_size}
+        for probabilities, models_consulted, version in outputs
+    ]
+    return {"predictions": predictions} if batched else predictions[0]
+
+@app.post("/predict/batch")
+async def predict_batch(files: List[UploadFile] = File(...), explain: bool = False):
+    """
+    Upload many X-ray images, or a zip/tar archive of them, and get one
+    prediction per image streamed back as newline-delimited JSON
     
-    # Get paths for test images
-    image_paths = []
+    Parameters:
+    - explain: Set to true to add a saliency heatmap to every prediction
+    """
+    return StreamingResponse(predict_xray_batch(files, explain), media_type="application/x-ndjson")
+
+@app.get("/cache")
+async def cache_status():
+    """
+    Report the prediction cache settings and hit/miss/eviction counters, the
+    near-duplicate index and how many ensemble calls both have saved
+    """
+    status = prediction_cache.status()
+    dedup_status = near_duplicates.status()
+    return {
+        **status,
+        "near_duplicates": dedup_status,
+        "ensemble_calls_saved": {
+            "exact_cache": status["stats"]["hits"] + status["stats"]["disk_hits"],
+            "near_duplicate": dedup_status["stats"]["hits"]
+        }
+    }
+
+@app.delete("/cache")
+async def purge_cache():
+    """
+    Remove every entry from the prediction cache
+    """
+    prediction_cache.purge()
+    near_duplicates.purge()
+    return {"message": "Prediction cache purged"}
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Runtime metrics in the Prometheus text format
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/batching")
+async def batching_status():
+    """
+    Report the micro-batching settings, how batches have been formed so far
+    and the average forward time of each backbone
+    """
+    return {
+        "max_batch_size": batch_scheduler.max_batch_size,
+        "max_wait_ms": batch_scheduler.max_wait * 1000,
+        "stats": batch_scheduler.stats,
+        "queue_depth": batch_scheduler.queue_depth(),
+        "pools": pool_status(),
+        "backbone_timings": backbone_timings.status()
+    }
+
+@app.get("/admission")
+async def admission_status():
+    """
+    Report the admission limits, how many predictions are pending and how
+    many were shed (queue full, client limit, deadline expired, disconnected)
+    """
+    return admission.status()
+
+def admin_forbidden(request: Request):
+    """
+    403 response unless the request carries ADMIN_TOKEN (when one is configured)
+    """
+    if ADMIN_TOKEN and not secrets.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        return JSONResponse(status_code=403, content={"error": "Invalid or missing X-Admin-Token"})
+    return None
+
+@app.get("/admin/model")
+async def model_status(request: Request):
+    """
+    Report the active and previous model versions, any load in progress,
+    the versions available to load and the recent swap history
+    """
+    return admin_forbidden(request) or model_registry.status()
+
+@app.post("/admin/model/load")
+async def load_model_version(request: Request, version: str):
+    """
+    Load a model version in the background, warm it up and swap it in
     
-    if category and category.upper() in ["NORMAL", "PNEUMONIA"]:
-        image_dir = test_images_dir / category.upper()
-        image_paths = list(image_dir.glob("*.jpeg"))[:limit]
-    else:
-        # Get both normal and pneumonia images
-        normal_images = list((test_images_dir / "NORMAL").glob("*.jpeg"))[:limit//2]
-        pneumonia_images = list((test_images_dir / "PNEUMONIA").glob("*.jpeg"))[:limit//2]
-        image_paths = normal_images + pneumonia_images
+    Parameters:
+    - version: "default" or the name of a directory in the model versions directory
     
-    if not image_paths:
-        return {"error": "No test images found"}
+    Requests keep being served by the active version until the swap;
+    batches already running finish on it.
+    """
+    forbidden = admin_forbidden(request)
+    if forbidden:
+        return forbidden
+    if not model_ready():
+        return JSONResponse(status_code=503, content={"error": "Model is not ready"})
+    try:
+        started = model_registry.load(version)
+    except ValueError as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    if not started:
+        return JSONResponse(status_code=409, content={"error": "Another model version is already loading"})
+    return JSONResponse(status_code=202, content=model_registry.status())
+
+@app.post("/admin/model/rollback")
+async def rollback_model(request: Request):
+    """
+    Swap the previously active model version back in
+    """
+    forbidden = admin_forbidden(request)
+    if forbidden:
+        return forbidden
+    if not model_registry.rollback():
+        return JSONResponse(status_code=409, content={"error": "No previous model version to roll back to"})
+    return model_registry.status()
+
+@app.post("/eval")
+async def start_evaluation(category: str = None, limit: int = None):
+    """
+    Start a background evaluation of the model on the bundled test images
     
-    # Process each image
-    results = []
-    metrics = {"correct": 0, "total": 0, "normal_correct": 0, "normal_total": 0, "pneumonia_correct": 0, "pneumonia_total": 0}
-    processing_time = 0
+    Parameters:
+    - category: Only evaluate "NORMAL" or "PNEUMONIA" images (optional)
+    - limit: Maximum number of test images per category (optional, default all)
     
-    for image_path in image_paths:
-        try:
-            start_time = time.time()
-            
-            # Open and prepare the image
-            with open(image_path, "rb") as img_file:
-                contents = img_file.read()
-            
-            # Create a mock UploadFile object
-            mock_file = type('MockFile', (), {
-                'filename': image_path.name,
-                'read': lambda: contents
-            })()
-            
-            # Get prediction
-            result = await predict_xray(mock_file)
-            end_time = time.time()
-            
-            # Calculate metrics
-            processing_time += (end_time - start_time)
-            
-            # Add ground truth based on directory name
-            true_label = "Normal" if "NORMAL" in str(image_path) else "Pneumonia"
-            result["true_label"] = true_label
-            result["correct"] = result["prediction"] == true_label
-            
-            # Update metrics
-            metrics["total"] += 1
-            if result["correct"]:
-                metrics["correct"] += 1
-            
-            if true_label == "Normal":
-                metrics["normal_total"] += 1
-                if result["correct"]:
-                    metrics["normal_correct"] += 1
-            else:
-                metrics["pneumonia_total"] += 1
-                if result["correct"]:
-                    metrics["pneumonia_correct"] += 1
-            
-            results.append(result)
-            
-        except Exception as e:
-            results.append({
-                "filename": image_path.name,
-                "error": str(e)
-            })
+    Returns the job record; poll GET /eval/{id} for progress and metrics.
+    If this evaluation already ran against the same model version, the
+    stored results are returned right away.
+    """
+    if not model_ready():
+        return JSONResponse(status_code=503, content={"error": "Model is not ready"})
+    if category and category.upper() not in ["NORMAL", "PNEUMONIA"]:
+        return JSONResponse(status_code=400, content={"error": "category must be NORMAL or PNEUMONIA"})
     
-    # Calculate accuracy metrics
-    if metrics["total"] > 0:
-        metrics["accuracy"] = metrics["correct"] / metrics["total"]
-        metrics["normal_accuracy"] = metrics["normal_correct"] / metrics["normal_total"] if metrics["normal_total"] > 0 else 0
-        metrics["pneumonia_accuracy"] = metrics["pneumonia_correct"] / metrics["pneumonia_total"] if metrics["pneumonia_total"] > 0 else 0
-        metrics["avg_processing_time"] = processing_time / metrics["total"]
+    job = evaluation_jobs.start(category=category, limit=limit)
+    return {key: value for key, value in job.items() if key != "results"}
+
+@app.get("/eval/{job_id}")
+async def get_evaluation(job_id: str, results: bool = False):
+    """
+    Report the progress of an evaluation job and, once completed, its metrics:
+    confusion matrix, precision/recall/F1, ROC-AUC and throughput
     
-    return {
-        "metrics": metrics,
-        "results": results
-    }
+    Parameters:
+    - results: Set to true to include the per-image predictions
+    """
+    job = evaluation_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": f"Evaluation job not found: {job_id}"})
+    return {key: value for key, value in job.items() if results or key != "results"}
 
 if __name__ == "__main__":
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
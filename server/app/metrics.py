@@ -0,0 +1,191 @@
+import bisect
+import os
+import threading
+
+from .config import METRICS_HISTOGRAMS
+
+# A small in-process metrics registry rendered in the Prometheus text
+# exposition format. Recording a value is a dict lookup and an addition under
+# a lock, cheap enough for the per-request hot path.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                                for key, value in values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # callback() returns {label values tuple: value}, read at scrape time
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.callback is not None:
+            values = self.callback()
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+                                for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not METRICS_HISTOGRAMS:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket counts (the last slot is +Inf), then sum and count
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def render(self):
+        with self._lock:
+            values = {key: (list(counts[0]), counts[1], counts[2]) for key, counts in self._values.items()}
+        lines = self.header()
+        for key, (bucket_counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, Histogram) and not METRICS_HISTOGRAMS:
+                continue
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _process_rss():
+    # Resident set size from /proc (Linux); reported as 0 elsewhere
+    try:
+        with open("/proc/self/statm") as f:
+            return {(): int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")}
+    except (OSError, ValueError):
+        return {(): 0}
+
+
+def _torch_threads():
+    import torch
+    return {("intra_op",): torch.get_num_threads(), ("inter_op",): torch.get_num_interop_threads()}
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    "xray_requests_total", "HTTP requests handled, by endpoint, method and status code",
+    ["endpoint", "method", "status"]))
+REQUEST_ERRORS = registry.register(Counter(
+    "xray_request_errors_total", "Requests that failed or returned an error payload, by endpoint",
+    ["endpoint"]))
+REQUEST_LATENCY = registry.register(Histogram(
+    "xray_request_duration_seconds", "End to end request latency, by endpoint",
+    ["endpoint"]))
+IN_FLIGHT = registry.register(Gauge(
+    "xray_requests_in_flight", "Requests currently being handled"))
+STAGE_LATENCY = registry.register(Histogram(
+    "xray_stage_duration_seconds", "Time spent in each stage of the prediction path "
+    "(upload_read, upload_validate, decode, preprocess, perceptual_hash, forward, explain, serialize)",
+    ["stage"]))
+ADMISSION_PENDING = registry.register(Gauge(
+    "xray_admission_pending", "Prediction requests admitted and not yet finished"))
+BATCH_QUEUE_DEPTH = registry.register(Gauge(
+    "xray_batch_queue_depth", "Prediction requests waiting to be formed into a batch"))
+REQUESTS_SHED = registry.register(Counter(
+    "xray_requests_shed_total", "Prediction requests refused or dropped before inference, by reason "
+    "(queue_full, client_limit, expired, disconnected)",
+    ["reason"]))
+ENSEMBLE_CALLS_SAVED = registry.register(Counter(
+    "xray_ensemble_calls_saved_total", "Predictions served without running the ensemble, by source "
+    "(exact_cache, near_duplicate)",
+    ["source"]))
+BACKBONE_LATENCY = registry.register(Histogram(
+    "xray_backbone_duration_seconds", "Forward pass time of each ensemble backbone",
+    ["backbone"]))
+BATCH_SIZE = registry.register(Histogram(
+    "xray_batch_size", "Number of images per ensemble forward pass",
+    buckets=(1, 2, 4, 8, 16, 32, 64)))
+PROCESS_RSS = registry.register(Gauge(
+    "xray_process_resident_memory_bytes", "Resident memory of the server process",
+    callback=_process_rss))
+TORCH_THREADS = registry.register(Gauge(
+    "xray_torch_threads", "Torch thread pool sizes of the process",
+    ["kind"], callback=_torch_threads))
@@ -1,29 +1,126 @@
-import io
+import time
+
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import json
+import threading
 import torch
 import torch.nn as nn
-import torchvision.transforms as transforms
-from PIL import Image
 import os
-import sys
 from pathlib import Path
 import timm
 
+from .batching import BatchScheduler, DeadlineExceeded
+from .bulk import stream_predictions
+from .cache import PredictionCache, file_hash, weights_checksum
+from .ingest import UploadRejected, validate_upload
+from .dedup import NearDuplicateIndex, HASH_FUNCTIONS, phash
+from .preprocessing import IMAGE_SIZE, decode_image, pixels_to_tensor, resize_pixels
+from .metrics import STAGE_LATENCY, BACKBONE_LATENCY, BATCH_SIZE, BATCH_QUEUE_DEPTH, ENSEMBLE_CALLS_SAVED
+from .config import (
+    BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS,
+    CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, CACHE_DB_PATH, CACHE_DB_MAX_ENTRIES, WARMUP_BATCH_SIZES,
+    WEIGHTS_MMAP, MODEL_PRECISION, INFERENCE_BACKEND,
+    CASCADE_MODE, CASCADE_THRESHOLD, PARALLEL_BACKBONES, MODEL_VERSIONS_DIR,
+    DEDUP_ENABLED, DEDUP_MAX_DISTANCE, DEDUP_MAX_ENTRIES, DEDUP_HASH,
+    OPTIMIZE_TRANSFORMS, OPTIMIZE_TOLERANCE, OPTIMIZE_CHECK_IMAGES
+)
+from .backends import EagerBackend, TorchScriptBackend, OnnxRuntimeBackend
+from .executor import (
+    inference_pool, inference_workers, decode_pool, backbone_pool, backbone_thread_counts, run_in_pool,
+    intra_op_threads
+)
+from .weights import load_mmap_weights
+from .registry import ModelRegistry, ModelVersion
+from .optimize import optimize_model
+from .saliency import capture_features, class_activation_maps, current_capture, use_capture, overlay_png
+
 # Define the EnsembleModel class
 class EnsembleModel(nn.Module):
-    def __init__(self, model1, model2, model3):
+    def __init__(self, model1, model2, model3, names=("model1", "model2", "model3")):
         super(EnsembleModel, self).__init__()
         self.model1 = model1
         self.model2 = model2
         self.model3 = model3
+        self.names = names
+        # Optional thread pool to run the backbones concurrently, see enable_parallel()
+        self.executor = None
+        # Optional callback(name, seconds) receiving each backbone's forward time
+        self.on_backbone_timing = None
+
+    def enable_parallel(self, executor):
+        """
+        Run the three independent backbones concurrently on executor's threads
+
+        The executor is shared, not owned: ensembles of every loaded version
+        use the same one (see executor.backbone_pool), whose threads each
+        have their own share of the torch intra-op threads (with the OpenMP
+        backend the thread count is tracked per calling thread), so together
+        they don't oversubscribe the cores. Latency then approaches the
+        slowest backbone rather than the sum of all three.
+        """
+        self.executor = executor
+
+    def backbones(self):
+        return [self.model1, self.model2, self.model3]
+
+    # Modes a backbone runs under when the caller passes none: pure inference,
+    # never recording autograd graphs
+    INFERENCE_MODES = (False, True, None, None)
+
+    def _run_backbone(self, index, model, x, modes=INFERENCE_MODES):
+        # Grad, inference and autocast modes, and the saliency capture, are
+        # thread local, so worker threads take them from the caller explicitly
+        grad_enabled, inference_mode, autocast_dtype, capture = modes
+        with torch.inference_mode(inference_mode), torch.set_grad_enabled(grad_enabled), \
+                torch.autocast(x.device.type, dtype=autocast_dtype or torch.bfloat16,
+                               enabled=autocast_dtype is not None), use_capture(capture):
+            started = time.perf_counter()
+            out = model(x)
+            if self.on_backbone_timing is not None:
+                self.on_backbone_timing(self.names[index], time.perf_counter() - started)
+        return out
+
+    def _run_backbones(self, x, indices):
+        models = self.backbones()
+        autocast_enabled = (torch.is_autocast_cpu_enabled() if x.device.type == "cpu"
+                            else torch.is_autocast_enabled())
+        autocast_dtype = (torch.get_autocast_cpu_dtype() if x.device.type == "cpu"
+                          else torch.get_autocast_gpu_dtype())
+        modes = (torch.is_grad_enabled(), torch.is_inference_mode_enabled(),
+                 autocast_dtype if autocast_enabled else None, current_capture())
+        if self.executor is None or len(indices) == 1:
+            return [self._run_backbone(i, models[i], x, modes) for i in indices]
+        futures = [self.executor.submit(self._run_backbone, i, models[i], x, modes) for i in indices]
+        return [future.result() for future in futures]
 
     def forward(self, x):
-        out1 = self.model1(x)
-        out2 = self.model2(x)
-        out3 = self.model3(x)
+        out1, out2, out3 = self._run_backbones(x, (0, 1, 2))
         # Simple averaging ensemble
         out = (out1 + out2 + out3) / 3
         return out
 
+    def forward_cascade(self, x, threshold):
+        """
+        Run model1 first and only consult model2 and model3 for the inputs
+        whose model1 softmax margin (top1 - top2 probability) is below threshold
+
+        Returns the class probabilities and a boolean mask of the escalated inputs.
+        """
+        (out1,) = self._run_backbones(x, (0,))
+        probabilities = torch.nn.functional.softmax(out1, dim=1)
+        top2 = probabilities.topk(2, dim=1).values
+        escalated = (top2[:, 0] - top2[:, 1]) < threshold
+
+        if escalated.any():
+            # The expensive models only see the uncertain subset of the batch
+            index = escalated.nonzero(as_tuple=True)[0]
+            out2, out3 = self._run_backbones(x[index], (1, 2))
+            out = (out1[index] + out2 + out3) / 3
+            probabilities[index] = torch.nn.functional.softmax(out, dim=1)
+        return probabilities, escalated
+
 # Define the wrapper for unified ensemble model
 class EnsembleModelWrapper(nn.Module):
     """
@@ -39,194 +136,710 @@ class EnsembleModelWrapper(nn.Module):
         self.resnet = timm.create_model("resnet50d", pretrained=False, num_classes=2)
         
         # Create the ensemble model
-        self.ensemble = EnsembleModel(self.efficientnet, self.swin, self.resnet)
+        self.ensemble = EnsembleModel(self.efficientnet, self.swin, self.resnet,
+                                      names=("efficientnet", "swin", "resnet"))
     
     def forward(self, x):
         return self.ensemble(x)
 
-# Get the directory where the models are stored
-BASE_MODEL_DIR = Path("../model").resolve()  # For server/app → server/model
-if not BASE_MODEL_DIR.exists():
-    BASE_MODEL_DIR = Path("../../server/model").resolve()  # For other relative paths
-if not BASE_MODEL_DIR.exists():
-    BASE_MODEL_DIR = Path(os.path.join(os.path.dirname(__file__), "../model")).resolve()  # From current file
-if not BASE_MODEL_DIR.exists():
-    BASE_MODEL_DIR = Path("/app/model").resolve()  # For Docker container path
+    def forward_cascade(self, x, threshold):
+        return self.ensemble.forward_cascade(x, threshold)
+
+class EnsembleProbabilities(nn.Module):
+    """
+    Folds the softmax into the model, so exported graphs return class probabilities
+    """
+    def __init__(self, model):
+        super(EnsembleProbabilities, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return torch.nn.functional.softmax(self.model(x), dim=1)
+
+# Architectures of the three ensemble members, in the order they run
+ENSEMBLE_MODEL_NAMES = ["efficientnet_b0", "swinv2_tiny_window8_256", "resnet50d"]
 
-print(f"Looking for models in: {BASE_MODEL_DIR}")
+# Model lifecycle state, reported by the /health endpoints.
+# status: not_loaded -> loading -> warming_up -> ready (or failed)
+MODEL_STATE = {
+    "status": "not_loaded",
+    "error": None,
+    "timings": {}
+}
 
 # Set up device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Using device: {device}")
 
-# Look for the unified ensemble model
-UNIFIED_MODEL_PATH = BASE_MODEL_DIR / "unified_ensemble_model.pth"
-ensemble_model = None
+# Predictions are only cached once a model version is known
+prediction_cache = PredictionCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    ttl_seconds=CACHE_TTL_SECONDS,
+    db_path=CACHE_DB_PATH or None,
+    db_max_entries=CACHE_DB_MAX_ENTRIES
+)
 
-# Check if the unified model exists
-if UNIFIED_MODEL_PATH.exists():
-    try:
-        # Load the unified model
-        unified_model = EnsembleModelWrapper()
-        unified_model.load_state_dict(torch.load(UNIFIED_MODEL_PATH, map_location=device))
-        unified_model.to(device)
-        unified_model.eval()
-        ensemble_model = unified_model
-        print(f"Unified ensemble model loaded successfully from {UNIFIED_MODEL_PATH}")
-    except Exception as e:
-        print(f"Error loading unified model: {e}")
-        ensemble_model = None
-else:
-    print(f"Unified ensemble model not found at {UNIFIED_MODEL_PATH}")
-    print("Falling back to loading individual models")
-    
-    # Define model file paths for fallback
-    MODELS = {
-        "efficientnet": {
-            "path": None,
-            "files": ["efficientnet_pneumonia.pth"],
-            "architecture": "efficientnet_b0",
-            "model_obj": None
-        },
-        "swin": {
-            "path": None,
-            "files": ["swin_best-2.pth"],
-            "architecture": "swinv2_tiny_window8_256",
-            "model_obj": None
-        },
-        "resnet": {
-            "path": None,
-            "files": ["resnet_best.pth"],
-            "architecture": "resnet50d",
-            "model_obj": None
-        }
-    }
+# Re-encoded or rescaled copies of an image reuse its prediction
+near_duplicates = NearDuplicateIndex(
+    max_distance=DEDUP_MAX_DISTANCE,
+    max_entries=DEDUP_MAX_ENTRIES if DEDUP_ENABLED else 0
+)
+perceptual_hash = HASH_FUNCTIONS.get(DEDUP_HASH, phash)
+
+def find_model_dir():
+    """
+    Get the directory where the models are stored
+    """
+    model_dir = Path("../model").resolve()  # For server/app → server/model
+    if not model_dir.exists():
+        model_dir = Path("../../server/model").resolve()  # For other relative paths
+    if not model_dir.exists():
+        model_dir = Path(os.path.join(os.path.dirname(__file__), "../model")).resolve()  # From current file
+    if not model_dir.exists():
+        model_dir = Path("/app/model").resolve()  # For Docker container path
+    return model_dir
+
+def build_unified_model(model_dir=None):
+    """
+    Build the fp32 unified ensemble on the CPU from the weights in model_dir,
+    for offline tools (benchmarks, calibration, quantization)
+
+    Prefers the memory-mapped .safetensors copy over the .pth file.
+    """
+    model_dir = Path(model_dir) if model_dir else find_model_dir()
+    model = EnsembleModelWrapper()
+    mmap_path = model_dir / "unified_ensemble_model.safetensors"
+    if mmap_path.exists():
+        model.load_state_dict(load_mmap_weights(mmap_path))
+    else:
+        model.load_state_dict(torch.load(model_dir / "unified_ensemble_model.pth", map_location="cpu"))
+    return model.eval()
+
+def load_model(model_dir=None, name="default"):
+    """
+    Build the ensemble from the weights in model_dir and load them
 
-    # Find model files
-    for model_name, model_info in MODELS.items():
-        for filename in model_info["files"]:
-            model_path = BASE_MODEL_DIR / filename
-            if model_path.exists():
-                MODELS[model_name]["path"] = model_path
-                print(f"Found {model_name} model at: {model_path}")
-                break
+    Returns a ModelVersion with the inference backend, the torch module (for
+    PyTorch backends), the weight files and their checksum as the version,
+    and the construct/load timings. Raises RuntimeError if nothing loaded.
+    """
+    timings = {"construct": 0.0, "load": 0.0}
+
+    base_model_dir = Path(model_dir) if model_dir else find_model_dir()
+    print(f"Looking for models in: {base_model_dir}")
+    print(f"Using device: {device}")
+
+    # Look for the unified ensemble model
+    unified_model_path = base_model_dir / "unified_ensemble_model.pth"
+    # Prefer the memory-mapped copy so all workers on a host share its pages
+    unified_mmap_path = base_model_dir / "unified_ensemble_model.safetensors"
+    if WEIGHTS_MMAP and unified_mmap_path.exists():
+        unified_model_path = unified_mmap_path
+    ensemble_model = None
+    inference_backend = None
+    weight_files = []
+    # Whether the ensemble's weights are pages of the shared mapped file
+    shared_weights = False
+    loaded_model_names = list(ENSEMBLE_MODEL_NAMES)
 
-    # Check if all models were found
-    all_models_found = all(model_info["path"] is not None for model_info in MODELS.values())
+    # Exported artifacts are self-contained (architecture and weights) and
+    # have the softmax folded in; the quantized model is one of them
+    exported = None
+    if MODEL_PRECISION == "int8":
+        # Quantized kernels only run on the CPU
+        exported = (TorchScriptBackend, base_model_dir / "unified_ensemble_model_int8.pt", torch.device("cpu"))
+    elif INFERENCE_BACKEND == "torchscript":
+        exported = (TorchScriptBackend, base_model_dir / "unified_ensemble_model.ts.pt", device)
+    elif INFERENCE_BACKEND == "onnx":
+        exported = (OnnxRuntimeBackend, base_model_dir / "unified_ensemble_model.onnx", torch.device("cpu"))
+    elif INFERENCE_BACKEND != "eager":
+        print(f"Unknown inference backend {INFERENCE_BACKEND}, using eager")
 
-    # Load the models
-    if all_models_found:
+    if exported is not None:
+        backend_class, exported_path, exported_device = exported
+        if not exported_path.exists():
+            print(f"{backend_class.name} model not found at {exported_path}, falling back to eager fp32")
+        else:
+            try:
+                started = time.perf_counter()
+                if backend_class is OnnxRuntimeBackend:
+                    inference_backend = OnnxRuntimeBackend(exported_path, num_threads=intra_op_threads())
+                else:
+                    inference_backend = backend_class(exported_path, exported_device)
+                    ensemble_model = inference_backend.model
+                timings["load"] = time.perf_counter() - started
+                weight_files = [exported_path]
+                print(f"{backend_class.name} ensemble model loaded successfully from {exported_path}")
+            except Exception as e:
+                print(f"Error loading {backend_class.name} model: {e}")
+                inference_backend = None
+                ensemble_model = None
+
+    # Check if the unified model exists
+    if inference_backend is None and unified_model_path.exists():
         try:
-            # Load EfficientNet model
-            model1 = timm.create_model(MODELS["efficientnet"]["architecture"], pretrained=False, num_classes=2)
-            model1.load_state_dict(torch.load(MODELS["efficientnet"]["path"], map_location=device))
-            model1.to(device)
-            model1.eval()
-            MODELS["efficientnet"]["model_obj"] = model1
-            print("EfficientNet model loaded successfully")
-
-            # Load SwinV2 model
-            model2 = timm.create_model(MODELS["swin"]["architecture"], pretrained=False, num_classes=2)
-            model2.load_state_dict(torch.load(MODELS["swin"]["path"], map_location=device), strict=False)
-            model2.to(device)
-            model2.eval()
-            MODELS["swin"]["model_obj"] = model2
-            print("Swin model loaded successfully")
-
-            # Load ResNet model
-            model3 = timm.create_model(MODELS["resnet"]["architecture"], pretrained=False, num_classes=2)
-            model3.load_state_dict(torch.load(MODELS["resnet"]["path"], map_location=device), strict=False)
-            model3.to(device)
-            model3.eval()
-            MODELS["resnet"]["model_obj"] = model3
-            print("ResNet model loaded successfully")
-
-            # Create ensemble model
-            ensemble_model = EnsembleModel(model1, model2, model3)
-            ensemble_model.to(device)
-            ensemble_model.eval()
-            print("Ensemble model created successfully")
-            
+            # Load the unified model
+            started = time.perf_counter()
+            unified_model = EnsembleModelWrapper()
+            timings["construct"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            if unified_model_path.suffix == ".safetensors":
+                # assign=True keeps the mapped tensors instead of copying into fresh parameters
+                unified_model.load_state_dict(load_mmap_weights(unified_model_path), assign=True)
+            else:
+                unified_model.load_state_dict(torch.load(unified_model_path, map_location=device))
+            unified_model.to(device)
+            unified_model.eval()
+            timings["load"] = time.perf_counter() - started
+            ensemble_model = unified_model
+            # Moving to a GPU copies the mapped weights anyway
+            shared_weights = unified_model_path.suffix == ".safetensors" and device.type == "cpu"
+            weight_files = [unified_model_path]
+            print(f"Unified ensemble model loaded successfully from {unified_model_path}")
         except Exception as e:
-            print(f"Error creating ensemble model: {e}")
+            print(f"Error loading unified model: {e}")
             ensemble_model = None
+    elif inference_backend is None:
+        print(f"Unified ensemble model not found at {unified_model_path}")
+        print("Falling back to loading individual models")
+        started = time.perf_counter()
+    
+        # Define model file paths for fallback
+        MODELS = {
+            "efficientnet": {
+                "path": None,
+                "files": ["efficientnet_pneumonia.pth"],
+                "architecture": "efficientnet_b0",
+                "model_obj": None
+            },
+            "swin": {
+                "path": None,
+                "files": ["swin_best-2.pth"],
+                "architecture": "swinv2_tiny_window8_256",
+                "model_obj": None
+            },
+            "resnet": {
+                "path": None,
+                "files": ["resnet_best.pth"],
+                "architecture": "resnet50d",
+                "model_obj": None
+            }
+        }
+
+        # Find model files
+        for model_name, model_info in MODELS.items():
+            for filename in model_info["files"]:
+                model_path = base_model_dir / filename
+                if model_path.exists():
+                    MODELS[model_name]["path"] = model_path
+                    print(f"Found {model_name} model at: {model_path}")
+                    break
+
+        # Check if all models were found
+        all_models_found = all(model_info["path"] is not None for model_info in MODELS.values())
+
+        # Load the models
+        if all_models_found:
+            try:
+                # Load EfficientNet model
+                model1 = timm.create_model(MODELS["efficientnet"]["architecture"], pretrained=False, num_classes=2)
+                model1.load_state_dict(torch.load(MODELS["efficientnet"]["path"], map_location=device))
+                model1.to(device)
+                model1.eval()
+                MODELS["efficientnet"]["model_obj"] = model1
+                print("EfficientNet model loaded successfully")
+
+                # Load SwinV2 model
+                model2 = timm.create_model(MODELS["swin"]["architecture"], pretrained=False, num_classes=2)
+                model2.load_state_dict(torch.load(MODELS["swin"]["path"], map_location=device), strict=False)
+                model2.to(device)
+                model2.eval()
+                MODELS["swin"]["model_obj"] = model2
+                print("Swin model loaded successfully")
+
+                # Load ResNet model
+                model3 = timm.create_model(MODELS["resnet"]["architecture"], pretrained=False, num_classes=2)
+                model3.load_state_dict(torch.load(MODELS["resnet"]["path"], map_location=device), strict=False)
+                model3.to(device)
+                model3.eval()
+                MODELS["resnet"]["model_obj"] = model3
+                print("ResNet model loaded successfully")
+
+                # Create ensemble model
+                ensemble_model = EnsembleModel(model1, model2, model3, names=("efficientnet", "swin", "resnet"))
+                ensemble_model.to(device)
+                ensemble_model.eval()
+                weight_files = [model_info["path"] for model_info in MODELS.values()]
+                print("Ensemble model created successfully")
+            
+            except Exception as e:
+                print(f"Error creating ensemble model: {e}")
+                ensemble_model = None
             
-            # Try to load at least one model for fallback
+                # Try to load at least one model for fallback
+                for model_name, model_info in MODELS.items():
+                    if model_info["path"] is not None:
+                        try:
+                            model = timm.create_model(model_info["architecture"], pretrained=False, num_classes=2)
+                            model.load_state_dict(torch.load(model_info["path"], map_location=device), 
+                                                 strict=(model_name != "swin" and model_name != "resnet"))
+                            model.to(device)
+                            model.eval()
+                            ensemble_model = model  # Use a single model as fallback
+                            loaded_model_names = [model_info["architecture"]]
+                            weight_files = [model_info["path"]]
+                            print(f"Using {model_name} as fallback model")
+                            break
+                        except Exception as e:
+                            print(f"Failed to load {model_name} model: {e}")
+        else:
+            print("Warning: Not all models were found. Attempting to use what's available.")
+            # Try to load any available model
             for model_name, model_info in MODELS.items():
                 if model_info["path"] is not None:
                     try:
                         model = timm.create_model(model_info["architecture"], pretrained=False, num_classes=2)
-                        model.load_state_dict(torch.load(model_info["path"], map_location=device), 
+                        model.load_state_dict(torch.load(model_info["path"], map_location=device),
                                              strict=(model_name != "swin" and model_name != "resnet"))
                         model.to(device)
                         model.eval()
                         ensemble_model = model  # Use a single model as fallback
+                        loaded_model_names = [model_info["architecture"]]
+                        weight_files = [model_info["path"]]
                         print(f"Using {model_name} as fallback model")
                         break
                     except Exception as e:
                         print(f"Failed to load {model_name} model: {e}")
-    else:
-        print("Warning: Not all models were found. Attempting to use what's available.")
-        # Try to load any available model
-        for model_name, model_info in MODELS.items():
-            if model_info["path"] is not None:
-                try:
-                    model = timm.create_model(model_info["architecture"], pretrained=False, num_classes=2)
-                    model.load_state_dict(torch.load(model_info["path"], map_location=device),
-                                         strict=(model_name != "swin" and model_name != "resnet"))
-                    model.to(device)
-                    model.eval()
-                    ensemble_model = model  # Use a single model as fallback
-                    print(f"Using {model_name} as fallback model")
-                    break
-                except Exception as e:
-                    print(f"Failed to load {model_name} model: {e}")
 
-# Define image transformations for the model
-transform = transforms.Compose([
-    transforms.Resize((256, 256)),
-    transforms.CenterCrop(256),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-])
+        # Individual models are built and loaded together, so both count as load time
+        timings["load"] = time.perf_counter() - started
+
+    optimizations = None
+    if inference_backend is None and ensemble_model is not None:
+        options = {}
+        if OPTIMIZE_TRANSFORMS:
+            started = time.perf_counter()
+            ensemble_model, options, optimizations = optimize_model(
+                ensemble_model, device, OPTIMIZE_TRANSFORMS, OPTIMIZE_TOLERANCE, OPTIMIZE_CHECK_IMAGES,
+                shared_weights=shared_weights)
+            timings["optimize"] = time.perf_counter() - started
+            for transform in optimizations["transforms"]:
+                gain = f", {transform['gain_pct']:+.1f}%" if "gain_pct" in transform else ""
+                print(f"  {transform['name']}: {transform['status']}{gain}")
+            print(f"Optimized ensemble: {optimizations['baseline_ms']:.1f} ms -> "
+                  f"{optimizations['optimized_ms']:.1f} ms per {optimizations['check_images']} images")
+        inference_backend = EagerBackend(ensemble_model, device, **options)
+        configure_ensemble(ensemble_model)
+    if inference_backend is None:
+        raise RuntimeError("Model not loaded properly")
+
+    # Version the loaded weights so cached predictions never outlive them
+    version = weights_checksum(weight_files)
+    cascade = cascade_enabled(inference_backend)
+    # Cascade results can differ from the full ensemble, so they are cached
+    # separately. Load-time optimizations stay within OPTIMIZE_TOLERANCE of
+    # the reference model, so they share its cache entries.
+    cache_version = f"{version}-cascade{CASCADE_THRESHOLD}" if cascade else version
+    print(f"Model version: {version}")
+    return ModelVersion(
+        name, inference_backend, model=ensemble_model, model_names=loaded_model_names,
+        weight_files=weight_files, version=version, cache_version=cache_version,
+        cascade=cascade, timings=timings, optimizations=optimizations
+    )
+
+class BackboneTimings:
+    """
+    Running per-backbone forward pass timings, to see the ensemble's critical path
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, seconds):
+        with self._lock:
+            stats = self._stats.setdefault(name, {"count": 0, "total": 0.0, "last": 0.0})
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["last"] = seconds
+
+    def status(self):
+        with self._lock:
+            backbones = {
+                name: {
+                    "count": stats["count"],
+                    "avg_ms": stats["total"] / stats["count"] * 1000,
+                    "last_ms": stats["last"] * 1000
+                }
+                for name, stats in self._stats.items()
+            }
+        critical_path = max(backbones, key=lambda name: backbones[name]["avg_ms"]) if backbones else None
+        return {"backbones": backbones, "critical_path": critical_path}
+
+backbone_timings = BackboneTimings()
+
+def record_backbone_timing(name, seconds):
+    backbone_timings.record(name, seconds)
+    BACKBONE_LATENCY.observe(seconds, backbone=name)
+
+def configure_ensemble(model):
+    """
+    Hook up per-backbone timing and, if enabled, concurrent backbone execution
+    on an eager three-model ensemble
+    """
+    ensemble = model.ensemble if isinstance(model, EnsembleModelWrapper) else model
+    if not isinstance(ensemble, EnsembleModel):
+        return
+    ensemble.on_backbone_timing = record_backbone_timing
+    if PARALLEL_BACKBONES:
+        ensemble.enable_parallel(backbone_pool)
+        print(f"Running backbones in parallel with {backbone_thread_counts()} threads each")
+    MODEL_STATE["parallel_backbones"] = PARALLEL_BACKBONES
+
+def warmup_batch_sizes():
+    """
+    Batch sizes the scheduler can dispatch, each of which gets a warmup pass
+    """
+    if WARMUP_BATCH_SIZES:
+        return sorted(set(size for size in WARMUP_BATCH_SIZES if 0 < size <= BATCH_MAX_SIZE))
+    return list(range(1, BATCH_MAX_SIZE + 1))
+
+def warmup_model(version):
+    """
+    Run a forward pass at every supported batch size, so the first real
+    request doesn't pay for lazy allocation and kernel selection
+    """
+    for batch_size in warmup_batch_sizes():
+        run_batch(torch.zeros((batch_size, 3) + IMAGE_SIZE[::-1]), version)
+
+def on_model_swap(version):
+    # Cached predictions are only valid for the weights that produced them
+    prediction_cache.set_model_version(version.cache_version)
+    near_duplicates.set_model_version(version.cache_version)
+    MODEL_STATE["backend"] = version.backend.name
+    MODEL_STATE["cascade"] = version.cascade
+    MODEL_STATE["version"] = version.version
+
+# Versions to hot-swap to live in server/model/versions/<name>, laid out like
+# server/model itself ("default")
+model_registry = ModelRegistry(
+    load_model, warmup_model,
+    versions_dir=MODEL_VERSIONS_DIR or find_model_dir() / "versions",
+    default_dir=find_model_dir,
+    on_swap=on_model_swap
+)
+
+def active_model():
+    """
+    The ModelVersion currently serving new requests (None until loaded)
+    """
+    return model_registry.active
+
+def load_and_warmup():
+    """
+    Full startup sequence: load the model, warm it up, then report ready
+    """
+    MODEL_STATE["status"] = "loading"
+    try:
+        version = model_registry.build("default")
+        MODEL_STATE["timings"].update(version.timings)
+        model_registry.activate(version, event="startup")
+        model_registry.state["status"] = "idle"
+        MODEL_STATE["status"] = "ready"
+        print(f"Model ready, startup timings: {MODEL_STATE['timings']}")
+    except Exception as e:
+        MODEL_STATE["status"] = "failed"
+        MODEL_STATE["error"] = str(e)
+        model_registry.state.update(status="failed", error=str(e))
+        print(f"Error starting model: {e}")
+
+def start_model_loading():
+    """
+    Load and warm up the model in the background so server startup isn't blocked
+
+    Runs on the inference pool, so warmup happens on the same threads (and
+    with the same torch thread settings) as real requests.
+    """
+    if MODEL_STATE["status"] != "not_loaded":
+        return None
+    MODEL_STATE["status"] = "loading"
+    return inference_pool.submit(load_and_warmup)
+
+def model_ready():
+    return MODEL_STATE["status"] == "ready"
+
+def model_unavailable_message():
+    if MODEL_STATE["status"] == "failed":
+        return "Model not loaded properly"
+    return "Model is still loading"
 
 # Classes for prediction
 CLASSES = ["Normal", "Pneumonia"]
 
-async def predict_xray(file):
+def preprocess_image(contents, with_hash=False):
+    """
+    Decode raw image bytes (or a binary file object) and turn them into a
+    normalized (C, H, W) tensor
+
+    With with_hash, returns (tensor, perceptual hash of the decoded image).
+    """
+    started = time.perf_counter()
+    pixels = decode_image(contents)
+    decoded = time.perf_counter()
+    tensor = pixels_to_tensor(pixels)
+    STAGE_LATENCY.observe(decoded - started, stage="decode")
+    STAGE_LATENCY.observe(time.perf_counter() - decoded, stage="preprocess")
+    if not with_hash:
+        return tensor
+    started = time.perf_counter()
+    image_hash = perceptual_hash(pixels)
+    STAGE_LATENCY.observe(time.perf_counter() - started, stage="perceptual_hash")
+    return tensor, image_hash
+
+def cascade_enabled(backend):
+    """
+    Cascade mode needs the eager three-model ensemble to run members separately
+    """
+    return (CASCADE_MODE and isinstance(backend, EagerBackend)
+            and hasattr(backend.model, "forward_cascade"))
+
+def explainable(version):
+    """
+    Saliency maps need the eager ensemble, whose feature maps can be hooked
+    """
+    model = version.model
+    ensemble = model.ensemble if isinstance(model, EnsembleModelWrapper) else model
+    return isinstance(version.backend, EagerBackend) and isinstance(ensemble, EnsembleModel)
+
+def run_batch(batch, version=None, explain=None):
+    """
+    Run a stacked (N, C, H, W) batch through the ensemble
+
+    Uses the active model version unless one is given; the whole batch runs
+    on the version it started with, even if another is swapped in meanwhile.
+    Returns one (class probabilities, models consulted, ModelVersion) triple
+    per image.
+
+    explain is an optional list of booleans, one per image. The rows it
+    marks get a fourth element: a fused class activation heatmap for their
+    predicted class, computed from feature maps captured during the same
+    forward pass (None if the backend can't be explained). Batches with
+    explained rows always consult all three models.
+    """
+    version = version or model_registry.active
+    rows = [i for i, flag in enumerate(explain or []) if flag]
+    started = time.perf_counter()
+    if rows and explainable(version):
+        model = version.model
+        ensemble = model.ensemble if isinstance(model, EnsembleModelWrapper) else model
+        with capture_features(ensemble, rows) as capture:
+            probabilities = version.backend.predict_proba(batch)
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage="forward")
+        explained = time.perf_counter()
+        heatmaps = class_activation_maps(ensemble, capture, probabilities[rows].argmax(dim=1))
+        STAGE_LATENCY.observe(time.perf_counter() - explained, stage="explain")
+        outputs = [(row, version.model_names, version) for row in probabilities]
+        for i, row in enumerate(rows):
+            outputs[row] += (heatmaps[i] if heatmaps is not None else None,)
+        BATCH_SIZE.observe(len(batch))
+        return outputs
+
+    if version.cascade and not rows:
+        probabilities, escalated = version.backend.predict_proba_cascade(batch, CASCADE_THRESHOLD)
+        outputs = [
+            (row, ENSEMBLE_MODEL_NAMES if was_escalated else ENSEMBLE_MODEL_NAMES[:1], version)
+            for row, was_escalated in zip(probabilities, escalated.tolist())
+        ]
+    else:
+        probabilities = version.backend.predict_proba(batch)
+        outputs = [(row, version.model_names, version) for row in probabilities]
+    for row in rows:
+        outputs[row] += (None,)
+    STAGE_LATENCY.observe(time.perf_counter() - started, stage="forward")
+    BATCH_SIZE.observe(len(batch))
+    return outputs
+
+def explanation(heatmap, probabilities, models_consulted):
+    """
+    The explanation payload for one image: a base64 PNG overlay of the
+    heatmap for its predicted class, to draw over the 256x256 input
+    """
+    if heatmap is None:
+        return {"error": "Explanations are only available with the eager backend"}
+    started = time.perf_counter()
+    overlay = overlay_png(heatmap)
+    STAGE_LATENCY.observe(time.perf_counter() - started, stage="explain")
+    return {
+        "method": "class_activation_map",
+        "class": CLASSES[int(torch.argmax(probabilities))],
+        "models": list(models_consulted),
+        "size": list(IMAGE_SIZE),
+        "overlay_png": overlay
+    }
+
+def format_prediction(filename, probabilities, models_consulted=None, version=None):
+    """
+    Build the response payload for a single image from its class probabilities,
+    tagged with the model version that produced them
+    """
+    version = version or model_registry.active
+    predicted = int(torch.argmax(probabilities))
+    
+    # Get the prediction class and confidence
+    predicted_class = CLASSES[predicted]
+    confidence_value = probabilities[predicted].item() * 100
+    
+    return {
+        "filename": filename,
+        "prediction": predicted_class,
+        "confidence": f"{confidence_value:.2f}%",
+        "probabilities": {
+            CLASSES[i]: f"{prob.item() * 100:.2f}%" 
+            for i, prob in enumerate(probabilities)
+        },
+        "models_consulted": list(models_consulted or version.model_names),
+        "model_version": version.version
+    }
+
+# Concurrent /predict requests are collected and run as one forward pass
+batch_scheduler = BatchScheduler(
+    run_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    executor=inference_pool,
+    max_concurrent_batches=inference_workers
+)
+BATCH_QUEUE_DEPTH.callback = lambda: {(): batch_scheduler.queue_depth()}
+
+async def predict_xray(file, use_cache=True, purge_cache=False, deadline=None, explain=False):
     """
     Process the uploaded X-ray image and return prediction using ensemble model
+    
+    Results are cached by the hash of the uploaded bytes; use_cache=False
+    skips the lookup (the fresh result is still stored) and purge_cache=True
+    drops any cached entry for this image first.
+    
+    The upload is read straight from its spooled file rather than copied into
+    memory; files that are too large or not images raise UploadRejected
+    before anything is decoded. If the time.monotonic() deadline passes
+    before the image reaches the model, DeadlineExceeded is raised instead
+    of running it (cached results are still returned).
+    
+    With explain=True the result also carries an "explanation": a saliency
+    heatmap for the predicted class, computed from the same forward pass.
+    Cached results have no heatmap, so the cache lookups are skipped (the
+    prediction itself is still cached, without the explanation).
     """
-    if ensemble_model is None:
-        return {"error": "Model not loaded properly"}
+    if not model_ready():
+        return {"error": model_unavailable_message()}
+    use_cache = use_cache and not explain
     
     try:
-        # Read image file
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents)).convert('RGB')
+        # Check size, format and dimensions from the image header
+        started = time.perf_counter()
+        upload = file.file
+        await run_in_pool(decode_pool, validate_upload, upload)
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage="upload_validate")
         
-        # Preprocess the image
-        image_tensor = transform(image).unsqueeze(0).to(device)
+        # Return the stored prediction if these exact bytes were seen before
+        key = None
+        if prediction_cache.enabled:
+            key = await run_in_pool(decode_pool, file_hash, upload)
+            if purge_cache:
+                await run_in_pool(decode_pool, prediction_cache.purge, key)
+            if use_cache and not purge_cache:
+                cached = await run_in_pool(decode_pool, prediction_cache.get, key)
+                if cached is not None:
+                    ENSEMBLE_CALLS_SAVED.inc(source="exact_cache")
+                    return {**cached, "filename": file.filename, "cached": True}
         
-        # Make prediction
-        with torch.no_grad():
-            outputs = ensemble_model(image_tensor)
-            probabilities = torch.nn.functional.softmax(outputs, dim=1)[0]
-            _, predicted = torch.max(outputs, 1)
-            
-        # Get the prediction class and confidence
-        predicted_class = CLASSES[predicted.item()]
-        confidence_value = probabilities[predicted.item()].item() * 100
+        # Decode and preprocess the image off the event loop
+        if deadline is not None and time.monotonic() > deadline:
+            raise DeadlineExceeded("Request deadline passed before decoding")
+        image_hash = None
+        if near_duplicates.enabled:
+            image_tensor, image_hash = await run_in_pool(decode_pool, preprocess_image, upload, True)
+        else:
+            image_tensor = await run_in_pool(decode_pool, preprocess_image, upload)
+        
+        # Reuse the prediction of a re-encoded or rescaled copy of this image
+        if image_hash is not None and use_cache and not purge_cache:
+            match = await run_in_pool(decode_pool, near_duplicates.lookup, image_hash)
+            if match is not None:
+                (probabilities, models_consulted, version), distance = match
+                ENSEMBLE_CALLS_SAVED.inc(source="near_duplicate")
+                result = format_prediction(file.filename, torch.tensor(probabilities), models_consulted, version)
+                result["cached"] = True
+                result["near_duplicate_distance"] = distance
+                return result
+        
+        # Make prediction, batched together with any concurrent requests
+        output, batch_size = await batch_scheduler.submit(image_tensor, deadline, explain)
+        probabilities, models_consulted, version = output[:3]
         
         # Return the prediction results
-        return {
-            "filename": file.filename,
-            "prediction": predicted_class,
-            "confidence": f"{confidence_value:.2f}%",
-            "probabilities": {
-                CLASSES[i]: f"{prob.item() * 100:.2f}%" 
-                for i, prob in enumerate(probabilities)
-            }
-        }
+        started = time.perf_counter()
+        result = format_prediction(file.filename, probabilities, models_consulted, version)
+        STAGE_LATENCY.observe(time.perf_counter() - started, stage="serialize")
+        if key is not None:
+            # Skipped if another version was swapped in while this one ran
+            await run_in_pool(decode_pool, prediction_cache.put, key, result, version.cache_version)
+        if image_hash is not None:
+            entry = (tuple(probabilities.tolist()), tuple(models_consulted), version)
+            near_duplicates.add(image_hash, entry, version.cache_version)
+        # A new dict, so the cached entry doesn't hold this request's
+        # batch size or heatmap
+        result = {**result, "batch_size": batch_size, "cached": False}
+        if explain:
+            result["explanation"] = await run_in_pool(
+                decode_pool, explanation, output[3], probabilities, models_consulted)
+        return result
+    except (UploadRejected, DeadlineExceeded):
+        raise
     except Exception as e:
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+def preprocess_pixels(pixels):
+    """
+    Turn an already decoded uint8 array into a normalized (C, H, W) tensor,
+    resizing it first only if it isn't IMAGE_SIZE
+    """
+    started = time.perf_counter()
+    tensor = pixels_to_tensor(resize_pixels(pixels))
+    STAGE_LATENCY.observe(time.perf_counter() - started, stage="preprocess")
+    return tensor
+
+async def predict_pixels(images, deadline=None):
+    """
+    Predict a stack of already decoded uint8 images, (N, H, W) or (N, H, W, 3)
+
+    Each image joins the micro-batching queue on its own, so a request's
+    images are batched together and with concurrent /predict requests. Skips
+    upload validation, decoding and the prediction caches. Returns the
+    (probabilities, models consulted, ModelVersion) triples in order and the
+    largest batch size they ran in.
+    """
+    if deadline is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded("Request deadline passed before preprocessing")
+    tensors = await asyncio.gather(*[
+        run_in_pool(decode_pool, preprocess_pixels, pixels) for pixels in images
+    ])
+    results = await asyncio.gather(*[batch_scheduler.submit(tensor, deadline) for tensor in tensors])
+    return [output for output, _ in results], max(batch_size for _, batch_size in results)
+
+async def predict_xray_batch(files, explain=False):
+    """
+    Process many uploaded X-ray images (or zip/tar archives of them) and
+    stream back one JSON prediction per line as each chunk finishes
+
+    With explain=True every prediction carries a saliency explanation, as
+    in predict_xray.
+    """
+    if not model_ready():
+        yield json.dumps({"error": model_unavailable_message()}) + "\n"
+        return
+    
+    async for lines in stream_predictions(files, preprocess_image, run_batch, format_prediction,
+                                          explain=explanation if explain else None):
+        yield lines
+
+MODEL_STATE["timings"]["import"] = time.perf_counter() - _IMPORT_STARTED
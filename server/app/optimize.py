@@ -0,0 +1,149 @@
+import copy
+import statistics
+import time
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from .backends import EagerBackend
+from .dataset import list_test_images
+from .preprocessing import IMAGE_SIZE, preprocess_bytes
+
+# Load-time transforms, applied in this order. Each one is kept only if the
+# ensemble's outputs on the check images stay within tolerance of the
+# unoptimized model's.
+TRANSFORMS = ("fold_bn", "channels_last", "inference_mode", "bf16")
+# Transforms that rewrite the weights into private copies
+WEIGHT_COPYING_TRANSFORMS = ("fold_bn", "channels_last")
+
+
+def fold_conv_bn(model):
+    """
+    Fold every BatchNorm2d that directly follows a Conv2d into the conv's
+    weights and bias, in place; returns the number of pairs folded
+
+    Only applies to eval mode. timm's BatchNormAct2d also applies dropout and
+    an activation after normalizing, which are kept in its place.
+    """
+    folded = 0
+    for parent in list(model.modules()):
+        children = list(parent.named_children())
+        for (conv_name, conv), (bn_name, bn) in zip(children, children[1:]):
+            if not (isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)):
+                continue
+            if not bn.track_running_stats or conv.out_channels != bn.num_features:
+                continue
+            setattr(parent, conv_name, fuse_conv_bn_eval(conv, bn))
+            setattr(parent, bn_name, nn.Sequential(bn.drop, bn.act) if hasattr(bn, "act") else nn.Identity())
+            folded += 1
+    return folded
+
+
+def bf16_supported():
+    """
+    Whether this CPU has native bfloat16 instructions (AVX512-BF16 or AMX)
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def check_inputs(per_class=4):
+    """
+    A preprocessed batch of test images to verify transforms on, and where
+    it came from (random inputs when the test images aren't available)
+    """
+    paths = [path for path, _ in list_test_images(limit=per_class)]
+    if paths:
+        return torch.stack([preprocess_bytes(path.read_bytes()) for path in paths]), "test_images"
+    generator = torch.Generator().manual_seed(0)
+    return torch.rand((2 * per_class, 3) + IMAGE_SIZE[::-1], generator=generator) * 2 - 1, "random"
+
+
+def _latency(backend, batch, repeats):
+    # Median forward time after one untimed pass
+    backend.predict_proba(batch)
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        backend.predict_proba(batch)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def optimize_model(model, device, transforms=TRANSFORMS, tolerance=0.01, per_class=4, repeats=3,
+                   shared_weights=False):
+    """
+    Apply the enabled load-time transforms to an eager model
+
+    Every transform is checked against the unoptimized model on the check
+    batch: it is kept only if no class probability moves by more than
+    tolerance and no predicted class changes. The decision never depends on
+    timing, so every worker on a host ends up with the same transforms; the
+    latency of the check batch after each transform is only reported.
+
+    With shared_weights (weights memory-mapped from a file all workers
+    share), transforms that would copy the weights are skipped. Returns the
+    optimized model, the EagerBackend options it needs, and the report.
+    """
+    batch, source = check_inputs(per_class)
+    options = {"inference_mode": False, "channels_last": False, "autocast_dtype": None}
+    reference_backend = EagerBackend(model, device)
+    reference = reference_backend.predict_proba(batch)
+    latency = _latency(reference_backend, batch, repeats)
+    report = {
+        "check_images": len(batch),
+        "check_source": source,
+        "tolerance": tolerance,
+        "baseline_ms": latency * 1000,
+        "transforms": []
+    }
+
+    for name in TRANSFORMS:
+        entry = {"name": name}
+        report["transforms"].append(entry)
+        if name not in transforms:
+            entry["status"] = "disabled"
+            continue
+        if name == "bf16" and (device.type != "cpu" or not bf16_supported()):
+            entry["status"] = "unsupported"
+            continue
+        if shared_weights and name in WEIGHT_COPYING_TRANSFORMS:
+            # Would trade the shared mapped pages for a private copy per worker
+            entry["status"] = "shared_weights"
+            continue
+
+        candidate, candidate_options = model, dict(options)
+        if name == "fold_bn":
+            candidate = copy.deepcopy(model)
+            entry["folded"] = fold_conv_bn(candidate)
+        elif name == "channels_last":
+            candidate = copy.deepcopy(model).to(memory_format=torch.channels_last)
+            candidate_options["channels_last"] = True
+        elif name == "inference_mode":
+            candidate_options["inference_mode"] = True
+        elif name == "bf16":
+            candidate_options["autocast_dtype"] = torch.bfloat16
+
+        backend = EagerBackend(candidate, device, **candidate_options)
+        probabilities = backend.predict_proba(batch)
+        entry["max_abs_diff"] = (probabilities - reference).abs().max().item()
+        same_classes = bool((probabilities.argmax(dim=1) == reference.argmax(dim=1)).all())
+        if entry["max_abs_diff"] > tolerance or not same_classes:
+            entry["status"] = "rejected"
+            continue
+
+        candidate_latency = _latency(backend, batch, repeats)
+        entry.update(
+            latency_ms=candidate_latency * 1000,
+            gain_ms=(latency - candidate_latency) * 1000,
+            gain_pct=(latency - candidate_latency) / latency * 100
+        )
+        entry["status"] = "applied"
+        model, options, latency = candidate, candidate_options, candidate_latency
+
+    report["optimized_ms"] = latency * 1000
+    report["total_gain_pct"] = (report["baseline_ms"] - report["optimized_ms"]) / report["baseline_ms"] * 100
+    return model, options, report
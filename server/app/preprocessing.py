@@ -0,0 +1,108 @@
+import io
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from .config import PREPROCESS_JPEG_DRAFT
+
+# Input size and normalization the ensemble was trained with
+IMAGE_SIZE = (256, 256)
+NORMALIZE_MEAN = 0.5
+NORMALIZE_STD = 0.5
+
+# Reference torchvision pipeline. The fast path below must stay numerically
+# equivalent to it (see scripts/check_preprocessing.py).
+transform = transforms.Compose([
+    transforms.Resize(IMAGE_SIZE),
+    transforms.CenterCrop(IMAGE_SIZE[0]),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[NORMALIZE_MEAN] * 3, std=[NORMALIZE_STD] * 3)
+])
+
+# ToTensor followed by Normalize folded into a single multiply-add:
+# (x / 255 - mean) / std == x * SCALE + SHIFT
+SCALE = 1.0 / (255.0 * NORMALIZE_STD)
+SHIFT = -NORMALIZE_MEAN / NORMALIZE_STD
+
+
+def decode_image(contents, draft=PREPROCESS_JPEG_DRAFT):
+    """
+    Decode image bytes, or a binary file object, into a resized uint8 array
+
+    Grayscale images stay single channel, shape (H, W); anything else is
+    converted to RGB, shape (H, W, 3). With draft enabled, JPEGs are decoded
+    directly at a reduced scale that is still at least IMAGE_SIZE.
+    """
+    if isinstance(contents, (bytes, bytearray)):
+        contents = io.BytesIO(contents)
+    image = Image.open(contents)
+
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    elif draft and image.format == "JPEG":
+        image.draft(image.mode, IMAGE_SIZE)
+
+    # Same resampling torchvision's Resize uses for PIL images
+    image = image.resize(IMAGE_SIZE, Image.BILINEAR)
+    # np.array (not asarray) so the result is writable and torch can share it
+    return np.array(image)
+
+
+def resize_pixels(pixels):
+    """
+    Resize an already decoded uint8 (H, W) or (H, W, 3) array to IMAGE_SIZE
+
+    Arrays that are already the right size are returned as they are, without
+    a copy; others are resized exactly like decode_image resizes.
+    """
+    if pixels.shape[:2] == IMAGE_SIZE[::-1]:
+        return pixels
+    return np.array(Image.fromarray(pixels).resize(IMAGE_SIZE, Image.BILINEAR))
+
+
+def _to_chw(pixels):
+    # uint8 (H, W) or (H, W, 3) -> uint8 view of shape (1 or 3, H, W)
+    tensor = torch.from_numpy(pixels)
+    if tensor.dim() == 2:
+        return tensor.unsqueeze(0)
+    return tensor.permute(2, 0, 1)
+
+
+def pixels_to_tensor(pixels):
+    """
+    Normalize a decoded uint8 array into a (3, H, W) float tensor
+
+    Single channel images are only broadcast to 3 channels as a view, so the
+    float conversion and normalization touch one channel's worth of pixels.
+    """
+    tensor = _to_chw(pixels).to(torch.float32)
+    tensor.mul_(SCALE).add_(SHIFT)
+    return tensor.expand(3, -1, -1)
+
+
+def preprocess_bytes(contents, draft=PREPROCESS_JPEG_DRAFT):
+    """
+    Decode and normalize a single image into a (3, H, W) float tensor
+    """
+    return pixels_to_tensor(decode_image(contents, draft))
+
+
+def pixels_to_batch(arrays):
+    """
+    Normalize a list of decoded uint8 arrays into one (N, 3, H, W) tensor
+    """
+    batch = torch.empty((len(arrays), 3) + IMAGE_SIZE[::-1], dtype=torch.float32)
+    for i, pixels in enumerate(arrays):
+        # copy_ converts to float and broadcasts grayscale to 3 channels in one pass
+        batch[i].copy_(_to_chw(pixels))
+    batch.mul_(SCALE).add_(SHIFT)
+    return batch
+
+
+def preprocess_batch(buffers, draft=PREPROCESS_JPEG_DRAFT):
+    """
+    Decode and normalize a list of image byte buffers into one (N, 3, H, W) tensor
+    """
+    return pixels_to_batch([decode_image(contents, draft) for contents in buffers])
@@ -0,0 +1,181 @@
+import io
+import struct
+
+import numpy as np
+from fastapi.responses import JSONResponse, Response
+
+from .config import MAX_IMAGE_PIXELS, RAW_MAX_BATCH, RAW_MAX_UPLOAD_BYTES
+from .ingest import UploadRejected
+
+# Shape of a raw pixel body, e.g. "1024,1024" or "8,1024,1024,3"
+SHAPE_HEADER = "x-shape"
+NPY_MAGIC = b"\x93NUMPY"
+# Bytes read to parse an .npy header; real headers are a few hundred bytes
+NPY_HEADER_LIMIT = 64 * 1024
+# Ceiling on a raw body even with RAW_MAX_UPLOAD_BYTES=0, so a client can't
+# make a worker buffer an unbounded stream
+RAW_HARD_MAX_BYTES = 4 * 1024 ** 3
+
+RESPONSE_FORMATS = ("json", "msgpack", "binary")
+RESPONSE_MEDIA_TYPES = {
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/octet-stream": "binary"
+}
+
+
+async def read_body(request):
+    """
+    Read a request body into a single writable buffer, up to body_limit()
+
+    The buffer grows as the chunks arrive and is never sized from the
+    client's Content-Length, which is only used to reject an oversized body
+    up front. Arrays built on it with np.frombuffer can be handed to torch
+    without another copy.
+    """
+    limit = body_limit()
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > limit:
+        raise UploadRejected(413, f"Request body is {length} bytes, the limit is {limit} bytes")
+
+    body = bytearray()
+    async for chunk in request.stream():
+        if len(body) + len(chunk) > limit:
+            raise UploadRejected(413, f"Request body is larger than the limit of {limit} bytes")
+        body += chunk
+    if length is not None and length.isdigit() and len(body) != int(length):
+        raise UploadRejected(400, f"Request body is {len(body)} bytes, its Content-Length says {length}")
+    return body
+
+
+def body_limit():
+    """
+    Largest raw body read: RAW_MAX_UPLOAD_BYTES, or RAW_HARD_MAX_BYTES when that is unlimited
+    """
+    return RAW_MAX_UPLOAD_BYTES or RAW_HARD_MAX_BYTES
+
+
+def parse_shape(value):
+    try:
+        shape = tuple(int(part) for part in value.replace("x", ",").split(","))
+    except ValueError:
+        raise UploadRejected(400, f"Invalid {SHAPE_HEADER} header: {value!r}, expected e.g. 1024,1024")
+    if not 2 <= len(shape) <= 4 or any(size <= 0 for size in shape):
+        raise UploadRejected(400, f"Invalid {SHAPE_HEADER} header: {value!r}, expected 2 to 4 positive sizes")
+    return shape
+
+
+def _npy_array(body):
+    # Parse the .npy header and map the data that follows it, without copying
+    header = io.BytesIO(bytes(memoryview(body)[:NPY_HEADER_LIMIT]))
+    try:
+        version = np.lib.format.read_magic(header)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+    except (ValueError, struct.error) as e:
+        raise UploadRejected(400, f"Invalid .npy payload: {e}")
+    if dtype != np.uint8:
+        raise UploadRejected(415, f".npy payload is {dtype}, expected uint8 pixels")
+    if fortran_order:
+        raise UploadRejected(415, ".npy payload must be C-ordered")
+    return _map(body, shape, header.tell())
+
+
+def _map(body, shape, offset=0):
+    expected = int(np.prod(shape))
+    if len(body) - offset != expected:
+        raise UploadRejected(400, f"Body has {len(body) - offset} bytes of pixels, "
+                                  f"shape {'x'.join(map(str, shape))} needs {expected}")
+    return np.frombuffer(body, dtype=np.uint8, count=expected, offset=offset).reshape(shape)
+
+
+def pixels_from_body(body, shape_header=None):
+    """
+    Map a raw request body onto a uint8 array of images, without copying it
+
+    The body is either an .npy file or bare uint8 pixels with their shape in
+    the X-Shape header. Accepted shapes are (H, W), (H, W, C), (N, H, W) and
+    (N, H, W, C) with 1 or 3 channels; a trailing size of 1 or 3 on a 3-D
+    shape is read as channels. Returns ((N, H, W) or (N, H, W, 3) array,
+    whether the request had a batch dimension).
+    """
+    if body[:len(NPY_MAGIC)] == NPY_MAGIC:
+        pixels = _npy_array(body)
+    elif shape_header:
+        pixels = _map(body, parse_shape(shape_header))
+    else:
+        raise UploadRejected(400, f"Raw pixel bodies need an {SHAPE_HEADER} header, or send an .npy file")
+
+    if pixels.ndim == 3 and pixels.shape[-1] not in (1, 3):
+        pixels = pixels[..., np.newaxis]
+    batched = pixels.ndim == 4
+    if pixels.ndim == 2:
+        pixels = pixels[np.newaxis, ..., np.newaxis]
+    elif pixels.ndim == 3:
+        pixels = pixels[np.newaxis]
+    elif pixels.ndim != 4:
+        raise UploadRejected(400, f"Expected 2 to 4 dimensions, got shape {pixels.shape}")
+
+    count, height, width, channels = pixels.shape
+    if channels not in (1, 3):
+        raise UploadRejected(400, f"Expected 1 or 3 channels, got {channels}")
+    if count > RAW_MAX_BATCH:
+        raise UploadRejected(413, f"{count} images in one request, the limit is {RAW_MAX_BATCH}")
+    if MAX_IMAGE_PIXELS and width * height > MAX_IMAGE_PIXELS:
+        raise UploadRejected(413, f"Image is {width}x{height} pixels, the limit is {MAX_IMAGE_PIXELS} pixels")
+    # Grayscale stays single channel, like decoded grayscale uploads
+    return (pixels[..., 0] if channels == 1 else pixels), batched
+
+
+def response_format(requested, accept=""):
+    """
+    Response format from the format query parameter, else the Accept header
+    """
+    if requested:
+        if requested not in RESPONSE_FORMATS:
+            raise UploadRejected(400, f"Unknown response format {requested!r}, "
+                                      f"expected one of {', '.join(RESPONSE_FORMATS)}")
+        return requested
+    for media_type in accept.split(","):
+        media_type = media_type.split(";")[0].strip()
+        if media_type in RESPONSE_MEDIA_TYPES:
+            return RESPONSE_MEDIA_TYPES[media_type]
+    return "json"
+
+
+def encode_predictions(outputs, classes, response_type, batch_size):
+    """
+    Pack (probabilities, models consulted, ModelVersion) triples into a
+    compact msgpack or binary response
+
+    binary is the (N, classes) float32 probabilities, little-endian and
+    row-major, with the shape, class names and model version in headers.
+    msgpack carries the same numbers as lists alongside the predicted class
+    indices.
+    """
+    probabilities = np.stack([row.float().numpy() for row, _, _ in outputs]).astype("<f4")
+    versions = sorted({version.version for _, _, version in outputs})
+    headers = {
+        "X-Shape": ",".join(map(str, probabilities.shape)),
+        "X-Classes": ",".join(classes),
+        "X-Model-Version": ",".join(versions),
+        "X-Batch-Size": str(batch_size)
+    }
+    if response_type == "binary":
+        return Response(probabilities.tobytes(), media_type="application/octet-stream", headers=headers)
+
+    try:
+        import msgpack
+    except ImportError:
+        return JSONResponse(status_code=406, content={"error": "msgpack responses require msgpack: pip install msgpack"})
+    payload = {
+        "classes": list(classes),
+        "predictions": probabilities.argmax(axis=1).tolist(),
+        "probabilities": probabilities.tolist(),
+        "models_consulted": [list(models) for _, models, _ in outputs],
+        "model_version": versions[0] if len(versions) == 1 else versions,
+        "batch_size": batch_size
+    }
+    return Response(msgpack.packb(payload), media_type="application/msgpack", headers=headers)
@@ -0,0 +1,158 @@
+import threading
+import time
+from pathlib import Path
+
+
+class ModelVersion:
+    """
+    One loaded set of weights and everything needed to serve it
+
+    Requests hold on to the ModelVersion their batch started with, so a
+    version that is swapped out keeps serving its in-flight batches.
+    """
+    def __init__(self, name, backend, model=None, model_names=(), weight_files=(), version=None,
+                 cache_version=None, cascade=False, timings=None, optimizations=None):
+        self.name = name
+        self.backend = backend
+        # The torch module behind the backend (None for ONNX Runtime)
+        self.model = model
+        self.model_names = list(model_names)
+        self.weight_files = list(weight_files)
+        self.version = version
+        self.cache_version = cache_version or version
+        self.cascade = cascade
+        self.timings = dict(timings or {})
+        # Report of the load-time optimization pass, if it ran
+        self.optimizations = optimizations
+        self.loaded_at = None
+
+    def describe(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+            "backend": self.backend.name,
+            "models": self.model_names,
+            "cascade": self.cascade,
+            "weight_files": [str(path) for path in self.weight_files],
+            "timings": self.timings,
+            "optimizations": self.optimizations,
+            "loaded_at": self.loaded_at
+        }
+
+
+class ModelRegistry:
+    """
+    Versioned model slots with background loading, atomic swap and rollback
+
+    Versions are directories under versions_dir laid out like server/model.
+    load(name) builds and warms up a version on a background thread while
+    the active one keeps serving, then swaps it in with a single reference
+    assignment; the version it replaced is kept for rollback().
+
+    loader(model_dir, name) returns a ModelVersion and warmup(version) runs
+    it once at every batch size; on_swap(version) is called after each swap.
+    """
+    def __init__(self, loader, warmup, versions_dir, default_dir=None, on_swap=None):
+        self.loader = loader
+        self.warmup = warmup
+        self.versions_dir = Path(versions_dir)
+        self.default_dir = default_dir
+        self.on_swap = on_swap
+        self.active = None
+        self.previous = None
+        self.state = {"status": "idle", "target": None, "error": None}
+        self.history = []
+        self._lock = threading.Lock()
+
+    def available(self):
+        """
+        Names of the versions that can be loaded
+        """
+        names = ["default"]
+        if self.versions_dir.is_dir():
+            names += sorted(path.name for path in self.versions_dir.iterdir() if path.is_dir())
+        return names
+
+    def version_dir(self, name):
+        if name == "default":
+            return self.default_dir() if callable(self.default_dir) else self.default_dir
+        path = (self.versions_dir / name).resolve()
+        if path.parent != self.versions_dir.resolve() or not path.is_dir():
+            raise ValueError(f"Unknown model version: {name}")
+        return path
+
+    def build(self, name):
+        """
+        Load and warm up a version without making it active
+        """
+        model_dir = self.version_dir(name)
+        self.state["status"] = "loading"
+        version = self.loader(model_dir, name)
+        self.state["status"] = "warming_up"
+        started = time.perf_counter()
+        self.warmup(version)
+        version.timings["warmup"] = time.perf_counter() - started
+        version.loaded_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        return version
+
+    def activate(self, version, event="swap"):
+        """
+        Make version the one serving new requests
+        """
+        with self._lock:
+            if self.active is not None:
+                self.previous = self.active
+            self.active = version
+        self.history.append({"event": event, "name": version.name, "version": version.version,
+                             "at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+        if self.on_swap is not None:
+            self.on_swap(version)
+        print(f"Serving model {version.name} ({version.version})")
+
+    def load(self, name):
+        """
+        Start loading a version in the background and swap it in once warm
+
+        Returns False if another load is already running.
+        """
+        self.version_dir(name)
+        with self._lock:
+            if self.state["status"] in ("loading", "warming_up"):
+                return False
+            self.state = {"status": "loading", "target": name, "error": None}
+        threading.Thread(target=self._load, args=(name,), name="model-load", daemon=True).start()
+        return True
+
+    def _load(self, name):
+        try:
+            version = self.build(name)
+            self.activate(version)
+            self.state["status"] = "idle"
+        except Exception as e:
+            self.state["status"] = "failed"
+            self.state["error"] = str(e)
+            self.history.append({"event": "failed", "name": name, "error": str(e),
+                                 "at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+            print(f"Error loading model version {name}: {e}")
+
+    def rollback(self):
+        """
+        Swap the previously active version back in
+
+        Returns False if there is nothing to roll back to.
+        """
+        with self._lock:
+            if self.previous is None:
+                return False
+            previous = self.previous
+        self.activate(previous, event="rollback")
+        return True
+
+    def status(self):
+        return {
+            "state": self.state,
+            "active": self.active.describe() if self.active else None,
+            "previous": self.previous.describe() if self.previous else None,
+            "available": self.available(),
+            "history": self.history[-20:]
+        }
@@ -0,0 +1,166 @@
+import base64
+import contextlib
+import io
+import threading
+import weakref
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from .preprocessing import IMAGE_SIZE
+
+# Most opaque the overlay gets, at the hottest point of the heatmap
+OVERLAY_MAX_ALPHA = 0.6
+
+# The capture of the explained batch running on this thread, if any. The
+# ensemble passes it on to its backbone threads (see EnsembleModel._run_backbone).
+_local = threading.local()
+_hooks = weakref.WeakKeyDictionary()
+_hooks_lock = threading.Lock()
+
+
+class FeatureCapture:
+    """
+    Final feature maps of each backbone for the explained rows of one batch
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.features = {}
+
+
+def current_capture():
+    return getattr(_local, "capture", None)
+
+
+@contextlib.contextmanager
+def use_capture(capture):
+    """
+    Make capture the one hooks on this thread record into
+    """
+    previous = current_capture()
+    _local.capture = capture
+    try:
+        yield
+    finally:
+        _local.capture = previous
+
+
+def _pool_module(backbone):
+    # timm CNNs pool in global_pool; swin does it inside its classifier head
+    # and keeps the pool type string ("avg") in its own global_pool
+    pool = getattr(backbone, "global_pool", None)
+    return pool if isinstance(pool, torch.nn.Module) else backbone.head.global_pool
+
+
+class _BackboneHooks:
+    """
+    Forward pre-hooks on each backbone's global pooling, which see the final
+    feature maps on their way into the classifier
+
+    They are only registered while at least one explained batch is running,
+    so other batches run with no hooks at all.
+    """
+    def __init__(self, ensemble):
+        self.ensemble = ensemble
+        self.users = 0
+        self.handles = []
+
+    def _hook(self, name):
+        def record(module, inputs):
+            capture = current_capture()
+            if capture is not None:
+                capture.features[name] = inputs[0][capture.rows].detach().float()
+        return record
+
+    def acquire(self):
+        if self.users == 0:
+            self.handles = [
+                _pool_module(backbone).register_forward_pre_hook(self._hook(name))
+                for name, backbone in zip(self.ensemble.names, self.ensemble.backbones())
+            ]
+        self.users += 1
+
+    def release(self):
+        self.users -= 1
+        if self.users == 0:
+            for handle in self.handles:
+                handle.remove()
+            self.handles = []
+
+
+@contextlib.contextmanager
+def capture_features(ensemble, rows):
+    """
+    Record the final feature maps of the given batch rows during the forward
+    passes of ensemble run inside this block
+    """
+    with _hooks_lock:
+        hooks = _hooks.get(ensemble)
+        if hooks is None:
+            hooks = _hooks[ensemble] = _BackboneHooks(ensemble)
+        hooks.acquire()
+    capture = FeatureCapture(rows)
+    try:
+        with use_capture(capture):
+            yield capture
+    finally:
+        with _hooks_lock:
+            hooks.release()
+
+
+@torch.no_grad()
+def class_activation_maps(ensemble, capture, classes):
+    """
+    Fused (R, H, W) heatmaps in [0, 1] of the evidence for each explained
+    row's class, from the captured feature maps
+
+    Each backbone's logits are its classifier applied to the spatial mean of
+    its feature map, so weighting the map by the classifier row of the class
+    (less the mean row, i.e. relative to the other classes) gives a map whose
+    mean is the backbone's logit margin. Averaging the upsampled maps of the
+    three backbones decomposes the ensemble's averaged logits the same way.
+    """
+    classes = torch.as_tensor(classes)
+    fused = None
+    for name, backbone in zip(ensemble.names, ensemble.backbones()):
+        features = capture.features.get(name)
+        if features is None:
+            continue
+        weights = backbone.get_classifier().weight.detach().float()
+        contrast = weights[classes] - weights.mean(dim=0)
+        if features.shape[1] != weights.shape[1]:
+            # Swin feature maps are channels last (N, H, W, C)
+            features = features.permute(0, 3, 1, 2)
+        maps = torch.einsum("nchw,nc->nhw", features, contrast)
+        maps = F.interpolate(maps.unsqueeze(1), size=IMAGE_SIZE[::-1], mode="bilinear", align_corners=False)
+        fused = maps if fused is None else fused + maps
+    if fused is None:
+        return None
+    fused = fused.squeeze(1).clamp(min=0)
+    peak = fused.flatten(1).max(dim=1).values.clamp(min=1e-8)
+    return (fused / peak[:, None, None]).cpu()
+
+
+def _colorize(heat):
+    # Jet-like colormap: blue -> cyan -> yellow -> red
+    red = np.clip(1.5 - np.abs(4 * heat - 3), 0, 1)
+    green = np.clip(1.5 - np.abs(4 * heat - 2), 0, 1)
+    blue = np.clip(1.5 - np.abs(4 * heat - 1), 0, 1)
+    return np.stack([red, green, blue], axis=-1)
+
+
+def overlay_png(heatmap):
+    """
+    Base64 RGBA PNG of a [0, 1] heatmap, to draw over the 256x256 input
+
+    Cold regions are transparent, so the PNG stays a few KB and the
+    radiograph shows through where the model didn't look.
+    """
+    heat = heatmap.numpy() if isinstance(heatmap, torch.Tensor) else np.asarray(heatmap)
+    heat = np.round(heat * 255) / 255
+    rgba = np.concatenate([_colorize(heat), heat[..., None] * OVERLAY_MAX_ALPHA], axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray((rgba * 255).astype(np.uint8), "RGBA").save(buffer, format="PNG", optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .config import PREPROCESS_JPEG_DRAFT, TENSOR_STORE_DIR
+from .dataset import LABEL_DIRS, IMAGE_EXTENSIONS
+from .preprocessing import IMAGE_SIZE, SCALE, SHIFT, decode_image
+
+# A directory of images preprocessed once into memory-mapped uint8 shards.
+#
+# store_dir/index.json   one entry per image: relative path, label, original
+#                        size, content hash, file stat, and its shard and row
+# store_dir/shard-*.npy  uint8 arrays of decoded, resized pixels, (N, H, W)
+#                        for grayscale images or (N, H, W, 3) for RGB ones
+#
+# Rebuilds are incremental: unchanged files keep their rows, new or changed
+# images are appended as new shards, and shards are compacted once more than
+# half of their rows belong to deleted or replaced images.
+
+INDEX_FILE = "index.json"
+STORE_VERSION = 1
+
+
+def _label_for(relative_path):
+    for part in Path(relative_path).parts[:-1]:
+        if part.upper() in LABEL_DIRS:
+            return LABEL_DIRS[part.upper()]
+    return None
+
+
+def _load_index(store_dir):
+    index_path = Path(store_dir) / INDEX_FILE
+    if not index_path.exists():
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def _settings(draft):
+    return {"version": STORE_VERSION, "image_size": list(IMAGE_SIZE), "draft": draft}
+
+
+def open_tensor_store(store_dir=TENSOR_STORE_DIR):
+    """
+    Open the tensor store if it exists and was built with the preprocessing
+    settings the server currently uses, otherwise return None
+    """
+    index = _load_index(store_dir)
+    if index is None or index.get("settings") != _settings(PREPROCESS_JPEG_DRAFT):
+        return None
+    return TensorStore(store_dir)
+
+
+def _write_shard(store_dir, shard_id, arrays):
+    name = f"shard-{shard_id:05d}.npy"
+    tmp_path = Path(store_dir) / f"{name}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.stack(arrays))
+    os.replace(tmp_path, Path(store_dir) / name)
+    return name
+
+
+def build_tensor_store(image_dir, store_dir, shard_size=256, draft=PREPROCESS_JPEG_DRAFT):
+    """
+    Preprocess every image under image_dir into memory-mapped shards in
+    store_dir, reusing the rows of images that haven't changed since the
+    last build
+
+    Returns counts of kept, added and removed images.
+    """
+    image_dir = Path(image_dir).resolve()
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    index = _load_index(store_dir)
+    # Shards the index on disk refers to, unlinked only once it no longer does
+    previous_shards = set(index["shards"]) if index else set()
+    settings = _settings(draft)
+    if index is None or index.get("settings") != settings:
+        # Different preprocessing settings invalidate every stored row. Shard
+        # numbering carries on, so new shards never overwrite ones the old
+        # index still points at.
+        index = {"settings": settings, "next_shard": index["next_shard"] if index else 0,
+                 "shards": {}, "entries": {}}
+    old_entries = index["entries"]
+
+    paths = sorted(p for p in image_dir.rglob("*") if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS)
+    entries = {}
+    pending = {1: [], 3: []}
+    counts = {"kept": 0, "added": 0, "removed": 0}
+
+    for path in paths:
+        relative = path.relative_to(image_dir).as_posix()
+        stat = path.stat()
+        entry = old_entries.get(relative)
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            entries[relative] = entry
+            counts["kept"] += 1
+            continue
+
+        contents = path.read_bytes()
+        content_hash = hashlib.sha256(contents).hexdigest()
+        if entry and entry["sha256"] == content_hash:
+            # Touched but not modified
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            entries[relative] = entry
+            counts["kept"] += 1
+            continue
+
+        with Image.open(path) as image:
+            width, height = image.size
+        pixels = decode_image(contents, draft)
+        channels = 1 if pixels.ndim == 2 else 3
+        entry = {
+            "path": relative,
+            "label": _label_for(relative),
+            "width": width,
+            "height": height,
+            "channels": channels,
+            "sha256": content_hash,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns
+        }
+        entries[relative] = entry
+        pending[channels].append((entry, pixels))
+        counts["added"] += 1
+
+    counts["removed"] = len(set(old_entries) - set(entries))
+
+    # Append new and changed images as new shards, one channel layout per shard
+    for channels, items in pending.items():
+        for start in range(0, len(items), shard_size):
+            chunk = items[start:start + shard_size]
+            name = _write_shard(store_dir, index["next_shard"], [pixels for _, pixels in chunk])
+            index["next_shard"] += 1
+            index["shards"][name] = {"rows": len(chunk), "channels": channels}
+            for row, (entry, _) in enumerate(chunk):
+                entry.update(shard=name, row=row)
+
+    index["entries"] = entries
+    _compact(store_dir, index, shard_size)
+
+    # Drop shards no entry points to any more
+    live = {entry["shard"] for entry in entries.values()}
+    dead = (previous_shards | set(index["shards"])) - live
+    for name in dead:
+        index["shards"].pop(name, None)
+
+    tmp_path = store_dir / f"{INDEX_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, store_dir / INDEX_FILE)
+
+    # Only now that the new index is in place can their files go: a crash
+    # before this point leaves the old index and all of its shards intact
+    for name in sorted(dead):
+        (store_dir / name).unlink(missing_ok=True)
+    return counts
+
+
+def _compact(store_dir, index, shard_size):
+    # Rewrite all rows into fresh shards once most stored rows are dead
+    total_rows = sum(shard["rows"] for shard in index["shards"].values())
+    live_rows = len(index["entries"])
+    if total_rows == 0 or live_rows * 2 >= total_rows:
+        return
+
+    shards = {name: np.load(store_dir / name, mmap_mode="r") for name in index["shards"]}
+    by_channels = {1: [], 3: []}
+    for entry in sorted(index["entries"].values(), key=lambda e: e["path"]):
+        by_channels[entry["channels"]].append(entry)
+
+    new_shards = {}
+    for channels, items in by_channels.items():
+        for start in range(0, len(items), shard_size):
+            chunk = items[start:start + shard_size]
+            arrays = [np.array(shards[entry["shard"]][entry["row"]]) for entry in chunk]
+            name = _write_shard(store_dir, index["next_shard"], arrays)
+            index["next_shard"] += 1
+            new_shards[name] = {"rows": len(chunk), "channels": channels}
+            for row, entry in enumerate(chunk):
+                entry.update(shard=name, row=row)
+    index["shards"].update(new_shards)
+
+
+class TensorStore:
+    """
+    Reads batches of preprocessed images from a store built by build_tensor_store
+
+    Shards are memory-mapped copy-on-write, so reading a batch pulls pixels
+    straight from the page cache into the model's input tensor; the only
+    copy is the uint8 -> normalized float conversion the model needs anyway.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+        self.index = _load_index(self.store_dir)
+        if self.index is None:
+            raise FileNotFoundError(f"No tensor store index found in {self.store_dir}")
+        self._shards = {}
+        # Entries in storage order, so consecutive rows are read as one slice
+        self.entries = sorted(self.index["entries"].values(), key=lambda e: (e["shard"], e["row"]))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _shard(self, name):
+        if name not in self._shards:
+            self._shards[name] = np.load(self.store_dir / name, mmap_mode="c")
+        return self._shards[name]
+
+    def lookup(self, relative_path, size=None, mtime_ns=None):
+        """
+        Entry for an image, or None if it isn't stored or its file changed since
+        """
+        entry = self.index["entries"].get(relative_path)
+        if entry is None:
+            return None
+        if size is not None and (entry["size"] != size or entry["mtime_ns"] != mtime_ns):
+            return None
+        return entry
+
+    def load(self, entries):
+        """
+        Normalized (N, 3, H, W) float batch for a list of entries
+        """
+        batch = torch.empty((len(entries), 3) + IMAGE_SIZE[::-1], dtype=torch.float32)
+        i = 0
+        while i < len(entries):
+            # Extend the run while the next entry is the next row of the same shard
+            j = i + 1
+            while (j < len(entries) and entries[j]["shard"] == entries[i]["shard"]
+                   and entries[j]["row"] == entries[j - 1]["row"] + 1):
+                j += 1
+            first = entries[i]["row"]
+            pixels = torch.from_numpy(self._shard(entries[i]["shard"])[first:first + (j - i)])
+            if pixels.dim() == 3:
+                # Grayscale: broadcast to 3 channels while converting
+                batch[i:j].copy_(pixels.unsqueeze(1))
+            else:
+                batch[i:j].copy_(pixels.permute(0, 3, 1, 2))
+            i = j
+        batch.mul_(SCALE).add_(SHIFT)
+        return batch
+
+    def iter_batches(self, batch_size, label=None):
+        """
+        Yield (batch, entries) pairs over the stored images, optionally only one label
+        """
+        entries = [e for e in self.entries if label is None or e["label"] == label]
+        for start in range(0, len(entries), batch_size):
+            chunk = entries[start:start + batch_size]
+            yield self.load(chunk), chunk
@@ -0,0 +1,352 @@
+"""
+CPU topology detection and thread planning for the inference workers
+
+Each server process (uvicorn worker) takes its own slice of the CPUs
+available to the container, pins itself to it and splits it between its
+inference threads, so several processes don't all default to every core and
+oversubscribe. A cgroup CPU quota caps how much CPU time the processes get,
+not where they run, so it only sizes the thread pools. The split can be auto-tuned once per host:
+
+    python -m app.topology --autotune
+
+runs short timed forward passes of the ensemble for a few configurations and
+caches the fastest one in TOPOLOGY_CACHE_PATH, where later startups read it.
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from .config import (
+    SERVER_WORKERS, PIN_WORKERS, INFERENCE_WORKERS, TORCH_NUM_THREADS, TORCH_INTEROP_THREADS,
+    TOPOLOGY_CACHE_PATH, BATCH_MAX_SIZE
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: no worker slots, processes share every CPU
+    fcntl = None
+
+# Held open for the life of the process so the worker slot stays claimed
+_slot_file = None
+
+
+def cgroup_cpu_limit():
+    """
+    CPUs granted by the cgroup CPU quota (v2 cpu.max or v1 CFS quota), or
+    None if unlimited
+    """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus():
+    """
+    IDs of the CPUs this process may run on (its affinity mask)
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def usable_cores(share, workers):
+    """
+    Cores' worth of CPU time one of workers server processes can use on its
+    share of the CPUs
+
+    The cgroup quota is shared by every process in the container, so a
+    container limited to 4 CPUs on a 64 core host gives each of 2 workers 2
+    cores' worth of threads, while still letting them run on any CPU of
+    their share.
+    """
+    cores = len(share)
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cores = min(cores, max(1, int(limit / workers)))
+    return cores
+
+
+SLOT_FILE_PREFIX = "xray-insight-"
+
+
+def _slot_path(parent, index):
+    return Path(tempfile.gettempdir()) / f"{SLOT_FILE_PREFIX}{parent}-worker{index}.lock"
+
+
+def _lock_slot(path):
+    """
+    Open and exclusively lock the slot file at path, or return None if
+    another process holds it
+
+    A holder unlinks its file before releasing the lock, so a lock won on a
+    file that is no longer at path is retried on a fresh one.
+    """
+    while True:
+        slot_file = open(path, "a")
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            slot_file.close()
+            return None
+        try:
+            if os.fstat(slot_file.fileno()).st_ino == os.stat(path).st_ino:
+                return slot_file
+        except FileNotFoundError:
+            pass
+        slot_file.close()
+
+
+def _release_slot():
+    # Unlink while still holding the lock, so no sibling can lock the old file
+    global _slot_file
+    if _slot_file is not None:
+        try:
+            os.unlink(_slot_file.name)
+        except OSError:
+            pass
+        _slot_file.close()
+        _slot_file = None
+
+
+def _remove_orphaned_slots():
+    # Slot files of server processes that were killed before they could clean up
+    for path in Path(tempfile.gettempdir()).glob(f"{SLOT_FILE_PREFIX}*-worker*.lock"):
+        try:
+            parent = int(path.name[len(SLOT_FILE_PREFIX):].split("-")[0])
+            os.kill(parent, 0)
+            continue
+        except ValueError:
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            # Alive, but someone else's
+            continue
+        slot_file = _lock_slot(path)
+        if slot_file is not None:
+            path.unlink(missing_ok=True)
+            slot_file.close()
+
+
+def claim_worker_slot(workers):
+    """
+    Index of this server process among its sibling workers
+
+    Workers started by the same parent each lock the first free slot file;
+    the file is removed when the process exits, along with any left behind
+    by server processes that were killed.
+    """
+    global _slot_file
+    if fcntl is None or workers <= 1:
+        return 0
+    _remove_orphaned_slots()
+    for index in range(workers):
+        slot_file = _lock_slot(_slot_path(os.getppid(), index))
+        if slot_file is None:
+            continue
+        _slot_file = slot_file
+        atexit.register(_release_slot)
+        return index
+    # More processes than slots (e.g. a restarted worker racing its predecessor)
+    return os.getpid() % workers
+
+
+def cpu_share(cpus, index, workers):
+    """
+    The contiguous slice of cpus that worker index of workers gets
+    """
+    per_worker = max(1, len(cpus) // workers)
+    start = (index * per_worker) % len(cpus)
+    return cpus[start:start + per_worker]
+
+
+def pin_to_cpus(cpus):
+    """
+    Restrict this process (and the threads it starts later) to cpus
+    """
+    try:
+        os.sched_setaffinity(0, cpus)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+def host_key(cores):
+    """
+    Cache key for a tuned configuration: the same host, core share and torch
+    version will pick the same configuration again
+    """
+    import torch
+    return f"{platform.node()}|{platform.processor() or platform.machine()}|cores={cores}|torch={torch.__version__}"
+
+
+def load_tuned(key, path=TOPOLOGY_CACHE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_tuned(key, choice, path=TOPOLOGY_CACHE_PATH):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(path) as f:
+            tuned = json.load(f)
+    except (OSError, ValueError):
+        tuned = {}
+    tuned[key] = choice
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(tuned, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def plan_threads():
+    """
+    Decide this process's CPUs, inference workers and torch threads
+
+    Explicit INFERENCE_WORKERS / TORCH_NUM_THREADS settings win, then a
+    tuned configuration cached for this host, then an even split of the
+    process's cores. Pins the process to its CPU share when several server
+    workers run on the host.
+    """
+    cpus = available_cpus()
+    index = claim_worker_slot(SERVER_WORKERS)
+    share = cpu_share(cpus, index, SERVER_WORKERS)
+    pinned = PIN_WORKERS and SERVER_WORKERS > 1 and pin_to_cpus(share)
+    cores = usable_cores(share, SERVER_WORKERS)
+
+    workers, threads, source = 1, None, "default"
+    tuned = load_tuned(host_key(cores))
+    if tuned and not INFERENCE_WORKERS and not TORCH_NUM_THREADS:
+        workers, threads, source = tuned["inference_workers"], tuned["intra_op_threads"], "tuned"
+    if INFERENCE_WORKERS or TORCH_NUM_THREADS:
+        source = "config"
+    workers = INFERENCE_WORKERS or workers
+    threads = TORCH_NUM_THREADS or threads or max(1, cores // workers)
+
+    return {
+        "server_workers": SERVER_WORKERS,
+        "worker_index": index,
+        "cpus": share,
+        "pinned": bool(pinned),
+        "cgroup_cpu_limit": cgroup_cpu_limit(),
+        "cores": cores,
+        "inference_workers": workers,
+        "intra_op_threads": threads,
+        "interop_threads": TORCH_INTEROP_THREADS or 1,
+        "source": source
+    }
+
+
+def candidate_configs(cores):
+    """
+    (inference workers, intra-op threads each) pairs that use all cores
+    """
+    configs = []
+    for workers in (1, 2, 4, 8):
+        if workers <= cores:
+            configs.append((workers, cores // workers))
+    return configs
+
+
+def _measure(model, batch, workers, threads, iterations):
+    # Images per second with `workers` threads each running forward passes
+    # on `threads` torch threads, as the inference pool would
+    import torch
+
+    ready = threading.Barrier(workers + 1)
+
+    def worker():
+        torch.set_num_threads(threads)
+        with torch.no_grad():
+            model(batch)
+            ready.wait()
+            for _ in range(iterations):
+                model(batch)
+
+    pool = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in pool:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return workers * iterations * len(batch) / elapsed
+
+
+def autotune(cores, batch_size=BATCH_MAX_SIZE, iterations=3, model_dir=None):
+    """
+    Time the candidate configurations on the ensemble and return the fastest
+    """
+    import torch
+    from .model import build_unified_model
+    from .preprocessing import IMAGE_SIZE
+
+    model = build_unified_model(model_dir)
+    batch = torch.zeros((batch_size, 3) + IMAGE_SIZE[::-1])
+    results = []
+    for workers, threads in candidate_configs(cores):
+        throughput = _measure(model, batch, workers, threads, iterations)
+        print(f"  {workers} inference worker(s) x {threads} thread(s): {throughput:.2f} img/s")
+        results.append({"inference_workers": workers, "intra_op_threads": threads, "throughput": throughput})
+    best = max(results, key=lambda result: result["throughput"])
+    best["tuned_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect the CPU topology and tune the inference thread split")
+    parser.add_argument("--autotune", action="store_true", help="Time candidate configurations and cache the best")
+    parser.add_argument("--force", action="store_true", help="Re-tune even if this host has a cached configuration")
+    parser.add_argument("--iterations", type=int, default=3, help="Timed forward passes per configuration")
+    args = parser.parse_args()
+
+    cpus = available_cpus()
+    cores = usable_cores(cpu_share(cpus, 0, SERVER_WORKERS), SERVER_WORKERS)
+    key = host_key(cores)
+    print(f"CPUs available: {len(cpus)} (cgroup limit: {cgroup_cpu_limit() or 'none'}), "
+          f"{SERVER_WORKERS} server worker(s) with {cores} core(s) each")
+
+    if not args.autotune:
+        print(json.dumps(plan_threads(), indent=2))
+        return 0
+    tuned = load_tuned(key)
+    if tuned and not args.force:
+        print(f"✅ Using cached configuration for this host: {tuned}")
+        return 0
+    print(f"Tuning with batch size {BATCH_MAX_SIZE}...")
+    best = autotune(cores, iterations=args.iterations)
+    save_tuned(key, best)
+    print(f"✅ Best: {best['inference_workers']} inference worker(s) x {best['intra_op_threads']} thread(s), "
+          f"saved to {TOPOLOGY_CACHE_PATH}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,116 @@
+import json
+import os
+import struct
+
+import torch
+
+# Weights are stored in the safetensors layout: an 8-byte little-endian
+# header length, a JSON header describing every tensor, then the raw tensor
+# data. Loading maps the file copy-on-write, so every worker process on a host
+# shares the same page-cache pages instead of holding a private copy.
+
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+
+def _dedupe(state_dict):
+    # EnsembleModelWrapper registers each backbone twice (e.g. efficientnet.*
+    # and ensemble.model1.*), so keep one copy and record the other names
+    canonical = {}
+    tensors = {}
+    aliases = {}
+    for name, tensor in state_dict.items():
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if tensor.numel() > 0 and key in canonical:
+            aliases[name] = canonical[key]
+        else:
+            canonical[key] = name
+            tensors[name] = tensor
+    return tensors, aliases
+
+
+def save_mmap_weights(state_dict, path):
+    """
+    Write a state dict as a memory-mappable safetensors file
+
+    Tensors are laid out largest dtype first so every tensor starts at an
+    offset aligned to its element size and can be mapped without copying.
+    The file is written next to the target and renamed into place, so
+    processes that have the old file mapped are never affected.
+    """
+    tensors, aliases = _dedupe(state_dict)
+    names = sorted(tensors, key=lambda name: (-tensors[name].element_size(), name))
+
+    header = {"__metadata__": {"aliases": json.dumps(aliases)}}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes]
+        }
+        offset += nbytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # Pad the header so the data section starts 8-byte aligned
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            tensor = tensors[name].detach().to("cpu").contiguous().reshape(-1)
+            if tensor.numel():
+                f.write(tensor.view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_mmap_weights(path):
+    """
+    Load a safetensors file as a state dict whose tensors are views into a
+    copy-on-write memory map of the file
+
+    Use with load_state_dict(..., assign=True) so the model's parameters are
+    the mapped tensors themselves rather than copies of them.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    data_start = 8 + header_size
+
+    metadata = header.pop("__metadata__", None) or {}
+    storage = torch.UntypedStorage.from_file(str(path), shared=False, nbytes=file_size)
+
+    state_dict = {}
+    for name, info in header.items():
+        dtype = DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        start = data_start + begin
+        itemsize = torch.empty((), dtype=dtype).element_size()
+
+        if start % itemsize == 0:
+            tensor = torch.empty(0, dtype=dtype).set_(storage, start // itemsize, info["shape"])
+        else:
+            # Not aligned for this dtype (files from other writers), fall back to a copy
+            raw = torch.empty(0, dtype=torch.uint8).set_(storage, start, (end - begin,))
+            tensor = raw.clone().view(dtype).reshape(info["shape"])
+        state_dict[name] = tensor
+
+    for alias, name in json.loads(metadata.get("aliases", "{}")).items():
+        state_dict[alias] = state_dict[name]
+    return state_dict
@@ -30,12 +30,26 @@ def check_dependencies():
             
             return False
 
+def tune_threads():
+    """Tune the inference thread split once per host if TOPOLOGY_AUTOTUNE=1"""
+    if os.environ.get("TOPOLOGY_AUTOTUNE") != "1":
+        return
+    # Runs in its own process so the server workers start with the tuned settings
+    print("Auto-tuning inference threads (skipped if this host is already tuned)...")
+    if subprocess.call([sys.executable, "-m", "app.topology", "--autotune"]) != 0:
+        print("❌ Auto-tuning failed, starting with the default thread split")
+
 def run_server():
     """Run the FastAPI server"""
     try:
         import uvicorn
-        print("Starting X-Ray Insight FastAPI server...")
-        uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+        # Each worker process takes its own share of the cores (see app/topology.py)
+        workers = int(os.environ.get("SERVER_WORKERS", "1"))
+        print(f"Starting X-Ray Insight FastAPI server with {workers} worker(s)...")
+        if workers > 1:
+            uvicorn.run("app.main:app", host="0.0.0.0", port=8000, workers=workers)
+        else:
+            uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
     except Exception as e:
         print(f"❌ Error starting server: {e}")
         
@@ -68,6 +82,7 @@ if __name__ == "__main__":
     # Check dependencies
     if check_dependencies():
         # Run the server
+        tune_threads()
         run_server()
     else:
         sys.exit(1)
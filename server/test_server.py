@@ -1,68 +1,442 @@
-import requests
-import sys
+#!/usr/bin/env python3
+"""
+Smoke and load test for a running X-Ray Insight server.
+
+With only an image path it sends one /predict request and prints the result.
+With --concurrency or --rps it replays images (by default every image under
+test_images) against the server:
+
+- closed loop: --concurrency 1,4,16 keeps that many requests in flight,
+  each client sending its next request as soon as the previous one returns
+- open loop: --rps 5,20 sends requests at that target rate whether or not
+  earlier ones have returned, and measures latency from the scheduled send
+  time, so server queueing isn't hidden by a slowed-down client
+
+Each level runs for --duration seconds (or --requests requests) and reports
+throughput, p50/p90/p99/max latency and error and 429 rates, overall and per
+--interval. --output saves everything, with a snapshot of the server's
+batching and admission settings, as JSON for comparing configurations.
+Only the standard library is used; requests go over plain HTTP/1.1
+keep-alive connections.
+"""
+
+import argparse
+import asyncio
+import json
 import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
 from pathlib import Path
+from urllib.parse import urlsplit
 
-def test_server_connection():
-    """Test if the server is running and responding"""
-    try:
-        response = requests.get("http://localhost:8000/")
-        if response.status_code == 200:
-            print("✅ Server is running and responding")
-            return True
+IMAGE_EXTENSIONS = {".jpeg", ".jpg", ".png"}
+DEFAULT_IMAGES = Path(__file__).resolve().parent / "test_images"
+
+
+class HttpConnection:
+    """
+    A single keep-alive HTTP/1.1 connection
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.closed = True
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.closed = False
+        return self
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.closed = True
+
+    async def request(self, method, path, headers=None, body=b""):
+        """
+        Send a request and read the whole response: (status, headers, body)
+        """
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.writer.writelines([("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"), body])
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Server closed the connection")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            response_body = b"".join(chunks)
         else:
-            print(f"❌ Server returned status code {response.status_code}")
-            return False
-    except requests.exceptions.ConnectionError:
-        print("❌ Could not connect to server. Make sure it's running on http://localhost:8000")
-        return False
-
-def test_prediction_endpoint(image_path=None):
-    """Test the prediction endpoint with a sample image"""
+            response_body = await self.reader.readexactly(int(response_headers.get("content-length", 0)))
+        if response_headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, response_headers, response_body
+
+
+class Client:
+    """
+    Pool of keep-alive connections to one server, at most max_connections open
+    """
+    def __init__(self, url, max_connections=256, timeout=30.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(max_connections)
+        self.idle = []
+
+    async def _send(self, method, path, headers, body):
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else await HttpConnection(self.host, self.port).open()
+            try:
+                response = await asyncio.wait_for(connection.request(method, path, headers, body), self.timeout)
+            except BaseException:
+                connection.close()
+                raise
+            if not connection.closed:
+                self.idle.append(connection)
+            return response
+
+    async def send(self, method, path, headers=None, body=b""):
+        try:
+            return await self._send(method, path, headers, body)
+        except ConnectionError:
+            # The server may close an idle keep-alive connection; retry once on a fresh one
+            self.idle.clear()
+            return await self._send(method, path, headers, body)
+
+    async def get_json(self, path):
+        status, _, body = await self.send("GET", path)
+        return status, json.loads(body) if body else None
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+
+def find_images(paths, limit=None):
+    images = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            images += sorted(p for p in path.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+        elif path.exists():
+            images.append(path)
+    return images[:limit] if limit else images
+
+
+def multipart_request(path, use_cache):
+    """
+    A ready-to-send /predict request for one image, built once up front
+    """
+    boundary = uuid.uuid4().hex
+    content_type = "image/png" if path.suffix.lower() == ".png" else "image/jpeg"
+    body = b"".join([
+        f"--{boundary}\r\n".encode(),
+        f'Content-Disposition: form-data; name="file"; filename="{path.name}"\r\n'.encode(),
+        f"Content-Type: {content_type}\r\n\r\n".encode(),
+        path.read_bytes(),
+        f"\r\n--{boundary}--\r\n".encode()
+    ])
+    query = "" if use_cache else "?cache=false"
+    return "/predict" + query, {"Content-Type": f"multipart/form-data; boundary={boundary}"}, body
+
+
+def raw_request(path, size):
+    """
+    A /predict/raw request carrying the image's decoded pixels, as an
+    upstream service holding decoded images would send them
+    """
+    from PIL import Image
+
+    image = Image.open(path)
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    if size:
+        image = image.resize((size, size), Image.BILINEAR)
+    shape = f"{image.height},{image.width}" + (",3" if image.mode == "RGB" else "")
+    return "/predict/raw", {"Content-Type": "application/octet-stream", "X-Shape": shape}, image.tobytes()
+
+
+def outcome(status, headers, body):
+    if status == 429:
+        return "429"
+    if status != 200:
+        return f"http_{status}"
+    # /predict reports some failures as a 200 with an error payload
+    if headers.get("content-type", "").startswith("application/json") and body.startswith(b'{"error"'):
+        return "error_response"
+    return "ok"
+
+
+async def timed_request(client, request, started, scheduled=None):
+    """
+    Send one request; latency is measured from its scheduled send time
+    """
+    scheduled = scheduled or time.monotonic()
+    path, headers, body = request
+    try:
+        result = outcome(*await client.send("POST", path, headers, body))
+    except asyncio.TimeoutError:
+        result = "timeout"
+    except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+        result = "connection_error"
+    return {"t": scheduled - started, "latency": time.monotonic() - scheduled, "outcome": result}
+
+
+async def run_closed_loop(client, requests, concurrency, duration, max_requests=None):
+    started = time.monotonic()
+    stop = started + duration
+    results = []
+    sent = 0
+
+    async def worker(offset):
+        nonlocal sent
+        index = offset
+        while time.monotonic() < stop and (not max_requests or sent < max_requests):
+            sent += 1
+            results.append(await timed_request(client, requests[index % len(requests)], started))
+            index += concurrency
+
+    await asyncio.gather(*[worker(random.randrange(len(requests))) for _ in range(concurrency)])
+    return results, time.monotonic() - started
+
+
+async def run_open_loop(client, requests, rps, duration, max_requests=None, poisson=False):
+    started = time.monotonic()
+    next_send = started
+    tasks = []
+    index = random.randrange(len(requests))
+    while next_send < started + duration and (not max_requests or len(tasks) < max_requests):
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(
+            timed_request(client, requests[index % len(requests)], started, scheduled=next_send)))
+        index += 1
+        next_send += random.expovariate(rps) if poisson else 1 / rps
+    results = await asyncio.gather(*tasks)
+    return list(results), time.monotonic() - started
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def latency_summary(results):
+    latencies = [result["latency"] * 1000 for result in results if result["outcome"] == "ok"]
+    return {
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies, default=0.0),
+        "mean": sum(latencies) / len(latencies) if latencies else 0.0
+    }
+
+
+def rates(results, elapsed):
+    outcomes = Counter(result["outcome"] for result in results)
+    total = len(results) or 1
+    return {
+        "requests": len(results),
+        "ok": outcomes["ok"],
+        "throughput_rps": outcomes["ok"] / elapsed if elapsed > 0 else 0.0,
+        "rate_429": outcomes["429"] / total,
+        "error_rate": (len(results) - outcomes["ok"] - outcomes["429"]) / total,
+        "outcomes": dict(outcomes)
+    }
+
+
+def summarize(results, elapsed, interval):
+    """
+    Totals for one level, plus the same figures per interval of its run
+    """
+    timeline = []
+    buckets = {}
+    for result in results:
+        buckets.setdefault(int(result["t"] // interval), []).append(result)
+    for bucket in sorted(buckets):
+        timeline.append({"t": bucket * interval, **rates(buckets[bucket], interval),
+                         "latency_ms": latency_summary(buckets[bucket])})
+    return {**rates(results, elapsed), "elapsed": elapsed, "latency_ms": latency_summary(results),
+            "timeline": timeline}
+
+
+def print_level(label, summary, show_timeline):
+    latency = summary["latency_ms"]
+    print(f"  {label:<18} {summary['requests']:>7} {summary['throughput_rps']:>8.1f} "
+          f"{latency['p50']:>8.1f} {latency['p90']:>8.1f} {latency['p99']:>8.1f} {latency['max']:>8.1f} "
+          f"{summary['rate_429'] * 100:>6.1f}% {summary['error_rate'] * 100:>6.1f}%")
+    if show_timeline:
+        for point in summary["timeline"]:
+            print(f"    t={point['t']:>5.0f}s {point['requests']:>6} req {point['throughput_rps']:>7.1f} ok/s "
+                  f"p50 {point['latency_ms']['p50']:>7.1f} ms p99 {point['latency_ms']['p99']:>7.1f} ms "
+                  f"429 {point['rate_429'] * 100:>5.1f}% err {point['error_rate'] * 100:>5.1f}%")
+
+
+async def server_snapshot(client):
+    # Settings of the server under test, so saved runs can be compared
+    snapshot = {}
+    for name, path in (("health", "/health/ready"), ("batching", "/batching"), ("admission", "/admission")):
+        try:
+            _, snapshot[name] = await client.get_json(path)
+        except Exception as e:
+            snapshot[name] = {"error": str(e)}
+    return snapshot
+
+
+async def smoke_test(client, image_path):
+    """
+    The original single-shot check: is the server up, and does /predict work
+    """
+    try:
+        status, _, _ = await client.send("GET", "/")
+    except OSError:
+        print(f"❌ Could not connect to server. Make sure it's running on http://{client.host}:{client.port}")
+        print("\nPlease make sure the server is running with 'python run.py'")
+        return 1
+    if status != 200:
+        print(f"❌ Server returned status code {status}")
+        return 1
+    print("✅ Server is running and responding")
+
     if not image_path:
-        print("No image path provided. Skipping prediction test.")
-        return False
-    
+        print("\nTo test the prediction endpoint, provide an image path:")
+        print("python test_server.py path/to/xray_image.jpg")
+        print("\nTo load test it: python test_server.py --concurrency 1,4,16 --duration 30")
+        return 0
     if not os.path.exists(image_path):
         print(f"❌ Image file not found at {image_path}")
-        return False
-    
-    try:
-        with open(image_path, "rb") as f:
-            files = {"file": (os.path.basename(image_path), f, "image/jpeg")}
-            response = requests.post("http://localhost:8000/predict", files=files)
-        
-        if response.status_code == 200:
-            result = response.json()
-            print("\n✅ Prediction endpoint is working")
-            print("\nPrediction Result:")
-            print(f"  - Filename: {result.get('filename')}")
-            print(f"  - Prediction: {result.get('prediction')}")
-            print(f"  - Confidence: {result.get('confidence')}")
-            print("\nProbabilities:")
-            for class_name, prob in result.get('probabilities', {}).items():
-                print(f"  - {class_name}: {prob}")
-            return True
+        return 1
+
+    path, headers, body = multipart_request(Path(image_path), use_cache=True)
+    status, _, response = await client.send("POST", path, headers, body)
+    if status != 200:
+        print(f"❌ Prediction endpoint returned status code {status}")
+        print(f"Response: {response.decode(errors='replace')}")
+        return 1
+    result = json.loads(response)
+    print("\n✅ Prediction endpoint is working")
+    print("\nPrediction Result:")
+    print(f"  - Filename: {result.get('filename')}")
+    print(f"  - Prediction: {result.get('prediction')}")
+    print(f"  - Confidence: {result.get('confidence')}")
+    print("\nProbabilities:")
+    for class_name, prob in result.get('probabilities', {}).items():
+        print(f"  - {class_name}: {prob}")
+    return 0
+
+
+def parse_levels(value):
+    return [float(level) for level in value.split(",") if level.strip()] if value else []
+
+
+async def run(args):
+    client = Client(args.url, max_connections=args.max_connections, timeout=args.timeout)
+    concurrency_levels = [int(level) for level in parse_levels(args.concurrency)]
+    rps_levels = parse_levels(args.rps)
+    if not concurrency_levels and not rps_levels:
+        try:
+            return await smoke_test(client, args.images[0] if args.images else None)
+        finally:
+            client.close()
+
+    images = find_images(args.images or [DEFAULT_IMAGES], args.limit)
+    if not images:
+        print("❌ No images found to replay")
+        return 1
+    if args.endpoint == "raw":
+        requests = [raw_request(path, args.raw_size) for path in images]
+    else:
+        requests = [multipart_request(path, args.use_cache) for path in images]
+    print(f"Replaying {len(images)} images against {args.url}/{args.endpoint.replace('raw', 'predict/raw')}")
+
+    report = {
+        "url": args.url,
+        "endpoint": requests[0][0],
+        "images": len(images),
+        "duration": args.duration,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "server": await server_snapshot(client),
+        "levels": []
+    }
+
+    print(f"\n  {'level':<18} {'requests':>7} {'ok/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'429':>7} {'errors':>7}")
+    levels = [("closed", level) for level in concurrency_levels] + [("open", level) for level in rps_levels]
+    for mode, level in levels:
+        if mode == "closed":
+            label = f"concurrency={level}"
+            results, elapsed = await run_closed_loop(client, requests, level, args.duration, args.requests)
         else:
-            print(f"❌ Prediction endpoint returned status code {response.status_code}")
-            print(f"Response: {response.text}")
-            return False
-    except Exception as e:
-        print(f"❌ Error during prediction test: {str(e)}")
-        return False
+            label = f"rps={level:g}"
+            results, elapsed = await run_open_loop(client, requests, level, args.duration, args.requests,
+                                                   args.poisson)
+        summary = summarize(results, elapsed, args.interval)
+        print_level(label, summary, args.timeline)
+        report["levels"].append({"mode": mode, "level": level, **summary})
+        if args.pause:
+            await asyncio.sleep(args.pause)
+    client.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smoke or load test a running X-Ray Insight server")
+    parser.add_argument("images", nargs="*", help="Image files or directories (default: test_images)")
+    parser.add_argument("--url", default="http://localhost:8000", help="Server base URL")
+    parser.add_argument("--endpoint", choices=["predict", "raw"], default="predict",
+                        help="Send multipart uploads to /predict or decoded pixels to /predict/raw")
+    parser.add_argument("--concurrency", help="Closed-loop concurrency levels, comma separated (e.g. 1,4,16)")
+    parser.add_argument("--rps", help="Open-loop target request rates, comma separated (e.g. 5,20)")
+    parser.add_argument("--poisson", action="store_true", help="Open loop: Poisson arrivals instead of a fixed interval")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per level")
+    parser.add_argument("--requests", type=int, help="Stop a level after this many requests")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds per timeline bucket")
+    parser.add_argument("--timeline", action="store_true", help="Print the per-interval figures")
+    parser.add_argument("--pause", type=float, default=2.0, help="Seconds to let the server drain between levels")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds before a request counts as timed out")
+    parser.add_argument("--max-connections", type=int, default=256, help="Open connections at most")
+    parser.add_argument("--limit", type=int, help="Replay at most this many images")
+    parser.add_argument("--use-cache", action="store_true",
+                        help="Let /predict serve repeated images from its prediction cache")
+    parser.add_argument("--raw-size", type=int, default=256,
+                        help="Side the images are resized to for /predict/raw (0 = original size)")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
 
 if __name__ == "__main__":
-    print("Testing X-Ray Insight FastAPI Server\n")
-    
-    # Test server connection
-    if not test_server_connection():
-        print("\nPlease make sure the server is running with 'python run.py'")
-        sys.exit(1)
-    
-    # Test prediction endpoint with a sample image if provided
-    if len(sys.argv) > 1:
-        image_path = sys.argv[1]
-        test_prediction_endpoint(image_path)
-    else:
-        print("\nTo test the prediction endpoint, provide an image path:")
-        print("python test_server.py path/to/xray_image.jpg")
+    sys.exit(main())